@@ -0,0 +1,28 @@
+"""WSGI entry point serving many requests per worker on gevent."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The patch has to come before anything imports socket, threading or
+# pymongo, so that waiting on MongoDB yields to other requests.
+from gevent import monkey
+monkey.patch_all()
+
+from donthackme_api.app import create_app  # noqa
+
+app = create_app(app_name=__name__)
+
+if __name__ == "__main__":
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(("0.0.0.0", 5000), app).serve_forever()
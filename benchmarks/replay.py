@@ -0,0 +1,271 @@
+"""Replay a recorded Cowrie event stream through the events API."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from donthackme_api import metrics  # noqa
+from donthackme_api.events.cowrie import Translator  # noqa
+
+
+DEFAULT_RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+MONGO_OPS = "donthackme_mongo_command_duration_seconds"
+
+CONFIG_TEMPLATE = """
+MONGODB_SETTINGS = {settings!r}
+MONGODB_WARM_UP = {warm_up!r}
+SECRET_KEY = "benchmark"
+LOG_FILE = {log_file!r}
+METRICS_DIR = None
+PROFILE_DIR = None
+RATELIMIT_ENABLED = False
+"""
+
+
+def open_stream(path):
+    """Open a plain or gzipped JSONL file."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def git_commit():
+    """Return the commit of the tree being measured, if known."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCH_DIR
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_app(mongo, workdir):
+    """Create the app against mongomock or a local mongod."""
+    if mongo == "mongomock":
+        settings = {"host": "mongomock://localhost", "db": "donthackme_bench"}
+    else:
+        settings = {"host": mongo, "db": "donthackme_bench"}
+
+    config_path = os.path.join(workdir, "bench_config.py")
+    with open(config_path, "w") as handle:
+        handle.write(CONFIG_TEMPLATE.format(
+            settings=settings,
+            # The warm-up's index check opens the capped TransactionLog,
+            # which mongomock cannot create.
+            warm_up=mongo != "mongomock",
+            log_file=os.path.join(workdir, "bench.log")
+        ))
+    os.environ["DONTHACKME_API_SETTINGS"] = config_path
+
+    if mongo == "mongomock":
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+
+    from donthackme_api.app import create_app
+    from donthackme_api.models import TransactionLog, User
+
+    app = create_app(app_name="donthackme_bench")
+    database = User._get_db()
+    database.client.drop_database(database.name)
+    if mongo == "mongomock":
+        # mongomock cannot create capped collections; a plain one keeps
+        # the entries in the same order.
+        TransactionLog._collection = database[
+            TransactionLog._get_collection_name()]
+
+    user = User(
+        username="bench",
+        email="bench@example.com",
+        password="bench",
+        version=1
+    ).save()
+    return app, {"X-Auth-Token": str(user.api_key)}
+
+
+def replay(app, headers, path, limit=None):
+    """Send every event in path through the test client and time it."""
+    client = app.test_client()
+    translator = Translator()
+    timings = {}
+    errors = {}
+    mongo_ops = {}
+    skipped = 0
+    events = 0
+
+    start = time.time()
+    with open_stream(path) as stream:
+        for line in stream:
+            if limit is not None and events >= limit:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            translated = translator.translate(json.loads(line))
+            if translated is None:
+                skipped += 1
+                continue
+            eventid, method, route, payload = translated
+            body = json.dumps(payload)
+
+            ops_before = metrics.REGISTRY.total(MONGO_OPS)
+            request_start = time.time()
+            response = client.open(
+                route,
+                method=method,
+                data=body,
+                content_type="application/json",
+                headers=headers
+            )
+            elapsed = time.time() - request_start
+            ops = metrics.REGISTRY.total(MONGO_OPS) - ops_before
+
+            events += 1
+            timings.setdefault(eventid, []).append(elapsed)
+            mongo_ops[eventid] = mongo_ops.get(eventid, 0) + ops
+            if response.status_code >= 400:
+                errors[eventid] = errors.get(eventid, 0) + 1
+    duration = time.time() - start
+
+    endpoints = {}
+    for eventid, values in timings.items():
+        values.sort()
+        endpoints[eventid] = {
+            "count": len(values),
+            "errors": errors.get(eventid, 0),
+            "mean_ms": 1000.0 * sum(values) / len(values),
+            "p50_ms": 1000.0 * percentile(values, 0.50),
+            "p95_ms": 1000.0 * percentile(values, 0.95),
+            "p99_ms": 1000.0 * percentile(values, 0.99),
+            "mongo_ops_per_event": float(mongo_ops[eventid]) / len(values),
+        }
+
+    total_ops = sum(mongo_ops.values())
+    return {
+        "events": events,
+        "skipped": skipped,
+        "duration_s": duration,
+        "throughput_eps": events / duration if duration else None,
+        "mongo_ops_per_event": float(total_ops) / events if events else None,
+        "endpoints": endpoints,
+    }
+
+
+def print_report(result, baseline=None):
+    """Print a per-endpoint table, with deltas against a baseline."""
+    def delta(new, old):
+        if old in (None, 0) or new is None:
+            return ""
+        return " ({0:+.1f}%)".format(100.0 * (new - old) / old)
+
+    base_endpoints = baseline["endpoints"] if baseline else {}
+    print("{0} events in {1:.2f}s: {2:.1f} events/s{3}".format(
+        result["events"],
+        result["duration_s"],
+        result["throughput_eps"] or 0,
+        delta(result["throughput_eps"],
+              baseline and baseline.get("throughput_eps"))
+    ))
+    print("mongo ops/event: {0}{1}".format(
+        result["mongo_ops_per_event"],
+        delta(result["mongo_ops_per_event"],
+              baseline and baseline.get("mongo_ops_per_event"))
+    ))
+    row = "{0:<32} {1:>7} {2:>6} {3:>16} {4:>16} {5:>16} {6:>8}"
+    print(row.format("event", "count", "errors", "p50 ms", "p95 ms",
+                     "p99 ms", "ops/ev"))
+    for eventid in sorted(result["endpoints"]):
+        stats = result["endpoints"][eventid]
+        old = base_endpoints.get(eventid, {})
+        print(row.format(
+            eventid,
+            stats["count"],
+            stats["errors"],
+            "{0:.2f}{1}".format(stats["p50_ms"],
+                                delta(stats["p50_ms"], old.get("p50_ms"))),
+            "{0:.2f}{1}".format(stats["p95_ms"],
+                                delta(stats["p95_ms"], old.get("p95_ms"))),
+            "{0:.2f}{1}".format(stats["p99_ms"],
+                                delta(stats["p99_ms"], old.get("p99_ms"))),
+            "-" if stats["mongo_ops_per_event"] is None else
+            "{0:.1f}".format(stats["mongo_ops_per_event"])
+        ))
+
+
+def main(argv=None):
+    """Run the benchmark and save its results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("events", help="Cowrie JSONL event stream (.gz ok)")
+    parser.add_argument("--mongo", default="mongomock",
+                        help="'mongomock' or a mongodb:// URI of a local "
+                             "mongod (its donthackme_bench db is dropped)")
+    parser.add_argument("--limit", type=int, help="Replay at most N events")
+    parser.add_argument("--name", default="replay", help="Result name")
+    parser.add_argument("--results-dir", default=DEFAULT_RESULTS_DIR)
+    parser.add_argument("--compare", help="Earlier result file to diff with")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="donthackme_bench")
+    app, headers = build_app(args.mongo, workdir)
+    result = replay(app, headers, args.events, args.limit)
+    result.update({
+        "name": args.name,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": git_commit(),
+        "mongo": "mongomock" if args.mongo == "mongomock" else "mongod",
+        "input": os.path.basename(args.events),
+    })
+    if result["mongo"] == "mongomock":
+        # mongomock never talks to a server, so no commands are observed.
+        result["mongo_ops_per_event"] = None
+        for stats in result["endpoints"].values():
+            stats["mongo_ops_per_event"] = None
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+    print_report(result, baseline)
+
+    if not os.path.isdir(args.results_dir):
+        os.makedirs(args.results_dir)
+    out_path = os.path.join(args.results_dir, "{0}-{1}.json".format(
+        args.name, time.strftime("%Y%m%dT%H%M%S")))
+    with open(out_path, "w") as handle:
+        json.dump(result, handle, indent=2, sort_keys=True)
+    print("results saved to {0}".format(out_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,18 +14,168 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import Blueprint
+import time
 
+from flask import Blueprint, current_app, jsonify, request
+
+from donthackme_api import auth
+from donthackme_api import heartbeat
+from donthackme_api import metrics
+from donthackme_api.profiler import PROFILER
+from donthackme_api.slowlog import SLOWLOG
 from donthackme_api.models import Sensor
 
+# Shortest sampling interval of a profile, in seconds.
+MIN_INTERVAL = 0.001
+
 admin = Blueprint('admin', __name__, url_prefix="/admin")
 
 
+@admin.route("/live", methods=["GET"])
+def test_liveness():
+    """Report that this worker is serving requests, without touching Mongo."""
+    return jsonify(status="alive"), 200
+
+
+@admin.route("/ready", methods=["GET"])
 @admin.route("/health", methods=["GET"])
-def test_health():
+def test_readiness():
+    """
+    Report whether this worker can serve sensor traffic.
+
+    Runs a timed ping against MongoDB and returns 503 when it fails or
+    exceeds READINESS_LATENCY_BUDGET_MS, so that a load balancer drains
+    the node before requests pile up.
+    """
+    budget = current_app.config.get("READINESS_LATENCY_BUDGET_MS", 250)
+    response = {
+        "budget_ms": budget,
+        "pool": metrics.POOL_STATS.to_dict()
+    }
+
+    start = time.time()
     try:
-        Sensor.objects()
-    except:
-        return "Couldn't connect to DB!", 500
+        Sensor._get_db().command("ping")
+    except Exception as e:
+        response["status"] = "unavailable"
+        response["error"] = str(e)
+        return jsonify(response), 503
+    latency = (time.time() - start) * 1000.0
+    response["ping_ms"] = latency
+
+    if latency > budget:
+        response["status"] = "degraded"
+        return jsonify(response), 503
+    response["status"] = "ready"
+    return jsonify(response), 200
+
+
+@admin.route("/metrics", methods=["GET"])
+@auth.requires_admin
+def get_metrics():
+    """
+    Expose request, event, MongoDB and cache metrics for Prometheus.
+
+    The labels name users, sensors and collections, so scrapes need an
+    admin token.
+    """
+    return metrics.REGISTRY.render(), 200, {
+        "Content-Type": metrics.CONTENT_TYPE
+    }
+
+
+@admin.route("/profile", methods=["POST"])
+@auth.requires_admin
+def start_profile():
+    """
+    Sample the stacks of in-flight requests for a number of seconds.
+
+    sample request:
+    {
+        "seconds": 30,
+        "route": "/events/command/*",
+        "interval_ms": 10,
+        "all_workers": true
+    }
+
+    route is a glob matched against the request path and the url rule.
+    interval_ms below 1 is raised to 1.
+    Without all_workers only the worker serving this request is sampled.
+    Collapsed stacks are written to PROFILE_DIR when the run ends.
+    """
+    payload = request.get_json(force=True, silent=True) or {}
+    max_seconds = current_app.config.get("PROFILE_MAX_SECONDS", 300)
+    try:
+        seconds = float(payload.get("seconds", 30))
+        interval = float(payload.get("interval_ms", 10)) / 1000.0
+    except (TypeError, ValueError):
+        return jsonify(error="seconds and interval_ms must be numbers."), 400
+    if not 0 < seconds <= max_seconds or not interval >= 0:
+        err = "seconds must be within (0, {0}] and interval_ms not negative."
+        return jsonify(error=err.format(max_seconds)), 400
+    # Shorter intervals would have the sampler spin on the GIL.
+    interval = max(interval, MIN_INTERVAL)
+
+    if payload.get("all_workers"):
+        if PROFILER.directory is None:
+            err = "PROFILE_DIR must be set to profile all workers."
+            return jsonify(error=err), 400
+        started = PROFILER.trigger_all(seconds, payload.get("route"),
+                                       interval)
     else:
-        return "All Good!", 200
+        started = PROFILER.start(seconds, payload.get("route"), interval)
+    if not started:
+        return jsonify(error="A profile is already running."), 409
+    return jsonify(PROFILER.status()), 202
+
+
+@admin.route("/profile", methods=["GET"])
+@auth.requires_admin
+def get_profile():
+    """Describe this worker's current or most recent profile run."""
+    return jsonify(PROFILER.status()), 200
+
+
+@admin.route("/slow", methods=["GET"])
+@auth.requires_admin
+def get_slow_commands():
+    """
+    Summarise the slow MongoDB commands logged by every worker.
+
+    Commands are grouped by route and query shape, those taking the most
+    time in total first. ?minutes= only counts recent records and
+    ?limit= caps the number of groups.
+    """
+    try:
+        minutes = request.args.get("minutes", type=float)
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        return jsonify(error="limit must be an integer"), 400
+    since = time.time() - minutes * 60 if minutes else None
+    return jsonify(
+        enabled=SLOWLOG.enabled,
+        threshold_ms=SLOWLOG.threshold * 1000.0,
+        commands=SLOWLOG.summary(since, limit)
+    ), 200
+
+
+@admin.route("/sensors", methods=["GET"])
+@auth.requires_admin
+def get_sensors():
+    """
+    Report when each sensor was last heard from and how busy it is.
+
+    A sensor is alive when it sent an event in the last
+    HEARTBEAT_ALIVE_SECONDS; its rate is averaged over the last
+    HEARTBEAT_RATE_MINUTES whole minutes. Both lag by up to
+    HEARTBEAT_FLUSH_INTERVAL.
+    """
+    alive = current_app.config.get("HEARTBEAT_ALIVE_SECONDS", 300)
+    window = current_app.config.get("HEARTBEAT_RATE_MINUTES", 15)
+    sensors = heartbeat.status(alive, window)
+    return jsonify(
+        alive_seconds=alive,
+        rate_minutes=window,
+        alive=sum(1 for sensor in sensors if sensor["alive"]),
+        sensors=sensors
+    ), 200
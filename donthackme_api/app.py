@@ -19,16 +19,33 @@ from logging.handlers import TimedRotatingFileHandler
 
 from flask import Flask
 
-from flask_mongoengine import MongoEngine
-
+from donthackme_api import cache
+from donthackme_api import concurrency
+from donthackme_api import heartbeat
+from donthackme_api import metrics
+from donthackme_api import mongo
+from donthackme_api import partitions
+from donthackme_api import pending
+from donthackme_api import profiler
+from donthackme_api import profiles
+from donthackme_api import ratelimit
+from donthackme_api import retention
+from donthackme_api import slowlog
+from donthackme_api import tracing
+from donthackme_api import write_concern
+from donthackme_api.events import views as event_views
 from donthackme_api.events.views import events
 from donthackme_api.admin.views import admin
+from donthackme_api.search.views import search
+from donthackme_api.sessions.views import sessions
 from donthackme_api.users.views import users
 
 
 DEFAULT_BLUEPRINTS = [
     events,
     admin,
+    search,
+    sessions,
     users
 ]
 
@@ -63,6 +80,25 @@ def configure_logging(app):
     app.logger.addHandler(handler)
 
 
+def configure_caches(app):
+    """Size the per-worker lookup caches from configuration."""
+    event_views.session_cache.configure(
+        maxsize=app.config.get("SESSION_CACHE_SIZE"),
+        ttl=app.config.get("SESSION_CACHE_TTL")
+    )
+    event_views.failed_login_cache.configure(
+        maxsize=app.config.get("FAILED_LOGIN_CACHE_SIZE"),
+        ttl=app.config.get("FAILED_LOGIN_CACHE_TTL")
+    )
+    cache.RESPONSE_CACHE.configure(
+        enabled=app.config.get("RESPONSE_CACHE_ENABLED", True),
+        maxsize=app.config.get("RESPONSE_CACHE_SIZE", 256),
+        ttl=app.config.get("RESPONSE_CACHE_TTL", 300),
+        directory=app.config.get("RESPONSE_CACHE_DIR"),
+        interval=app.config.get("RESPONSE_CACHE_CHECK_INTERVAL", 1.0)
+    )
+
+
 def create_app(app_name=None, blueprints=None):
     """Create the flask app."""
     if app_name is None:
@@ -74,10 +110,24 @@ def create_app(app_name=None, blueprints=None):
 
     configure_app(app)
     configure_logging(app)
-
-    db = MongoEngine()
-    db.app = app
-    db.init_app(app)
+    configure_caches(app)
+
+    metrics.register_listeners()
+    metrics.init_app(app)
+    profiler.init_app(app)
+    tracing.init_app(app)
+    slowlog.init_app(app)
+    pending.init_app(app)
+    profiles.init_app(app)
+    heartbeat.init_app(app)
+    ratelimit.init_app(app)
+    write_concern.init_app(app)
+
+    concurrency.init_app(app)
+    partitions.init_app(app)
+    retention.init_app(app)
+    mongo.init_app(app)
+    mongo.register_postfork(app)
 
     configure_blueprints(app, blueprints)
 
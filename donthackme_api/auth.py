@@ -17,10 +17,15 @@
 from flask import request, jsonify, g
 from functools import wraps
 
+import math
+
 from models import User
 
 from mongoengine import errors
 
+from donthackme_api import tracing
+from donthackme_api.ratelimit import LIMITER
+
 
 def check_auth(headers):
     """Return True when token is valid."""
@@ -44,20 +49,48 @@ def check_auth(headers):
     return False
 
 
+def authenticate():
+    """Return an error response for the request, or None when allowed."""
+    headers = request.headers
+    required_headers = ["X-Auth-Token", "X-JWT"]
+
+    if not any(x in headers for x in required_headers):
+        err = "Required Headers: {0}"
+        return jsonify(error=err.format(",".join(required_headers))), 401
+
+    if not check_auth(headers):
+        err = "Could not authenticate using those credentials"
+        return jsonify(error=err), 403
+
+    wait = LIMITER.check(g.user)
+    if wait:
+        err = "Rate limit exceeded; retry in {0:.1f}s.".format(wait)
+        response = jsonify(error=err)
+        response.status_code = 429
+        response.headers["Retry-After"] = str(int(math.ceil(wait)))
+        return response
+    return None
+
+
 def requires_token(f):
     """Decorate Flask Route to require Token."""
     @wraps(f)
     def decorated(*args, **kwargs):
-        headers = request.headers
-        required_headers = ["X-Auth-Token", "X-JWT"]
+        with tracing.span("auth"):
+            refused = authenticate()
+        if refused is not None:
+            return refused
+        return f(*args, **kwargs)
+    return decorated
 
-        if not any(x in headers for x in required_headers):
-            err = "Required Headers: {0}"
-            return jsonify(error=err.format(",".join(required_headers))), 401
 
-        if not check_auth(headers):
-            err = "Could not authenticate using those credentials"
+def requires_admin(f):
+    """Decorate Flask Route to require a Token belonging to an admin."""
+    @wraps(f)
+    @requires_token
+    def decorated(*args, **kwargs):
+        if not g.user.is_admin():
+            err = "This action requires the admin role."
             return jsonify(error=err), 403
-
         return f(*args, **kwargs)
     return decorated
@@ -0,0 +1,338 @@
+"""Content-addressed store of large binaries with reference counts."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+
+from datetime import datetime, timedelta
+
+from gridfs import GridFSBucket
+from gridfs.errors import FileExists, NoFile
+
+from mongoengine.connection import get_db
+
+from pymongo.errors import DuplicateKeyError
+
+from donthackme_api import metrics
+from donthackme_api import partitions
+from donthackme_api.concurrency import EXECUTOR
+from donthackme_api.models import Blob, Download, Session
+
+# GridFS bucket holding the content, as blobs.files and blobs.chunks.
+BUCKET = "blobs"
+
+# Documents that reference blobs, and the field holding the sha256.
+REFERENCES = [
+    (Session, "ttylog.sha256"),
+    (Download, "shasum"),
+]
+
+# Bytes read from an upload at a time: one GridFS chunk.
+CHUNK_SIZE = 255 * 1024
+
+# Seconds an unfinished upload holds its blob before another may start.
+UPLOAD_LEASE = 600
+
+metrics.REGISTRY.describe("donthackme_blob_puts_total",
+                          "Blobs received, by whether they were new.")
+metrics.REGISTRY.describe("donthackme_blob_deduplicated_bytes_total",
+                          "Bytes not written because they were stored.")
+
+
+class DigestMismatch(ValueError):
+    """Uploaded content does not hash to the sha256 it was sent as."""
+
+
+class TooLarge(ValueError):
+    """Uploaded content is longer than allowed."""
+
+
+class UploadInProgress(ValueError):
+    """Another upload of the same content has not finished yet."""
+
+
+def digest(data):
+    """Return the key of some content: its sha256, in hex."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def bucket():
+    """Return the GridFS bucket of the current database."""
+    return GridFSBucket(get_db(), bucket_name=BUCKET)
+
+
+def put(data):
+    """
+    Store content once and take a reference to it. Returns its sha256.
+
+    The reference is counted before anything else is written, so when
+    the content is already stored that one small update is the whole
+    write and the body never reaches GridFS again.
+    """
+    sha256 = digest(data)
+    now = datetime.utcnow()
+    previous = EXECUTOR.run(
+        Blob._get_collection().find_one_and_update,
+        {"_id": sha256},
+        {
+            "$inc": {"refs": 1},
+            "$set": {"last_referenced": now},
+            "$setOnInsert": {"size": len(data), "stored": False,
+                             "created": now}
+        },
+        upsert=True
+    )
+    if previous is not None and previous.get("stored"):
+        metrics.inc("donthackme_blob_puts_total", {"result": "duplicate"})
+        metrics.inc("donthackme_blob_deduplicated_bytes_total",
+                    amount=len(data))
+        return sha256
+    metrics.inc("donthackme_blob_puts_total", {"result": "new"})
+    write(sha256, data)
+    return sha256
+
+
+def write(sha256, data):
+    """
+    Write the content of a blob to GridFS and mark it stored.
+
+    When another worker is writing the same content, its files document
+    only appears once all chunks are in, and it marks the blob itself.
+    """
+    try:
+        with EXECUTOR.slot():
+            bucket().upload_from_stream_with_id(sha256, sha256, data)
+    except (FileExists, DuplicateKeyError):
+        files = get_db()[BUCKET + ".files"]
+        if EXECUTOR.run(files.find_one, {"_id": sha256}, {"_id": True}) \
+                is None:
+            return
+    EXECUTOR.run(Blob._get_collection().update_one, {"_id": sha256},
+                 {"$set": {"stored": True}})
+
+
+def reference(sha256):
+    """
+    Take a reference to stored content by its sha256 alone.
+
+    Returns False, taking nothing, when the content is not stored; the
+    caller then has to send the content itself.
+    """
+    result = EXECUTOR.run(
+        Blob._get_collection().update_one,
+        {"_id": sha256, "stored": True},
+        {"$inc": {"refs": 1}, "$set": {"last_referenced": datetime.utcnow()}}
+    )
+    return result.matched_count == 1
+
+
+def claim(sha256):
+    """
+    Take a reference to content that may not have been uploaded yet.
+
+    A download event names its file before the sensor uploads it, if it
+    ever does; the reference keeps the content once it arrives.
+    """
+    now = datetime.utcnow()
+    EXECUTOR.run(
+        Blob._get_collection().update_one,
+        {"_id": sha256},
+        {
+            "$inc": {"refs": 1},
+            "$set": {"last_referenced": now},
+            "$setOnInsert": {"stored": False, "created": now}
+        },
+        upsert=True
+    )
+
+
+def upload(sha256, stream, max_bytes=None):
+    """
+    Store content read from a stream under the sha256 it claims to have.
+
+    The content is read and written one GridFS chunk at a time, hashed
+    as it goes, and discarded unless the hash matches. Returns False
+    when the content was already stored, without reading the stream.
+
+    Raises UploadInProgress while another upload of the same content
+    holds its lease, TooLarge past max_bytes and DigestMismatch.
+    """
+    if exists(sha256):
+        return False
+    now = datetime.utcnow()
+    try:
+        EXECUTOR.run(
+            Blob._get_collection().find_one_and_update,
+            {
+                "_id": sha256,
+                "stored": {"$ne": True},
+                "$or": [
+                    {"uploading": None},
+                    {"uploading": {
+                        "$lt": now - timedelta(seconds=UPLOAD_LEASE)}}
+                ]
+            },
+            {
+                "$set": {"uploading": now, "last_referenced": now},
+                "$setOnInsert": {"refs": 0, "stored": False, "created": now}
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        if exists(sha256):
+            return False
+        raise UploadInProgress(sha256)
+
+    blobs = Blob._get_collection()
+    chunks = get_db()[BUCKET + ".chunks"]
+    try:
+        # Chunks of an earlier, abandoned upload would clash with ours.
+        EXECUTOR.run(chunks.delete_many, {"files_id": sha256})
+        size = _stream_in(sha256, stream, max_bytes)
+    except Exception:
+        EXECUTOR.run(blobs.update_one, {"_id": sha256},
+                     {"$unset": {"uploading": True}})
+        raise
+    EXECUTOR.run(blobs.update_one, {"_id": sha256}, {
+        "$set": {"stored": True, "size": size},
+        "$unset": {"uploading": True}
+    })
+    metrics.inc("donthackme_blob_puts_total", {"result": "new"})
+    return True
+
+
+def _stream_in(sha256, stream, max_bytes):
+    hasher = hashlib.sha256()
+    size = 0
+    grid_in = bucket().open_upload_stream_with_id(
+        sha256, sha256, chunk_size_bytes=CHUNK_SIZE)
+    try:
+        while True:
+            data = stream.read(CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+            if max_bytes is not None and size > max_bytes:
+                raise TooLarge("Content is larger than {0} bytes.".format(
+                    max_bytes))
+            hasher.update(data)
+            # Only the writes take a MongoDB slot, not waiting on the
+            # sensor for the next chunk.
+            with EXECUTOR.slot():
+                grid_in.write(data)
+        if hasher.hexdigest() != sha256:
+            raise DigestMismatch("Content hashes to {0}, not {1}.".format(
+                hasher.hexdigest(), sha256))
+    except Exception:
+        grid_in.abort()
+        raise
+    with EXECUTOR.slot():
+        grid_in.close()
+    return size
+
+
+def exists(sha256):
+    """Return True when the content with this sha256 is stored."""
+    return EXECUTOR.run(Blob._get_collection().find_one,
+                        {"_id": sha256, "stored": True},
+                        {"_id": True}) is not None
+
+
+def release(sha256):
+    """Drop a reference; unreferenced content is removed by collect()."""
+    EXECUTOR.run(Blob._get_collection().update_one, {"_id": sha256},
+                 {"$inc": {"refs": -1}})
+
+
+def open_blob(sha256):
+    """Return a seekable file-like object of stored content, or None."""
+    try:
+        return bucket().open_download_stream(sha256)
+    except NoFile:
+        return None
+
+
+def read(sha256):
+    """Return stored content as bytes, or None."""
+    stream = open_blob(sha256)
+    return stream.read() if stream is not None else None
+
+
+def recount(report=None):
+    """
+    Set every blob's reference count from the documents referencing it.
+
+    Counts drift when referencing documents go without releasing their
+    blobs, as when a partition is dropped or a TTL index expires them.
+    Returns the number of blobs whose count changed.
+    """
+    report = report or (lambda line: None)
+    counts = {}
+    for document, field in REFERENCES:
+        pipeline = [
+            {"$match": {field: {"$exists": True, "$ne": None}}},
+            {"$group": {"_id": "$" + field, "refs": {"$sum": 1}}}
+        ]
+        for suffix in partitions.ROUTER.partitions(document):
+            with partitions.use(suffix):
+                for group in document._get_collection().aggregate(
+                        pipeline, allowDiskUse=True):
+                    counts[group["_id"]] = \
+                        counts.get(group["_id"], 0) + group["refs"]
+                report("{0}: {1} blobs referenced".format(
+                    document._get_collection_name(), len(counts)))
+    changed = 0
+    blobs = Blob._get_collection()
+    for blob in blobs.find({}, {"refs": True}):
+        refs = counts.get(blob["_id"], 0)
+        if blob.get("refs") != refs:
+            blobs.update_one({"_id": blob["_id"]}, {"$set": {"refs": refs}})
+            changed += 1
+    return changed
+
+
+def collect(grace=timedelta(hours=1), report=None):
+    """
+    Remove blobs that nothing references any more.
+
+    Blobs referenced within the grace period are kept, as are their
+    reference counts, so a put racing the removal does not lose content.
+    Uploads left unfinished for as long are cleared so that the next
+    put writes them again. Returns (blobs removed, bytes freed).
+    """
+    report = report or (lambda line: None)
+    cutoff = datetime.utcnow() - grace
+    blobs = Blob._get_collection()
+    store = bucket()
+    removed = freed = 0
+    while True:
+        blob = blobs.find_one_and_delete({
+            "refs": {"$lte": 0},
+            "last_referenced": {"$lt": cutoff}
+        })
+        if blob is None:
+            break
+        try:
+            store.delete(blob["_id"])
+        except NoFile:
+            pass
+        removed += 1
+        freed += blob.get("size") or 0
+    chunks = get_db()[BUCKET + ".chunks"]
+    for blob in blobs.find({"stored": False, "created": {"$lt": cutoff}},
+                           {"_id": True}):
+        chunks.delete_many({"files_id": blob["_id"]})
+    report("{0} blobs removed, {1} bytes freed.".format(removed, freed))
+    return removed, freed
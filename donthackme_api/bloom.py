@@ -0,0 +1,81 @@
+"""Bloom filter for cheap, in-memory "seen before" checks."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import math
+import threading
+
+
+class BloomFilter(object):
+    """
+    Set membership with no false negatives and few false positives.
+
+    Sized for `capacity` keys at `error_rate` false positives. Once that
+    many keys have been added the filter starts over, so the error rate
+    never degrades; a key forgotten that way only costs the write the
+    filter would have saved.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        """init."""
+        self.configure(capacity, error_rate)
+
+    def configure(self, capacity, error_rate):
+        """Resize the filter, forgetting every key."""
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(
+            float(self.size) / capacity * math.log(2))))
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Forget every key."""
+        with self._lock:
+            self._bits = bytearray((self.size + 7) // 8)
+            self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from the two halves of one digest.
+        digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+        first, second = int(digest[:16], 16), int(digest[16:], 16) | 1
+        return [(first + i * second) % self.size
+                for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        """Return True if key was probably added, False if it was not."""
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def add(self, key):
+        """Add key; return True if it was (probably) already present."""
+        positions = self._positions(key)
+        with self._lock:
+            bits = self._bits
+            present = all(bits[position >> 3] & (1 << (position & 7))
+                          for position in positions)
+            if present:
+                return True
+            if self.count >= self.capacity:
+                self._bits = bits = bytearray(len(bits))
+                self.count = 0
+            for position in positions:
+                bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+        return False
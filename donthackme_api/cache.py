@@ -0,0 +1,311 @@
+"""Small in-process caches for hot lookups, and the response cache."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+
+from donthackme_api import metrics
+from donthackme_api import partitions
+from donthackme_api.concurrency import EXECUTOR
+
+# Log entries re-read on every check, to catch entries inserted out of
+# ts order by concurrent writers.
+LOG_WINDOW = 100
+
+# Past this many new entries in one check everything is invalidated.
+LOG_MAX_SCAN = 10000
+
+metrics.REGISTRY.describe("donthackme_response_not_modified_total",
+                          "Cached responses answered with 304.")
+
+
+class TTLCache(object):
+    """
+    Bounded mapping whose entries expire after ``ttl`` seconds.
+
+    When ``name`` is given, every lookup is counted as a hit or a miss
+    in the metrics registry under that cache name.
+    """
+
+    def __init__(self, name=None, maxsize=1024, ttl=60):
+        """init."""
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize=None, ttl=None):
+        """Resize the cache and change the expiry of future entries."""
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if ttl is not None:
+            self.ttl = ttl
+        self.clear()
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] < now:
+                del self._data[key]
+                entry = None
+        if self.name is not None:
+            metrics.cache_lookup(self.name, entry is not None)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        """Store value for key, evicting the oldest entries when full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+            self._data[key] = (time.time() + self.ttl, value)
+
+    def pop(self, key):
+        """Drop key from the cache."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        """Return the number of (possibly expired) entries."""
+        return len(self._data)
+
+
+class ResponseCache(object):
+    """
+    Rendered responses of read views, invalidated by the TransactionLog.
+
+    Every write the events API makes is recorded in the TransactionLog
+    with the next value of its ts sequence. Each worker reads the entries
+    added since its last look, at most every `interval` seconds, and
+    keeps a generation per collection that moves whenever one of its
+    documents is written. A cached response stays valid while the
+    generations of the collections its view reads are unchanged, so
+    repeated polls, and If-None-Match revalidations in particular, cost
+    no MongoDB work at all.
+
+    Responses are kept per worker and, when `directory` is set, also in
+    files shared by all workers of the host. Entries also expire after
+    `ttl` seconds, which bounds how long a response can be served stale
+    should a log entry be missed.
+    """
+
+    def __init__(self):
+        """init."""
+        self.enabled = False
+        self.memory = TTLCache()
+        self.directory = None
+        self.interval = 1.0
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._floor = None
+        self._generations = {}
+        self._newest = None
+        self._recent = set()
+
+    def configure(self, enabled=True, maxsize=256, ttl=300, directory=None,
+                  interval=1.0):
+        """Size the cache and choose its tiers."""
+        self.enabled = enabled
+        self.memory.configure(maxsize=maxsize, ttl=ttl)
+        self.directory = directory
+        self.interval = interval
+        if enabled and directory:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _scan(self):
+        """Advance the generations past the log entries added since."""
+        from donthackme_api.models import TransactionLog
+
+        newest = None
+        changed = []
+        seen = set()
+        with EXECUTOR.slot():
+            cursor = TransactionLog._get_collection().find(
+                {}, {"collection": True, "ts": True, "_id": False}
+            ).sort("$natural", -1).batch_size(LOG_WINDOW)
+            for entry in cursor:
+                ts = entry.get("ts")
+                if ts is None:
+                    continue
+                if newest is None:
+                    newest = ts
+                if ts <= (self._newest or newest) - LOG_WINDOW:
+                    break
+                seen.add(ts)
+                if self._newest is not None and ts not in self._recent:
+                    changed.append((ts, entry.get("collection")))
+                if len(changed) > LOG_MAX_SCAN:
+                    changed = None
+                    break
+            cursor.close()
+        if newest is None:
+            newest = 0
+        if self._floor is None:
+            self._floor = newest
+        elif changed is None:
+            # Too far behind to tell what changed: move everything on.
+            self._floor = max(self._floor + 1, newest)
+            for name in self._generations:
+                self._generations[name] = max(self._generations[name] + 1,
+                                              newest)
+        else:
+            for ts, collection in changed:
+                name = partitions.strip_suffix(collection or "")
+                current = self._generations.get(name, self._floor)
+                self._generations[name] = max(current + 1, ts)
+        self._newest = max(newest, self._newest or 0)
+        self._recent = seen
+
+    def generation(self, collections):
+        """Return the generation of a set of collections (or of all)."""
+        with self._lock:
+            now = time.time()
+            if now - self._checked >= self.interval:
+                self._scan()
+                self._checked = now
+            if not collections:
+                return [max([self._floor] + list(self._generations.values()))]
+            return [self._generations.get(name, self._floor)
+                    for name in collections]
+
+    @staticmethod
+    def key():
+        """Return the cache key of the current request."""
+        parts = [
+            request.url_rule.rule,
+            sorted((request.view_args or {}).items()),
+            sorted((name, value.strip()) for name, value
+                   in request.args.items(multi=True) if value.strip())
+        ]
+        return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _read_file(self, key):
+        try:
+            with open(self._path(key), "rb") as cached:
+                if os.fstat(cached.fileno()).st_mtime + self.memory.ttl \
+                        < time.time():
+                    return None
+                entry = json.loads(cached.readline().decode("utf-8"))
+                entry["body"] = cached.read()
+                return entry
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_file(self, key, entry):
+        header = dict((name, value) for name, value in entry.items()
+                      if name != "body")
+        try:
+            fd, temporary = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as cached:
+                cached.write(json.dumps(header).encode("utf-8") + b"\n")
+                cached.write(entry["body"])
+            os.rename(temporary, self._path(key))
+        except (IOError, OSError) as e:
+            current_app.logger.warning(
+                "Response not cached in {0}: {1}".format(self.directory, e))
+
+    def get(self, key, generation):
+        """Return the cached entry for key at a generation, or None."""
+        entry = self.memory.get(key)
+        if entry is None and self.directory:
+            entry = self._read_file(key)
+            if entry is not None and entry["generation"] == generation:
+                self.memory.set(key, entry)
+        if entry is not None and entry["generation"] != generation:
+            entry = None
+        metrics.cache_lookup("response", entry is not None)
+        return entry
+
+    def set(self, key, generation, response):
+        """Cache a rendered response and return its entry."""
+        body = response.get_data()
+        entry = {
+            "generation": generation,
+            "etag": hashlib.sha1(body).hexdigest(),
+            "mimetype": response.mimetype,
+            "body": body
+        }
+        self.memory.set(key, entry)
+        if self.directory:
+            self._write_file(key, entry)
+        return entry
+
+
+RESPONSE_CACHE = ResponseCache()
+
+
+def cached_view(*collections):
+    """
+    Serve a GET view from the response cache, with a strong ETag.
+
+    collections are the (unpartitioned) collections the view reads; a
+    write to any of them invalidates its responses. With none given,
+    any write does. Only 200 responses are cached.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = RESPONSE_CACHE
+            if not cache.enabled or request.method != "GET":
+                return view(*args, **kwargs)
+            key = cache.key()
+            generation = cache.generation(collections)
+            entry = cache.get(key, generation)
+            if entry is None:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = cache.set(key, generation, response)
+            if request.if_none_match.contains(entry["etag"]):
+                metrics.inc("donthackme_response_not_modified_total")
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.response_class(
+                    entry["body"], mimetype=entry["mimetype"])
+            response.set_etag(entry["etag"])
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,183 @@
+"""Bounded MongoDB concurrency and write coalescing within a worker."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+from donthackme_api import metrics
+
+metrics.REGISTRY.describe("donthackme_mongo_slot_wait_seconds",
+                          "Time requests waited for a MongoDB slot.")
+metrics.REGISTRY.describe("donthackme_session_pushes_total",
+                          "Children pushed onto sessions.")
+metrics.REGISTRY.describe("donthackme_session_push_batches_total",
+                          "Session updates that carried those pushes.")
+
+
+def cooperative():
+    """Return True when running on gevent with the stdlib patched."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+class Executor(object):
+    """
+    Bound the MongoDB operations in flight in one worker.
+
+    On gevent a worker serves hundreds of requests at once, far more
+    than it has pooled connections. Rather than have them all wait in
+    pymongo's pool and fail after waitQueueTimeoutMS, operations queue
+    here for one of a fixed number of slots. Without a limit (the
+    default for one request per worker) slot() costs nothing.
+    """
+
+    def __init__(self):
+        """init."""
+        self.limit = None
+        self._slots = None
+
+    def configure(self, limit):
+        """Allow at most limit operations at once; None for no bound."""
+        self.limit = limit
+        self._slots = threading.BoundedSemaphore(limit) if limit else None
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot for the MongoDB operations within the block."""
+        slots = self._slots
+        if slots is None:
+            yield
+            return
+        start = time.time()
+        slots.acquire()
+        metrics.observe("donthackme_mongo_slot_wait_seconds",
+                        time.time() - start)
+        try:
+            yield
+        finally:
+            slots.release()
+
+    def run(self, f, *args, **kwargs):
+        """Call f in a slot and return its result."""
+        with self.slot():
+            return f(*args, **kwargs)
+
+
+EXECUTOR = Executor()
+
+
+class _Batch(object):
+    """Values waiting to be pushed in one update."""
+
+    def __init__(self):
+        """init."""
+        self.pushes = {}
+        self.size = 0
+        self.done = False
+        self.error = None
+
+
+class _Queue(object):
+    """Coalescing state of one document and group."""
+
+    def __init__(self, lock):
+        """init."""
+        self.condition = threading.Condition(lock)
+        self.waiting = None
+        self.flushing = False
+        self.users = 0
+
+
+class Coalescer(object):
+    """
+    Merge concurrent $push updates to the same document.
+
+    Works as a group commit: while one update of a session is in flight,
+    further pushes to it collect in a batch, and once the update returns
+    a single caller writes the whole batch with $push/$each. Every
+    caller returns only when its own values are written. With one
+    request at a time there is never a batch to join, and each push is
+    written straight away.
+    """
+
+    def __init__(self):
+        """init."""
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def push(self, document, doc_id, field, value, write, group=None):
+        """
+        Append value to the list field of a document.
+
+        write(pushes) performs the update, given {db_field: [values]}.
+        Only pushes of the same group, such as a write concern tier, are
+        merged.
+        """
+        db_field = document._fields[field].db_field
+        key = (document, doc_id, group)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = _Queue(self._lock)
+            queue.users += 1
+            batch = queue.waiting
+            if batch is None:
+                batch = queue.waiting = _Batch()
+            batch.pushes.setdefault(db_field, []).append(value)
+            batch.size += 1
+            while not batch.done:
+                if not queue.flushing and queue.waiting is batch:
+                    queue.waiting = None
+                    queue.flushing = True
+                    break
+                queue.condition.wait()
+            lead = not batch.done
+
+        if lead:
+            try:
+                write(batch.pushes)
+            except Exception as e:
+                batch.error = e
+            metrics.inc("donthackme_session_pushes_total",
+                        amount=batch.size)
+            metrics.inc("donthackme_session_push_batches_total")
+
+        with self._lock:
+            if lead:
+                batch.done = True
+                queue.flushing = False
+                queue.condition.notify_all()
+            queue.users -= 1
+            if not queue.users:
+                del self._queues[key]
+        if batch.error is not None:
+            raise batch.error
+
+
+COALESCER = Coalescer()
+
+
+def init_app(app):
+    """Bound MongoDB concurrency when serving requests on gevent."""
+    limit = app.config.get("ASYNC_MONGO_CONCURRENCY")
+    if limit is None and cooperative():
+        limit = app.config.get("MONGODB_MAX_POOL_SIZE")
+    EXECUTOR.configure(limit)
@@ -10,6 +10,27 @@ MONGODB_SETTINGS = {
     'db': 'test',
 }
 
+# Connection pool, per worker process. Keys set in MONGODB_SETTINGS win.
+# Workers connect after uWSGI forks them, then open MONGODB_MIN_POOL_SIZE
+# connections and check (never build) indexes before their first request.
+MONGODB_MAX_POOL_SIZE = 10
+MONGODB_MIN_POOL_SIZE = 2
+MONGODB_MAX_IDLE_TIME_MS = 300000
+MONGODB_CONNECT_TIMEOUT_MS = 2000
+MONGODB_SOCKET_TIMEOUT_MS = 10000
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = 2000
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = 1000
+MONGODB_WARM_UP = True
+MONGODB_VERIFY_INDEXES = True
+
+# Concurrency
+# Under uwsgi-async.ini each worker serves up to 1000 requests at once on
+# gevent. At most ASYNC_MONGO_CONCURRENCY MongoDB operations per worker
+# are then in flight while the rest queue for a slot; None uses
+# MONGODB_MAX_POOL_SIZE on gevent and no bound otherwise. Raise
+# MONGODB_MAX_POOL_SIZE and MONGODB_WAIT_QUEUE_TIMEOUT_MS along with it.
+ASYNC_MONGO_CONCURRENCY = None
+
 # Application Settings
 PASSWORD_LENGTH = 24
 
@@ -17,3 +38,193 @@ PASSWORD_LENGTH = 24
 JSONIFY_PRETTYPRINT_REGULAR = True
 
 LOG_FILE = './donthackme_api.log'
+
+# Metrics
+# Every worker writes its counters here so that /admin/metrics reports
+# totals for all uWSGI processes. Clear it when the master restarts.
+METRICS_DIR = '/tmp/donthackme_metrics'
+METRICS_FLUSH_INTERVAL = 5
+
+# Readiness
+# /admin/ready returns 503 when a MongoDB ping takes longer than this.
+READINESS_LATENCY_BUDGET_MS = 250
+
+# Profiling
+# Collapsed-stack output from POST /admin/profile is written here.
+PROFILE_DIR = '/tmp/donthackme_profiles'
+PROFILE_MAX_SECONDS = 300
+
+# Tracing
+# With TRACE_ENABLED every request records timed spans: auth, session
+# lookup, each write and every MongoDB command. TRACE_SAMPLE_RATE of
+# requests (and those whose traceparent header says so) are written out,
+# as are all requests slower than TRACE_SLOW_MS or failing with a 5xx.
+# Each worker appends OTLP/JSON lines to its own file in TRACE_DIR,
+# rotated at TRACE_MAX_BYTES.
+TRACE_ENABLED = False
+TRACE_SAMPLE_RATE = 0.01
+TRACE_SLOW_MS = 500
+TRACE_KEEP_ERRORS = True
+TRACE_MAX_SPANS = 1000
+TRACE_DIR = '/tmp/donthackme_traces'
+TRACE_MAX_BYTES = 50 * 1024 * 1024
+TRACE_BACKUPS = 5
+
+# Slow operations
+# MongoDB commands taking SLOWLOG_THRESHOLD_MS or longer are logged with
+# the route that issued them and their query shape, values replaced by
+# "?". SLOWLOG_EXPLAIN_RATE of them are explained, each shape at most
+# once per SLOWLOG_EXPLAIN_INTERVAL seconds. Each worker appends JSON
+# lines to its own file in SLOWLOG_DIR; GET /admin/slow summarises them.
+SLOWLOG_ENABLED = True
+SLOWLOG_THRESHOLD_MS = 100
+SLOWLOG_EXPLAIN_RATE = 0.1
+SLOWLOG_EXPLAIN_INTERVAL = 300
+SLOWLOG_DIR = '/tmp/donthackme_slowlog'
+SLOWLOG_MAX_BYTES = 10 * 1024 * 1024
+SLOWLOG_BACKUPS = 3
+
+# Sensor heartbeats
+# Each worker counts the events of every sensor in memory and writes its
+# last-seen times and counts, plus per-minute activity kept for seven
+# days, in one bulk write every HEARTBEAT_FLUSH_INTERVAL seconds.
+# GET /admin/sensors reports a sensor alive when it was seen in the last
+# HEARTBEAT_ALIVE_SECONDS, with its events per minute over the last
+# HEARTBEAT_RATE_MINUTES.
+HEARTBEAT_ENABLED = True
+HEARTBEAT_FLUSH_INTERVAL = 10
+HEARTBEAT_ALIVE_SECONDS = 300
+HEARTBEAT_RATE_MINUTES = 15
+
+# Caches (per worker, seconds)
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 600
+FAILED_LOGIN_CACHE_SIZE = 50000
+FAILED_LOGIN_CACHE_TTL = 3600
+
+# Response cache
+# GET responses of the sessions and search views are cached until the
+# TransactionLog shows a write to a collection they read, which each
+# worker checks at most every RESPONSE_CACHE_CHECK_INTERVAL seconds, and
+# at most for RESPONSE_CACHE_TTL. Set RESPONSE_CACHE_DIR to also share
+# responses between the workers of a host.
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_TTL = 300
+RESPONSE_CACHE_CHECK_INTERVAL = 1.0
+RESPONSE_CACHE_DIR = None
+
+# Rate limits
+# Each user (API key) gets a token bucket refilled at RATELIMIT_RATE
+# requests per second and holding up to RATELIMIT_BURST. The buckets live
+# in RATELIMIT_DIR and are shared by all workers of the host. Requests
+# over the limit get 429 with Retry-After. RATELIMIT_KEYS overrides the
+# limits by API key or username, e.g.
+# {"busy_sensor": {"rate": 200, "burst": 1000}}; a rate of 0 disables
+# the limit for that user.
+RATELIMIT_ENABLED = True
+RATELIMIT_DIR = '/tmp/donthackme_ratelimit'
+RATELIMIT_RATE = 50
+RATELIMIT_BURST = 200
+RATELIMIT_KEYS = {}
+
+# Write concern tiers
+# Every ingest write uses the tier of its collection, else of its cowrie
+# event, else the default. Repeats of a recent failed login (same sensor,
+# username and password) count as "cowrie.login.failed.duplicate".
+# Writes whose outcome is checked (sensor and session inserts on
+# session.connect) and TransactionLog entries never go below w=1. Tier
+# names are checked at startup.
+WRITE_CONCERN_TIERS = {
+    "fast": {"w": 0},
+    "standard": {"w": 1},
+    "durable": {"w": "majority", "j": True},
+}
+WRITE_CONCERN_DEFAULT_TIER = "standard"
+WRITE_CONCERN_EVENTS = {
+    "cowrie.session.connect": "durable",
+    "cowrie.session.file_download": "durable",
+    "cowrie.client.size": "fast",
+    "cowrie.login.failed.duplicate": "fast",
+}
+WRITE_CONCERN_COLLECTIONS = {}
+
+# Pending events
+# Events that arrive before their session.connect are held for up to
+# PENDING_TTL seconds and applied, in timestamp order, once the session
+# is created. At most PENDING_MAX_PER_SESSION are held per session; more
+# are refused with 404 as if buffering were off (PENDING_EVENTS = False).
+PENDING_EVENTS = True
+PENDING_TTL = 300
+PENDING_MAX_PER_SESSION = 500
+PENDING_SWEEP_INTERVAL = 30
+
+# Partitioning
+# None keeps sessions, commands and credentials in one collection each.
+# "monthly" or "weekly" stores them in per-period collections such as
+# session_2016_07, so that old periods can be dropped or compacted whole
+# with "python -m donthackme_api.manage partitions". A session and its
+# children share the partition of the session's start_time; sessions are
+# looked up in partitions up to PARTITION_SESSION_MAX_AGE seconds before
+# an event. PARTITION_INCLUDE_LEGACY also searches the unpartitioned
+# collections, for data written before partitioning was enabled. Run
+# "manage partitions ensure" daily to create the coming partitions; the
+# API does not build indexes for a partition it finds missing.
+PARTITION_SCHEME = None
+PARTITION_SESSION_MAX_AGE = 86400
+PARTITION_INCLUDE_LEGACY = True
+
+# Retention
+# Days to keep the documents of each collection, enforced by TTL indexes
+# on start_time (sessions) or timestamp; None keeps them forever. Apply
+# changes with "python -m donthackme_api.manage retention apply". Run
+# "manage retention archive" daily: it copies sessions and their children
+# to ARCHIVE_DIR RETENTION_ARCHIVE_LEAD_DAYS before any of them expire.
+# "ttylog" is the age after which TTY log binaries are removed from
+# sessions that have been archived.
+RETENTION_DAYS = {
+    "session": None,
+    "command": None,
+    "credentials": None,
+    "fingerprint": None,
+    "download": None,
+    "tcp_connection": None,
+    "ttylog": None,
+}
+RETENTION_ARCHIVE_LEAD_DAYS = 7
+ARCHIVE_DIR = './archive'
+
+# Artifacts
+# Files captured by sensors are uploaded to PUT /events/artifacts/<sha256>
+# and kept once per distinct content in the blob store, with TTY logs.
+# Larger uploads are refused with 413; None accepts any size.
+ARTIFACT_MAX_BYTES = 64 * 1024 * 1024
+
+# Search
+# Commands are added to the search index as they arrive; index existing
+# ones with "python -m donthackme_api.manage search backfill". Queries
+# whose rarest trigram occurs in more than SEARCH_MAX_CANDIDATES distinct
+# commands are refused as too broad.
+SEARCH_INDEX_COMMANDS = True
+SEARCH_MAX_CANDIDATES = 100000
+
+# Similar sessions
+# Closed sessions get a MinHash signature of their command sequence and
+# join the campaign cluster of their most similar earlier session when
+# the estimated similarity reaches SIMILARITY_THRESHOLD. At most
+# SIMILARITY_MAX_CANDIDATES sessions sharing an LSH band are compared.
+SIMILARITY_ENABLED = True
+SIMILARITY_THRESHOLD = 0.5
+SIMILARITY_MAX_CANDIDATES = 1000
+
+# Attacker profiles
+# Each source IP has a profile updated as its events arrive. The lists of
+# distinct sensors, credentials, downloads and clients keep at most
+# PROFILE_MAX_VALUES entries. A Bloom filter per worker remembers the
+# profiles already written, so only new IPs are upserted. It is sized
+# for PROFILE_BLOOM_CAPACITY keys at PROFILE_BLOOM_ERROR_RATE false
+# positives (about 1.8MB per worker with the defaults).
+PROFILES_ENABLED = True
+PROFILE_MAX_VALUES = 100
+PROFILE_BLOOM_CAPACITY = 1000000
+PROFILE_BLOOM_ERROR_RATE = 0.001
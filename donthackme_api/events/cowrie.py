@@ -0,0 +1,142 @@
+"""Translate raw Cowrie JSON log events into events API requests."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# cowrie eventid -> (HTTP method, events blueprint route)
+EVENT_ROUTES = {
+    "cowrie.session.connect": ("POST", "/events/session/connect"),
+    "cowrie.client.version": ("PUT", "/events/client/version"),
+    "cowrie.client.size": ("PUT", "/events/client/size"),
+    "cowrie.session.closed": ("PUT", "/events/session/closed"),
+    "cowrie.log.closed": ("PUT", "/events/log/closed"),
+    "cowrie.login.success": ("PUT", "/events/login/success"),
+    "cowrie.login.failed": ("PUT", "/events/login/failed"),
+    "cowrie.command.success": ("PUT", "/events/command/success"),
+    "cowrie.command.failed": ("PUT", "/events/command/failed"),
+    "cowrie.session.file_download": ("PUT", "/events/session/file_download"),
+    "cowrie.client.fingerprint": ("PUT", "/events/client/fingerprint"),
+    "cowrie.direct-tcpip.request": ("PUT", "/events/cdirect-tcpip/request"),
+}
+
+# Newer cowrie releases log commands as a single input event.
+EVENT_ALIASES = {
+    "cowrie.command.input": "cowrie.command.success",
+}
+
+
+def _split_size(event):
+    if "width" in event:
+        return {"width": event["width"], "height": event["height"]}
+    width, height = str(event["size"]).split("x")
+    return {"width": int(width), "height": int(height)}
+
+
+class Translator(object):
+    """
+    Turn cowrie.json events into (eventid, method, route, payload).
+
+    Cowrie only logs the sensor's own address on session.connect, so the
+    translator remembers it per session for the events that follow.
+    Events that already carry API payload fields (``sensor_ip``) are
+    passed through unchanged apart from the ``eventid`` key.
+    """
+
+    def __init__(self):
+        """init."""
+        self._sensor_ips = {}
+
+    def translate(self, event):
+        """Return (eventid, method, route, payload), or None if unmapped."""
+        eventid = EVENT_ALIASES.get(event.get("eventid"),
+                                    event.get("eventid"))
+        if eventid not in EVENT_ROUTES:
+            return None
+        method, route = EVENT_ROUTES[eventid]
+
+        if "sensor_ip" in event:
+            payload = dict(event)
+            payload.pop("eventid", None)
+            return eventid, method, route, payload
+
+        session = event["session"]
+        payload = {
+            "session": session,
+            "sensor_name": event.get("sensor"),
+        }
+        if eventid == "cowrie.session.connect":
+            sensor_ip = event.get("dst_ip")
+            self._sensor_ips[session] = sensor_ip
+            payload.update({
+                "sensor_ip": sensor_ip,
+                "source_ip": event.get("src_ip"),
+                "start_time": event["timestamp"],
+            })
+            return eventid, method, route, payload
+
+        payload["sensor_ip"] = self._sensor_ips.get(session)
+        timestamp = event.get("timestamp")
+
+        if eventid == "cowrie.session.closed":
+            self._sensor_ips.pop(session, None)
+            payload["end_time"] = timestamp
+        elif eventid == "cowrie.client.version":
+            payload["ssh_version"] = event.get("version")
+            for field in ("kexAlgs", "keyAlgs", "encCS", "macCS",
+                          "compCS"):
+                if field in event:
+                    payload["ssh_" + field] = event[field]
+        elif eventid == "cowrie.client.size":
+            payload["ttysize"] = _split_size(event)
+        elif eventid == "cowrie.log.closed":
+            payload["ttylog"] = {
+                "size": event.get("size"),
+                "log_location": event.get("ttylog"),
+                "log_base64": event.get("log_base64", ""),
+            }
+            if event.get("shasum"):
+                payload["ttylog"]["sha256"] = event["shasum"]
+        elif eventid.startswith("cowrie.login."):
+            payload.update({
+                "username": event.get("username"),
+                "password": event.get("password"),
+                "success": eventid == "cowrie.login.success",
+                "timestamp": timestamp,
+            })
+        elif eventid.startswith("cowrie.command."):
+            payload.update({
+                "command": event.get("input"),
+                "success": eventid == "cowrie.command.success",
+                "timestamp": timestamp,
+            })
+        elif eventid == "cowrie.session.file_download":
+            payload.update({
+                "url": event.get("url"),
+                "outfile": event.get("outfile"),
+                "shasum": event.get("shasum"),
+                "timestamp": timestamp,
+            })
+        elif eventid == "cowrie.client.fingerprint":
+            payload.update({
+                "username": event.get("username"),
+                "fingerprint": event.get("fingerprint"),
+                "timestamp": timestamp,
+            })
+        elif eventid == "cowrie.direct-tcpip.request":
+            payload.update({
+                "dest_ip": event.get("dst_ip"),
+                "dest_port": event.get("dst_port"),
+                "timestamp": timestamp,
+            })
+        return eventid, method, route, payload
@@ -14,11 +14,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import request, jsonify, Blueprint, current_app
+from flask import request, jsonify, Blueprint, current_app, g
 
 from mongoengine import errors
 
 from donthackme_api import auth
+from donthackme_api import blobstore
+from donthackme_api import hassh
+from donthackme_api import partitions
+from donthackme_api import pending
+from donthackme_api import profiles
+from donthackme_api import tracing
+from donthackme_api import write_concern
+from donthackme_api.cache import TTLCache
+from donthackme_api.concurrency import EXECUTOR
+from donthackme_api.search import index as search_index
+from donthackme_api.search import minhash
 from donthackme_api.models import (Sensor,
                                    Session,
                                    Credentials,
@@ -28,6 +39,8 @@ from donthackme_api.models import (Sensor,
                                    TransactionLog,
                                    TcpConnection)
 
+from datetime import datetime
+
 import base64
 import re
 
@@ -35,13 +48,132 @@ events = Blueprint('events', __name__, url_prefix="/events")
 
 STANDARD_RESPONSE = '{"acknowledged": true}'
 
+SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+# (session, sensor_name) -> (Session id, partition suffix), so that
+# follow-up events can be applied with a targeted update instead of
+# fetching the whole session.
+session_cache = TTLCache(name="session")
+
+# (sensor_name, username, password) of recent failed logins; repeats are
+# written with the cowrie.login.failed.duplicate write concern tier.
+failed_login_cache = TTLCache(name="failed_login")
+
+
+@events.before_request
+def sweep_pending():
+    """
+    Drop buffered events whose session never came.
+
+    Only event requests sweep, so that other routes, such as the
+    liveness check, never wait on MongoDB for it.
+    """
+    if pending.enabled():
+        try:
+            pending.sweep()
+        except Exception as e:
+            current_app.logger.warning(
+                "Pending event sweep failed: {0}".format(e))
 
-def log_save(doc_class, doc_instance):
-    """Report document change to capped collection."""
-    TransactionLog(
+
+@tracing.traced()
+def log_save(doc_class, doc_id):
+    """
+    Report document change to capped collection.
+
+    Cached views are invalidated by these entries, so an event logs its
+    changes after its last write, derived data included, and never with
+    an unacknowledged (w=0) tier.
+    """
+    write_concern.save(TransactionLog(
         collection=doc_class._get_collection_name(),
-        doc_id=doc_instance.id
-    ).save()
+        doc_id=doc_id
+    ), acknowledged=True)
+
+
+def profile(update, *args):
+    """Update an attacker profile, without failing the event."""
+    if not current_app.config.get("PROFILES_ENABLED", True):
+        return
+    try:
+        update(*args)
+    except Exception as e:
+        # Profiles are derived data; an event must not fail over them.
+        current_app.logger.warning(
+            "Attacker profile not updated: {0}".format(e))
+
+
+@tracing.traced()
+def find_session(payload):
+    """
+    Return the id of the payload's session, or None if it is unknown.
+
+    The partition holding the session stays active for the rest of the
+    request, so that its commands and credentials are written next to
+    it. Events without a time (client.version, client.size) look in every
+    partition, newest first, as their session may be of any age. When the
+    session is unknown, the partition of the event's time is activated
+    instead, for the session the handler may insert.
+    """
+    key = (payload["session"], payload["sensor_name"])
+    cached = session_cache.get(key)
+    if cached is not None:
+        session_id, suffix = cached
+        partitions.activate(suffix)
+        return session_id
+
+    hint = payload.get("timestamp") or payload.get("end_time")
+    if hint is not None:
+        suffixes = partitions.ROUTER.session_partitions(hint)
+    else:
+        suffixes = partitions.ROUTER.partitions(Session)
+    for suffix in suffixes:
+        partitions.activate(suffix)
+        session = EXECUTOR.run(Session.objects(
+            session=payload["session"],
+            sensor_name=payload["sensor_name"]
+        ).only("id").first)
+        if session is not None:
+            session_cache.set(key, (session.id, suffix))
+            return session.id
+
+    partitions.activate(partitions.ROUTER.suffix_for(
+        hint or datetime.utcnow()))
+    return None
+
+
+def with_session(payload, apply):
+    """
+    Apply an event to its session, or buffer it until the session exists.
+
+    Sensors post events concurrently, so an event can overtake the
+    session.connect that creates its session. Such events are held by
+    the pending buffer and applied by drain_pending() once the session is
+    created, instead of being refused.
+    """
+    session_id = find_session(payload)
+    if session_id is not None:
+        with tracing.span(apply.__name__):
+            return apply(payload, session_id)
+
+    if pending.enabled() and \
+            pending.hold(write_concern.current_event(), payload):
+        # The session may have been created, and its buffer drained,
+        # between the lookup above and the hold.
+        session_id = find_session(payload)
+        if session_id is not None:
+            drain_pending(payload["session"], payload["sensor_name"],
+                          session_id)
+        return STANDARD_RESPONSE, 202
+
+    msg = "Session {0} Not Found.".format(payload["session"])
+    return jsonify(error=msg), 404
+
+
+def drain_pending(session, sensor_name, session_id):
+    """Apply the events buffered for a session that now exists."""
+    if pending.enabled():
+        pending.drain(session, sensor_name, session_id)
 
 
 def fix_ip(string):
@@ -62,15 +194,16 @@ def get_or_insert_sensor(payload):
     """Insert Sensor if doesn't exist."""
     payload["sensor_ip"] = fix_ip(payload["sensor_ip"])
     try:
-        sensor = Sensor(
+        sensor = write_concern.save(Sensor(
             name=payload["sensor_name"],
             ip=payload["sensor_ip"],
             timestamp=payload["start_time"]
-        ).save()
-        log_save(Sensor, sensor)
+        ), acknowledged=True)
+        log_save(Sensor, sensor.id)
         return sensor
     except errors.NotUniqueError:
-        sensor = Sensor.objects.get(
+        sensor = EXECUTOR.run(
+            Sensor.objects.get,
             name=payload["sensor_name"],
             ip=payload["sensor_ip"]
         )
@@ -83,17 +216,40 @@ def session_connect():
     """Apply incoming log entry to session object in MongoEngine."""
     payload = request.get_json()
     sensor = get_or_insert_sensor(payload)
+    suffix = partitions.ROUTER.suffix_for(payload["start_time"])
+    partitions.activate(suffix)
     try:
         session = Session(**payload)
         session.sensor = sensor
-        session.save()
+        write_concern.save(session, acknowledged=True)
 
     except errors.NotUniqueError:
         msg = "Session {0} Already Exists".format(payload["session"])
         return jsonify(error=msg), 409
+    session_cache.set((session.session, session.sensor_name),
+                      (session.id, suffix))
+    profile(profiles.session_started, session.id, session.source_ip,
+            session.sensor_name, session.start_time)
+    log_save(Session, session.id)
+    drain_pending(session.session, session.sensor_name, session.id)
     return STANDARD_RESPONSE, 201
 
 
+def upsert_session(payload):
+    """Update the payload's session, inserting it if it is unknown."""
+    session_id = find_session(payload)
+    if session_id is not None:
+        write_concern.update_one(Session.objects(id=session_id), **payload)
+    else:
+        msg = "update_session: session {0} does not exist, inserting."
+        current_app.logger.debug(msg.format(payload["session"]))
+
+        session_id = write_concern.save(Session(**payload)).id
+        drain_pending(payload["session"], payload["sensor_name"],
+                      session_id)
+    return session_id
+
+
 @events.route("/client/version", methods=["PUT"])
 @events.route("/client/size", methods=["PUT"])
 @auth.requires_token
@@ -101,26 +257,23 @@ def update_session():
     """
     Process events which require normal, atomic updates.
 
+    A client version also gives the session the HASSH fingerprint of
+    the client's algorithms, which is counted in the client catalog.
+
     This includes:
         cowrie.client.version
         cowrie.client.size
     """
     payload = request.get_json()
-
-    try:
-        session = Session.objects.get(
-            session=payload["session"],
-            sensor_name=payload["sensor_name"]
-        )
-        session.update(**payload)
-
-    except errors.DoesNotExist:
-        msg = "update_session: session {0} does not exist, inserting."
-        current_app.logger.debug(msg.format(payload["session"]))
-
-        session = Session(**payload)
-        session.save()
-
+    fingerprint = hassh.from_session(payload)
+    if fingerprint is not None:
+        payload["ssh_hassh"] = fingerprint[0]
+    session_id = upsert_session(payload)
+    if fingerprint is not None:
+        hassh.record(fingerprint[0], fingerprint[1],
+                     payload.get("ssh_version"))
+        profile(profiles.client, session_id, fingerprint[0])
+    log_save(Session, session_id)
     return STANDARD_RESPONSE, 202
 
 
@@ -133,26 +286,66 @@ def close_session():
     This includes:
         cowrie.session.closed
     """
-    payload = request.get_json()
+    session_id = upsert_session(request.get_json())
+    if current_app.config.get("SIMILARITY_ENABLED", True):
+        try:
+            minhash.record_session(
+                session_id,
+                current_app.config.get("SIMILARITY_THRESHOLD", 0.5),
+                current_app.config.get("SIMILARITY_MAX_CANDIDATES", 1000))
+        except Exception as e:
+            current_app.logger.warning(
+                "Session signature not stored: {0}".format(e))
+    log_save(Session, session_id)
+    return STANDARD_RESPONSE, 202
 
-    try:
-        session = Session.objects.get(
-            session=payload["session"],
-            sensor_name=payload["sensor_name"]
-        )
-        session.update(**payload)
 
-    except errors.DoesNotExist:
-        msg = "update_session: session {0} does not exist, inserting."
-        current_app.logger.debug(msg.format(payload["session"]))
+def store_ttylog(ttylog):
+    """
+    Move a TTY log's content into the blob store, keeping its sha256.
 
-        session = Session(**payload)
-        session.save()
+    A log already stored, as most bot sessions' are, only gains a
+    reference. Returns False when the log was sent as a sha256 alone and
+    the content is not stored.
+    """
+    encoded = ttylog.pop("log_base64", None)
+    if encoded:
+        ttylog["sha256"] = blobstore.put(base64.b64decode(encoded))
+        return True
+    if ttylog.get("sha256"):
+        return blobstore.reference(ttylog["sha256"])
+    return True
 
-    log_save(Session, session)
+
+@pending.applies("cowrie.log.closed")
+def apply_ttylog(payload, session_id):
+    """
+    Point the session at its TTY log in the blob store.
+
+    The reference taken on receipt becomes the session's. The one the
+    session held before is released: that of a log it no longer points
+    at, or the same log's when a sensor retried the event.
+    """
+    # Events buffered before logs went to the blob store carry content.
+    if "log_base64" in payload["ttylog"]:
+        store_ttylog(payload["ttylog"])
+    previous = write_concern.find_one_and_update(
+        Session.objects(id=session_id), {"ttylog.sha256": True}, **payload)
+    sha256 = ((previous or {}).get("ttylog") or {}).get("sha256")
+    if sha256:
+        blobstore.release(sha256)
+    log_save(Session, session_id)
     return STANDARD_RESPONSE, 202
 
 
+@pending.expires("cowrie.log.closed")
+def expire_ttylog(payload):
+    """Release the reference taken on a TTY log whose session never came."""
+    sha256 = payload.get("ttylog", {}).get("sha256")
+    if sha256 and "log_base64" not in payload["ttylog"]:
+        blobstore.release(sha256)
+
+
 @events.route("/log/closed", methods=["PUT"])
 @auth.requires_token
 def close_ttylog():
@@ -160,25 +353,87 @@ def close_ttylog():
     Process log closure.
 
     This processing is special as it requires the decoding of
-    the binary log file before insertion.
+    the binary log file before insertion. The log is stored once per
+    distinct content; a sensor that already knows a log's sha256 may
+    send ttylog.sha256 instead of ttylog.log_base64, and gets a 409 when
+    that content is not stored yet.
 
     This includes:
         cowrie.log.closed
     """
     payload = request.get_json()
+    ttylog = payload.setdefault("ttylog", {})
+    if not store_ttylog(ttylog):
+        msg = "TTY log {0} is not stored; send its content.".format(
+            ttylog["sha256"])
+        return jsonify(error=msg), 409
+    response, status = with_session(payload, apply_ttylog)
+    if status == 404 and ttylog.get("sha256"):
+        blobstore.release(ttylog["sha256"])
+    return response, status
 
-    try:
-        session = Session.objects.get(
-            session=payload["session"],
-            sensor_name=payload["sensor_name"]
-        )
-    except errors.DoesNotExist:
-        msg = "Session {0} Not Found.".format(payload["session"])
-        return jsonify(error=msg), 404
 
-    b64_ttylog = payload["ttylog"].pop("log_base64")
-    payload["ttylog"]["log_binary"] = base64.b64decode(b64_ttylog)
-    session.update(**payload)
+@events.route("/ttylogs/<sha256>", methods=["HEAD"])
+@auth.requires_token
+def ttylog_exists(sha256):
+    """Tell a sensor whether a TTY log's content is already stored."""
+    return "", 200 if blobstore.exists(sha256.lower()) else 404
+
+
+@events.route("/artifacts/<sha256>", methods=["HEAD"])
+@auth.requires_token
+def artifact_exists(sha256):
+    """Tell a sensor whether a downloaded file is already stored."""
+    return "", 200 if blobstore.exists(sha256.lower()) else 404
+
+
+@events.route("/artifacts/<sha256>", methods=["PUT"])
+@auth.requires_token
+def upload_artifact(sha256):
+    """
+    Store a file captured by a sensor, once per distinct content.
+
+    The body is the raw file, streamed into the blob store in chunks
+    and kept only if it hashes to sha256. A file already stored is not
+    read at all; sensors can avoid sending it by asking HEAD first.
+    """
+    sha256 = sha256.lower()
+    if SHA256.match(sha256) is None:
+        return jsonify(error="Artifacts are named by their sha256."), 400
+    limit = current_app.config.get("ARTIFACT_MAX_BYTES")
+    if limit is not None and (request.content_length or 0) > limit:
+        msg = "Artifacts are limited to {0} bytes.".format(limit)
+        return jsonify(error=msg), 413
+    try:
+        stored = blobstore.upload(sha256, request.stream, limit)
+    except blobstore.UploadInProgress:
+        msg = "Artifact {0} is being uploaded.".format(sha256)
+        return jsonify(error=msg), 409, {"Retry-After": "60"}
+    except blobstore.TooLarge as e:
+        return jsonify(error=str(e)), 413
+    except blobstore.DigestMismatch as e:
+        return jsonify(error=str(e)), 422
+    return jsonify(sha256=sha256, stored=True,
+                   deduplicated=not stored), 201 if stored else 200
+
+
+@pending.applies("cowrie.login.success", "cowrie.login.failed")
+def apply_login_attempt(payload, session_id):
+    """Store a login attempt and add it to its session."""
+    if not payload.get("success"):
+        key = (payload["sensor_name"], payload.get("username"),
+               payload.get("password"))
+        if failed_login_cache.get(key) is not None:
+            g.write_concern_event = "cowrie.login.failed.duplicate"
+        else:
+            failed_login_cache.set(key, True)
+
+    payload["session"] = session_id
+    creds = write_concern.save(Credentials(**payload))
+    write_concern.push(Session, session_id, "credentials", creds.id)
+    profile(profiles.login_attempt, session_id, creds.username,
+            creds.password, creds.success, creds.timestamp)
+    log_save(Credentials, creds.id)
     return STANDARD_RESPONSE, 202
 
 
@@ -193,19 +448,26 @@ def add_login_attempt():
         cowrie.login.success
         cowrie.login.failed
     """
-    payload = request.get_json()
-    try:
-        session = Session.objects.get(
-            session=payload["session"],
-            sensor_name=payload["sensor_name"]
-        )
-    except errors.DoesNotExist:
-        msg = "Session {0} Not Found.".format(payload["session"])
-        return jsonify(error=msg), 404
-
-    creds = Credentials(**payload).save()
-    log_save(Credentials, creds)
-    session.update(push__credentials=creds)
+    return with_session(request.get_json(), apply_login_attempt)
+
+
+@pending.applies("cowrie.command.success", "cowrie.command.failed")
+def apply_command(payload, session_id):
+    """Store a command and add it to its session."""
+    payload["session"] = session_id
+    cmd = write_concern.save(Command(**payload))
+    if current_app.config.get("SEARCH_INDEX_COMMANDS", True):
+        try:
+            search_index.index_command(
+                cmd.command, partitions.to_datetime(cmd.timestamp))
+        except Exception as e:
+            # The index is derived data; "manage search backfill" repairs
+            # it, so a failure must not fail the event.
+            current_app.logger.warning(
+                "Command not indexed for search: {0}".format(e))
+    write_concern.push(Session, session_id, "commands", cmd.id)
+    profile(profiles.command, session_id, cmd.timestamp)
+    log_save(Command, cmd.id)
     return STANDARD_RESPONSE, 202
 
 
@@ -220,19 +482,19 @@ def add_command():
         cowrie.command.success
         cowrie.command.failed
     """
-    payload = request.get_json()
-    try:
-        session = Session.objects.get(
-            session=payload["session"],
-            sensor_name=payload["sensor_name"]
-        )
-    except errors.DoesNotExist:
-        msg = "Session {0} Not Found.".format(payload["session"])
-        return jsonify(error=msg), 404
-
-    cmd = Command(**payload).save()
-    log_save(Command, cmd)
-    session.update(push__commands=cmd)
+    return with_session(request.get_json(), apply_command)
+
+
+@pending.applies("cowrie.session.file_download")
+def apply_download(payload, session_id):
+    """Store a download and add it to its session."""
+    payload["session"] = session_id
+    download = write_concern.save(Download(**payload))
+    if download.shasum:
+        blobstore.claim(download.shasum.lower())
+    write_concern.push(Session, session_id, "downloads", download.id)
+    profile(profiles.download, session_id, download.shasum)
+    log_save(Download, download.id)
     return STANDARD_RESPONSE, 202
 
 
@@ -245,19 +507,16 @@ def add_download():
     This includes:
         cowrie.session.file_download
     """
-    payload = request.get_json()
-    try:
-        session = Session.objects.get(
-            session=payload["session"],
-            sensor_name=payload["sensor_name"]
-        )
-    except errors.DoesNotExist:
-        msg = "Session {0} Not Found.".format(payload["session"])
-        return jsonify(error=msg), 404
+    return with_session(request.get_json(), apply_download)
+
 
-    download = Download(**payload).save()
-    log_save(Download, download)
-    session.update(push__downloads=download)
+@pending.applies("cowrie.client.fingerprint")
+def apply_fingerprint(payload, session_id):
+    """Store a key fingerprint and add it to its session."""
+    payload["session"] = session_id
+    fingerprint = write_concern.save(Fingerprint(**payload))
+    write_concern.push(Session, session_id, "fingerprints", fingerprint.id)
+    log_save(Fingerprint, fingerprint.id)
     return STANDARD_RESPONSE, 202
 
 
@@ -270,20 +529,22 @@ def add_fingerprint():
     This includes:
         cowrie.client.fingerprint
     """
-    payload = request.get_json()
-    try:
-        session = Session.objects.get(
-            session=payload["session"],
-            sensor_name=payload["sensor_name"]
-        )
-    except errors.DoesNotExist:
-        msg = "Session {0} Not Found.".format(payload["session"])
-        return jsonify(error=msg), 404
-
-    fingerprint = Fingerprint.from_json(**payload).save()
-    log_save(Fingerprint, fingerprint)
-    session.update(push__fingerprints=fingerprint)
-    return STANDARD_RESPONSE, 202
+    return with_session(request.get_json(), apply_fingerprint)
+
+
+@pending.applies("cowrie.cdirect-tcpip.request")
+def apply_connection(payload, session_id):
+    """Store a forwarded TCP connection and add it to its session."""
+    payload["session"] = session_id
+    tcp = write_concern.save(TcpConnection(**payload))
+    session = EXECUTOR.run(
+        Session.objects(id=session_id).modify,
+        push__tcpconnections=tcp,
+        new=True
+    )
+    log_save(TcpConnection, tcp.id)
+    log_save(Session, session.id)
+    return session.to_json(), 202
 
 
 @events.route("/cdirect-tcpip/request", methods=["PUT"])
@@ -295,18 +556,4 @@ def add_connection():
     This includes:
         cowrie.direct-tcpip.request
     """
-    payload = request.get_json()
-    try:
-        session = Session.objects.get(
-            session=payload["session"],
-            sensor_name=payload["sensor_name"]
-        )
-    except errors.DoesNotExist:
-        msg = "Session {0} Not Found.".format(payload["session"])
-        return jsonify(error=msg), 404
-    tcp = TcpConnection(**payload).save()
-    log_save(TcpConnection, tcp)
-    session.update(push__tcpconnections=tcp)
-    session.reload()
-    log_save(Session, session)
-    return session.to_json(), 202
+    return with_session(request.get_json(), apply_connection)
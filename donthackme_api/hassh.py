@@ -0,0 +1,102 @@
+"""HASSH fingerprints of SSH clients, and their catalog."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+
+from datetime import datetime
+
+from donthackme_api.cache import TTLCache
+from donthackme_api.concurrency import EXECUTOR
+from donthackme_api.models import ClientFingerprint
+
+# Client versions listed per fingerprint in the catalog.
+MAX_VERSIONS = 20
+
+# (fingerprint, version) pairs already in the catalog.
+known_versions = TTLCache(name="hassh_versions", maxsize=10000, ttl=3600)
+
+
+def algorithms(kex, enc, mac, comp):
+    """Return the HASSH algorithms string, "kex;enc;mac;comp"."""
+    return ";".join(",".join(names or []) for names in (kex, enc, mac, comp))
+
+
+def hassh(algorithms_string):
+    """Return the HASSH of an algorithms string."""
+    return hashlib.md5(algorithms_string.encode("utf-8")).hexdigest()
+
+
+def from_session(values):
+    """
+    Return (hassh, algorithms) of a session's ssh_ fields, or None.
+
+    values is a client.version payload or a raw session document. Older
+    cowrie sensors do not report the cipher and compression lists; their
+    fingerprints group clients all the same, but do not match published
+    HASSH values.
+    """
+    if not values.get("ssh_kexAlgs"):
+        return None
+    value = algorithms(values.get("ssh_kexAlgs"), values.get("ssh_encCS"),
+                       values.get("ssh_macCS"), values.get("ssh_compCS"))
+    return hassh(value), value
+
+
+def record(fingerprint, algorithms_string, version=None, seen=None):
+    """
+    Count a session of a client in the catalog.
+
+    One upsert keeps the session count and first and last sightings;
+    the version list, capped at MAX_VERSIONS, is only written for a
+    version this worker has not recently added.
+    """
+    seen = seen or datetime.utcnow()
+    catalog = ClientFingerprint._get_collection()
+    EXECUTOR.run(catalog.update_one, {"_id": fingerprint}, {
+        "$inc": {"sessions": 1},
+        "$min": {"first_seen": seen},
+        "$max": {"last_seen": seen},
+        "$setOnInsert": {"algorithms": algorithms_string}
+    }, upsert=True)
+    if version and known_versions.get((fingerprint, version)) is None:
+        EXECUTOR.run(catalog.update_one, {
+            "_id": fingerprint,
+            "versions.{0}".format(MAX_VERSIONS - 1): {"$exists": False}
+        }, {"$addToSet": {"versions": version}})
+        known_versions.set((fingerprint, version), True)
+
+
+def backfill(group):
+    """
+    Merge the catalog entry aggregated from stored sessions.
+
+    group holds the fingerprint's algorithms, session count, first and
+    last start times and versions. Counts are raised, never added, so a
+    backfill can be run again.
+    """
+    ClientFingerprint._get_collection().update_one(
+        {"_id": group["_id"]},
+        {
+            "$max": {"sessions": group["sessions"],
+                     "last_seen": group["last_seen"]},
+            "$min": {"first_seen": group["first_seen"]},
+            "$setOnInsert": {"algorithms": group["algorithms"]},
+            "$addToSet": {"versions": {"$each": [
+                version for version in group["versions"] if version
+            ][:MAX_VERSIONS]}}
+        },
+        upsert=True
+    )
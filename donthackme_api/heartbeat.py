@@ -0,0 +1,180 @@
+"""Sensor last-seen times and event counts, aggregated per worker."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from flask import current_app, request
+
+from pymongo import UpdateMany, UpdateOne
+
+from donthackme_api import metrics
+from donthackme_api import write_concern
+from donthackme_api.concurrency import EXECUTOR
+from donthackme_api.models import Sensor, SensorActivity
+
+metrics.REGISTRY.describe("donthackme_heartbeat_flushes_total",
+                          "Bulk writes of aggregated sensor activity.")
+
+
+def field(event):
+    """Return the event_counts key of an event: its id without dots."""
+    return event.replace(".", "_")
+
+
+def minute(when):
+    """Return the start of the minute of a datetime."""
+    return when.replace(second=0, microsecond=0)
+
+
+class Heartbeats(object):
+    """
+    Sensor activity seen by this worker since its last flush.
+
+    Recording an event only updates a dict; flush() writes everything
+    recorded with one bulk write to the sensors and one to the
+    per-minute activity collection, at most once per `interval` seconds.
+    """
+
+    def __init__(self, interval=10):
+        """init."""
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._seen = {}
+        self._minutes = {}
+
+    def record(self, sensor_name, event, when=None):
+        """Count an event of a sensor."""
+        when = when or datetime.utcnow()
+        key = field(event)
+        with self._lock:
+            seen = self._seen.get(sensor_name)
+            if seen is None:
+                seen = self._seen[sensor_name] = [when, {}]
+            elif when > seen[0]:
+                seen[0] = when
+            seen[1][key] = seen[1].get(key, 0) + 1
+            counts = self._minutes.setdefault(
+                (sensor_name, minute(when)), {})
+            counts[key] = counts.get(key, 0) + 1
+
+    def due(self):
+        """Return True when the interval since the last flush has passed."""
+        return time.time() - self._last_flush >= self.interval
+
+    def flush(self):
+        """Write the activity recorded so far; return the sensors written."""
+        with self._lock:
+            seen, self._seen = self._seen, {}
+            minutes, self._minutes = self._minutes, {}
+            self._last_flush = time.time()
+        if not seen:
+            return 0
+        sensors = [
+            UpdateMany({"name": name}, {
+                "$max": {"last_seen": when},
+                "$inc": dict(("event_counts." + key, count)
+                             for key, count in counts.items())
+            }) for name, (when, counts) in seen.items()
+        ]
+        activity = []
+        for (name, start), counts in minutes.items():
+            update = dict(("counts." + key, count)
+                          for key, count in counts.items())
+            update["events"] = sum(counts.values())
+            activity.append(UpdateOne(
+                {"_id": "{0}:{1:%Y%m%d%H%M}".format(name, start)},
+                {"$inc": update,
+                 "$setOnInsert": {"sensor": name, "minute": start}},
+                upsert=True))
+        EXECUTOR.run(Sensor._get_collection().bulk_write, sensors,
+                     ordered=False)
+        EXECUTOR.run(SensorActivity._get_collection().bulk_write, activity,
+                     ordered=False)
+        metrics.inc("donthackme_heartbeat_flushes_total")
+        return len(seen)
+
+
+HEARTBEATS = Heartbeats()
+
+
+def rates(minutes):
+    """
+    Return {sensor_name: events per minute} over the last minutes.
+
+    The current, partial minute is not counted.
+    """
+    end = minute(datetime.utcnow())
+    start = end - timedelta(minutes=minutes)
+    totals = SensorActivity._get_collection().aggregate([
+        {"$match": {"minute": {"$gte": start, "$lt": end}}},
+        {"$group": {"_id": "$sensor", "events": {"$sum": "$events"}}}
+    ])
+    return dict((total["_id"], float(total["events"]) / minutes)
+                for total in totals)
+
+
+def status(alive_seconds, rate_minutes):
+    """Describe every sensor: last seen, liveness, counts and rate."""
+    now = datetime.utcnow()
+    per_minute = rates(rate_minutes)
+    sensors = []
+    for sensor in Sensor.objects.order_by("name"):
+        response = sensor.to_dict()
+        age = (now - sensor.last_seen).total_seconds() \
+            if sensor.last_seen else None
+        response["seconds_since_seen"] = age
+        response["alive"] = age is not None and age <= alive_seconds
+        response["events_per_minute"] = per_minute.get(sensor.name, 0.0)
+        sensors.append(response)
+    return sensors
+
+
+def _record(response):
+    if response.status_code >= 400:
+        return response
+    event = write_concern.current_event()
+    payload = request.get_json(silent=True) if event else None
+    if isinstance(payload, dict) and payload.get("sensor_name"):
+        HEARTBEATS.record(payload["sensor_name"], event)
+    if HEARTBEATS.due():
+        try:
+            HEARTBEATS.flush()
+        except Exception as e:
+            # Liveness is advisory; the events themselves are stored.
+            current_app.logger.warning(
+                "Sensor activity not written: {0}".format(e))
+    return response
+
+
+def _flush_at_exit():
+    try:
+        HEARTBEATS.flush()
+    except Exception:
+        pass
+
+
+def init_app(app):
+    """Count sensor events after each request, when HEARTBEAT_ENABLED."""
+    HEARTBEATS.interval = app.config.get("HEARTBEAT_FLUSH_INTERVAL", 10)
+    if not app.config.get("HEARTBEAT_ENABLED", True):
+        return
+    app.after_request(_record)
+    atexit.register(_flush_at_exit)
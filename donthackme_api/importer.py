@@ -0,0 +1,529 @@
+"""Offline import of Cowrie JSON log files, in parallel by session."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import json
+import multiprocessing
+import os
+import time
+import zlib
+
+from collections import OrderedDict
+from datetime import datetime
+from Queue import Empty, Full
+
+from bson import ObjectId
+
+from flask import current_app
+
+from pymongo import ReturnDocument, UpdateOne
+
+from donthackme_api import blobstore
+from donthackme_api import hassh
+from donthackme_api import heartbeat
+from donthackme_api import mongo
+from donthackme_api import partitions
+from donthackme_api import profiles
+from donthackme_api.cache import TTLCache
+from donthackme_api.events.cowrie import Translator
+from donthackme_api.models import (Command, Credentials, Download,
+                                   Fingerprint, Sensor, Session,
+                                   TcpConnection)
+
+# cowrie event id -> (document, Session list field) of child events.
+CHILDREN = {
+    "cowrie.login.success": (Credentials, "credentials"),
+    "cowrie.login.failed": (Credentials, "credentials"),
+    "cowrie.command.success": (Command, "commands"),
+    "cowrie.command.failed": (Command, "commands"),
+    "cowrie.session.file_download": (Download, "downloads"),
+    "cowrie.client.fingerprint": (Fingerprint, "fingerprints"),
+    "cowrie.direct-tcpip.request": (TcpConnection, "tcpconnections"),
+}
+
+# Seconds to wait for a worker before checking that it is still alive.
+WORKER_POLL = 5
+
+
+def read_events(path, offset=0):
+    """
+    Yield (event, offset) for each JSON line of a plain or gzipped file.
+
+    offset is the position just after the event's line, in the
+    uncompressed stream, and reading can start again from any of them.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as stream:
+        if offset:
+            stream.seek(offset)
+        while True:
+            line = stream.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            yield event, stream.tell()
+
+
+def event_time(payload):
+    """Return when an event happened, or None if it does not say."""
+    when = payload.get("timestamp") or payload.get("start_time") or \
+        payload.get("end_time")
+    return partitions.to_datetime(when) if when else None
+
+
+def shard_of(payload, shards):
+    """Return the worker that imports a payload's session."""
+    key = u"{0}\0{1}".format(payload.get("session"),
+                             payload.get("sensor_name"))
+    return (zlib.crc32(key.encode("utf-8")) & 0xffffffff) % shards
+
+
+class Checkpoint(object):
+    """
+    Progress of an import: how far each file has been written.
+
+    Saved as JSON, through a temporary file, whenever every worker has
+    written all the events read so far without error; a run given the
+    same checkpoint skips finished files and continues the others from
+    their offset. Events read after the last save of an interrupted or
+    failed run are imported again, so their child documents may be
+    written, and their profile and sensor counts added, twice.
+    """
+
+    def __init__(self, path=None):
+        """init."""
+        self.path = path
+        self.files = {}
+        self.events = 0
+        if path is not None and os.path.exists(path):
+            with open(path) as handle:
+                saved = json.load(handle)
+            self.files = saved.get("files", {})
+            self.events = saved.get("events", 0)
+
+    def position(self, name):
+        """Return the offset to resume a file from, or None when done."""
+        progress = self.files.get(os.path.abspath(name), {})
+        if progress.get("done"):
+            return None
+        return progress.get("offset", 0)
+
+    def save(self, name, offset, events, done=False):
+        """Record a file's progress, and save it if there is a path."""
+        self.files[os.path.abspath(name)] = {"offset": offset, "done": done}
+        self.events = events
+        if self.path is None:
+            return
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as handle:
+            json.dump({"files": self.files, "events": self.events,
+                       "saved": datetime.utcnow().isoformat()}, handle)
+        os.rename(temporary, self.path)
+
+
+class Shard(object):
+    """
+    Write batches of events, all of whose sessions belong to this worker.
+
+    Each batch costs one insert per child collection and one bulk
+    upsert of the sessions per partition, besides looking up the ids of
+    sessions this worker has not seen yet. The attacker profiles and
+    sensor activity the events add up to follow in a few bulk writes.
+    """
+
+    def __init__(self, cache_size=100000, profiles_enabled=True,
+                 heartbeats_enabled=True):
+        """init."""
+        # (session, sensor_name) -> (Session id, partition suffix,
+        # source IP)
+        self.sessions = TTLCache(maxsize=cache_size, ttl=86400)
+        self.sensors = {}
+        self.profiles_enabled = profiles_enabled
+        self.heartbeats_enabled = heartbeats_enabled
+
+    def sensor_id(self, payload):
+        """Return the id of a session's sensor, registering it if new."""
+        key = (payload.get("sensor_name"), payload.get("sensor_ip"))
+        if key not in self.sensors:
+            sensor = Sensor._get_collection().find_one_and_update(
+                {"ip": key[1]},
+                {"$setOnInsert": {"name": key[0]},
+                 "$min": {"timestamp": partitions.to_datetime(
+                     payload["start_time"])}},
+                projection={"_id": True},
+                upsert=True,
+                return_document=ReturnDocument.AFTER)
+            self.sensors[key] = sensor["_id"]
+        return self.sensors[key]
+
+    def resolve(self, sessions):
+        """
+        Find or allocate the id and partition of every session in a batch.
+
+        A session is looked for in the partition of its start_time, or
+        those that may hold it when the batch starts after its connect,
+        with one query per partition for the whole batch.
+        """
+        homes = {}
+        candidates = OrderedDict()
+        for key, items in sessions.items():
+            if self.sessions.get(key) is not None:
+                continue
+            connect = [payload for eventid, payload in items
+                       if eventid == "cowrie.session.connect"]
+            if connect:
+                home = partitions.ROUTER.suffix_for(connect[0]["start_time"])
+                suffixes = [home]
+            else:
+                payload = items[0][1]
+                hint = payload.get("timestamp") or payload.get("end_time")
+                home = partitions.ROUTER.suffix_for(
+                    hint or datetime.utcnow())
+                suffixes = partitions.ROUTER.session_partitions(hint)
+            homes[key] = home
+            for suffix in suffixes:
+                candidates.setdefault(suffix, []).append(key)
+
+        for suffix, keys in candidates.items():
+            keys = [key for key in keys if self.sessions.get(key) is None]
+            for start in range(0, len(keys), 500):
+                query = {"$or": [{"session": session, "sensor_name": name}
+                                 for session, name in keys[start:start + 500]]}
+                with partitions.use(suffix):
+                    found = Session._get_collection().find(
+                        query, {"session": True, "sensor_name": True,
+                                "source_ip": True})
+                    for session in found:
+                        self.sessions.set(
+                            (session["session"], session.get("sensor_name")),
+                            (session["_id"], suffix,
+                             session.get("source_ip")))
+        for key, home in homes.items():
+            if self.sessions.get(key) is None:
+                self.sessions.set(key, (ObjectId(), home, None))
+
+    def session_fields(self, eventid, payload):
+        """Return the Session fields an event sets, as stored."""
+        payload = dict(payload)
+        if eventid == "cowrie.session.connect":
+            payload["sensor"] = self.sensor_id(payload)
+        elif eventid == "cowrie.log.closed":
+            from donthackme_api.events.views import store_ttylog
+            ttylog = payload.get("ttylog") or {}
+            if not store_ttylog(ttylog):
+                # Logged by hash alone, and the content is not stored.
+                ttylog.pop("sha256", None)
+        elif eventid == "cowrie.client.version":
+            fingerprint = hassh.from_session(payload)
+            if fingerprint is not None:
+                payload["ssh_hassh"] = fingerprint[0]
+        stored = Session(**payload).to_mongo()
+        return dict((key, value) for key, value in stored.items()
+                    if key in payload and key != "_id" and
+                    value is not None)
+
+    @staticmethod
+    def profile(tally, ip, eventid, payload, fields):
+        """Add an event to the attacker profile of its source IP."""
+        if eventid == "cowrie.session.connect":
+            tally.session_started(ip, payload.get("sensor_name"),
+                                  payload.get("start_time"))
+        elif eventid in ("cowrie.login.success", "cowrie.login.failed"):
+            tally.login_attempt(ip, payload.get("username"),
+                                payload.get("password"),
+                                payload.get("success"),
+                                payload.get("timestamp"))
+        elif eventid in ("cowrie.command.success",
+                         "cowrie.command.failed"):
+            tally.command(ip, payload.get("timestamp"))
+        elif eventid == "cowrie.session.file_download":
+            tally.download(ip, payload.get("shasum"))
+        elif eventid == "cowrie.client.version":
+            tally.client(ip, fields.get("ssh_hassh"))
+
+    def apply(self, batch):
+        """Write a batch of (eventid, payload); return counts by event."""
+        sessions = OrderedDict()
+        for eventid, payload in batch:
+            key = (payload["session"], payload.get("sensor_name"))
+            sessions.setdefault(key, []).append((eventid, payload))
+        self.resolve(sessions)
+
+        counts = {}
+        writes = {}
+        tally = profiles.Tally()
+        heartbeats = heartbeat.Heartbeats()
+        for key, items in sessions.items():
+            session_id, suffix, ip = self.sessions.get(key)
+            children, updates = writes.setdefault(suffix, ({}, []))
+            fields = {}
+            pushes = OrderedDict()
+            for eventid, payload in items:
+                counts[eventid] = counts.get(eventid, 0) + 1
+                if eventid == "cowrie.session.connect":
+                    ip = payload.get("source_ip")
+                    self.sessions.set(key, (session_id, suffix, ip))
+                if payload.get("sensor_name"):
+                    heartbeats.record(payload["sensor_name"], eventid,
+                                      event_time(payload))
+                event_fields = {}
+                if eventid in CHILDREN:
+                    document, field = CHILDREN[eventid]
+                    child = document(**dict(
+                        payload, session=session_id)).to_mongo()
+                    child["_id"] = ObjectId()
+                    children.setdefault(document, []).append(child)
+                    pushes.setdefault(field, []).append(child["_id"])
+                    if document is Download and child.get("shasum"):
+                        blobstore.claim(child["shasum"].lower())
+                else:
+                    event_fields = self.session_fields(eventid, payload)
+                    fields.update(event_fields)
+                if ip:
+                    self.profile(tally, ip, eventid, payload, event_fields)
+            update = {"$setOnInsert": {"_id": session_id}}
+            if fields:
+                update["$set"] = fields
+            if pushes:
+                update["$push"] = dict(
+                    (field, {"$each": ids}) for field, ids in pushes.items())
+            updates.append(UpdateOne(
+                {"session": key[0], "sensor_name": key[1]}, update,
+                upsert=True))
+
+        for suffix, (children, updates) in writes.items():
+            with partitions.use(suffix):
+                # Children first, so that no session lists a missing one.
+                for document, stored in children.items():
+                    document._get_collection().insert_many(stored,
+                                                           ordered=False)
+                Session._get_collection().bulk_write(updates, ordered=False)
+                self.log(children)
+        self.derive(tally, heartbeats)
+        return counts
+
+    def derive(self, tally, heartbeats):
+        """
+        Write a batch's attacker profiles and sensor activity.
+
+        Like the events API, a failure here is logged rather than failing
+        the batch: the events themselves are stored.
+        """
+        try:
+            if self.profiles_enabled:
+                tally.write()
+            if self.heartbeats_enabled:
+                heartbeats.flush()
+        except Exception as e:
+            current_app.logger.warning(
+                "Profiles and sensor activity of an import batch not "
+                "written: {0}".format(e))
+
+    @staticmethod
+    def log(children):
+        """Report the batch's writes to the TransactionLog, once each."""
+        from donthackme_api.events.views import log_save
+
+        log_save(Session, None)
+        for document, stored in children.items():
+            log_save(document, stored[-1]["_id"])
+
+
+def deliver(inbox, process, message):
+    """
+    Put a message in a worker's inbox, waiting while the worker lives.
+
+    Raises RuntimeError when the worker has exited.
+    """
+    while True:
+        try:
+            inbox.put(message, timeout=WORKER_POLL)
+            return
+        except Full:
+            if not process.is_alive():
+                raise RuntimeError("An import worker exited; resume from "
+                                   "the last checkpoint.")
+
+
+def work(app, inbox, outbox):
+    """Run in a worker process: apply batches until told to stop."""
+    mongo.reset_connections()
+    shard = Shard(profiles_enabled=app.config.get("PROFILES_ENABLED", True),
+                  heartbeats_enabled=app.config.get("HEARTBEAT_ENABLED",
+                                                    True))
+    counts = {}
+    failed = 0
+    with app.app_context():
+        while True:
+            message = inbox.get()
+            if message is None:
+                break
+            if message == "sync":
+                outbox.put((counts, failed))
+                counts = {}
+                failed = 0
+                continue
+            try:
+                written = shard.apply(message)
+            except Exception:
+                app.logger.exception("Import batch of {0} events "
+                                     "failed.".format(len(message)))
+                failed += len(message)
+                continue
+            for eventid, count in written.items():
+                counts[eventid] = counts.get(eventid, 0) + count
+
+
+class Importer(object):
+    """
+    Import Cowrie JSON logs with a pool of worker processes.
+
+    This process reads and translates the events, as the events API
+    would receive them from a sensor, and hands each to the worker that
+    owns its session, in batches of `batch_size`. Every
+    `checkpoint_every` events, and at the end of each file, it waits
+    for all workers to catch up, then saves the checkpoint and reports
+    the rate.
+    """
+
+    def __init__(self, app, workers=None, batch_size=1000,
+                 checkpoint_every=50000, checkpoint=None, report=None):
+        """init."""
+        self.app = app
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint = Checkpoint(checkpoint)
+        self.previous = self.checkpoint.events
+        self.report = report or (lambda line: None)
+        self.translator = Translator()
+        self.counts = {}
+        self.skipped = 0
+        self.failed = 0
+        self.started = None
+
+    def run(self, paths):
+        """Import every file in paths; return the events imported."""
+        outbox = multiprocessing.Queue()
+        inboxes = [multiprocessing.Queue(maxsize=8)
+                   for _ in range(self.workers)]
+        processes = [multiprocessing.Process(target=work,
+                                             args=(self.app, inbox, outbox))
+                     for inbox in inboxes]
+        for process in processes:
+            process.daemon = True
+            process.start()
+        self.started = time.time()
+        try:
+            for path in paths:
+                self.import_file(path, inboxes, outbox, processes)
+        finally:
+            for inbox, process in zip(inboxes, processes):
+                try:
+                    deliver(inbox, process, None)
+                except RuntimeError:
+                    # Already gone: there is nothing left to stop.
+                    pass
+            for process in processes:
+                process.join()
+        self.report("{0} events imported in {1:.0f}s ({2:.0f} events/s); "
+                    "{3} skipped, {4} failed.".format(
+                        self.imported, time.time() - self.started,
+                        self.rate(), self.skipped, self.failed))
+        return self.imported
+
+    @property
+    def imported(self):
+        """Return the number of events written so far."""
+        return sum(self.counts.values())
+
+    def total(self):
+        """Return the events written by this and earlier runs."""
+        return self.previous + self.imported
+
+    def rate(self):
+        """Return the events written per second of this run."""
+        elapsed = time.time() - self.started
+        return self.imported / elapsed if elapsed else 0.0
+
+    def import_file(self, path, inboxes, outbox, processes):
+        """Send one file's events to the workers, with checkpoints."""
+        offset = self.checkpoint.position(path)
+        if offset is None:
+            self.report("{0}: already imported.".format(path))
+            return
+        batches = [[] for _ in inboxes]
+        read = 0
+        for event, position in read_events(path, offset):
+            translated = self.translator.translate(event)
+            if translated is None:
+                self.skipped += 1
+                continue
+            eventid, _, _, payload = translated
+            shard = shard_of(payload, len(inboxes))
+            batches[shard].append((eventid, payload))
+            if len(batches[shard]) >= self.batch_size:
+                deliver(inboxes[shard], processes[shard], batches[shard])
+                batches[shard] = []
+            read += 1
+            if read % self.checkpoint_every == 0:
+                self.sync(batches, inboxes, outbox, processes)
+                self.checkpoint.save(path, position, self.total())
+                self.report("{0}: {1} events, {2:.0f} events/s".format(
+                    path, self.imported, self.rate()))
+            offset = position
+        self.sync(batches, inboxes, outbox, processes)
+        self.checkpoint.save(path, offset, self.total(), done=True)
+        self.report("{0}: done, {1} events, {2:.0f} events/s".format(
+            path, self.imported, self.rate()))
+
+    def sync(self, batches, inboxes, outbox, processes):
+        """
+        Flush partial batches and wait until every worker wrote them.
+
+        Raises RuntimeError when a worker exited or a batch failed.
+        """
+        for shard, inbox in enumerate(inboxes):
+            if batches[shard]:
+                deliver(inbox, processes[shard], batches[shard])
+                batches[shard] = []
+            deliver(inbox, processes[shard], "sync")
+        waiting = len(inboxes)
+        failures = 0
+        while waiting:
+            try:
+                counts, failed = outbox.get(timeout=WORKER_POLL)
+            except Empty:
+                if not all(process.is_alive() for process in processes):
+                    raise RuntimeError("An import worker exited; resume "
+                                       "from the last checkpoint.")
+                continue
+            waiting -= 1
+            failures += failed
+            for eventid, count in counts.items():
+                self.counts[eventid] = self.counts.get(eventid, 0) + count
+        if failures:
+            # A failed batch may be partly written: stop before the
+            # checkpoint passes it, so that the next run imports it again.
+            self.failed += failures
+            raise RuntimeError("{0} events failed to import; resume from "
+                               "the last checkpoint.".format(failures))
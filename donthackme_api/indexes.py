@@ -0,0 +1,231 @@
+"""Create, verify and migrate the indexes declared on the models."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from bson.son import SON
+
+from mongoengine.connection import get_db
+
+from donthackme_api import partitions
+from donthackme_api import retention
+
+
+# Index options that make two indexes on the same keys different.
+COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds",
+                    "partialFilterExpression")
+
+
+def declared(document):
+    """
+    Return [(keys, options)] for every index declared on document.
+
+    The TTL index of the collection's retention policy is included.
+    """
+    specs = []
+    for spec in document._meta.get("index_specs", []):
+        spec = dict(spec)
+        keys = [tuple(key) for key in spec.pop("fields")]
+        specs.append((keys, spec))
+    return retention.POLICY.apply(
+        partitions.base_collection_name(document), specs)
+
+
+def retimed(found, options):
+    """
+    Return True when an index differs from its spec only by its TTL.
+
+    Such an index is changed in place with collMod instead of rebuilt,
+    unless its TTL is to be removed, which collMod cannot do.
+    """
+    if "expireAfterSeconds" not in found:
+        return False
+    found = dict(found)
+    found.pop("expireAfterSeconds")
+    wanted = dict((option, options[option]) for option in COMPARED_OPTIONS
+                  if options.get(option) not in (None, False) and
+                  option != "expireAfterSeconds")
+    return found == wanted
+
+
+def existing(collection):
+    """Return {keys: (name, options)} for the indexes on collection."""
+    indexes = {}
+    for name, info in collection.index_information().items():
+        if name == "_id_":
+            continue
+        keys = tuple(tuple(key) for key in info["key"])
+        options = dict((option, info[option]) for option in COMPARED_OPTIONS
+                       if option in info)
+        indexes[keys] = (name, options)
+    return indexes
+
+
+def plan(document):
+    """
+    Compare declared and existing indexes of one document.
+
+    Returns (missing, changed, extra, ttl): declared specs with no index
+    on their keys, (existing name, spec) pairs whose options differ, the
+    names of indexes that are not declared at all, and the (name, spec)
+    pairs among changed that only need a new TTL or none. An undeclared
+    TTL index, left by a retention policy since removed, is also in ttl,
+    with None for its spec.
+    """
+    current = existing(document._get_collection())
+    missing = []
+    changed = []
+    ttl = []
+    seen = set()
+    for keys, options in declared(document):
+        seen.add(tuple(keys))
+        found = current.get(tuple(keys))
+        wanted = dict((option, options[option]) for option in COMPARED_OPTIONS
+                      if options.get(option) not in (None, False))
+        if found is None:
+            missing.append((keys, options))
+        elif found[1] != wanted:
+            changed.append((found[0], (keys, options)))
+            if retimed(found[1], options):
+                ttl.append((found[0], (keys, options)))
+    extra = []
+    for keys, (name, options) in current.items():
+        if keys not in seen:
+            extra.append(name)
+            if "expireAfterSeconds" in options:
+                ttl.append((name, None))
+    return missing, changed, extra, ttl
+
+
+class BuildProgress(threading.Thread):
+    """Print the server's progress message for running index builds."""
+
+    def __init__(self, db, report, interval=5):
+        """init."""
+        super(BuildProgress, self).__init__()
+        self.daemon = True
+        self.db = db
+        self.report = report
+        self.interval = interval
+        self.finished = threading.Event()
+
+    def run(self):
+        """Poll currentOp until stopped."""
+        while not self.finished.wait(self.interval):
+            try:
+                ops = self.db.command("currentOp", {
+                    "$or": [
+                        {"command.createIndexes": {"$exists": True}},
+                        {"msg": {"$regex": "^Index Build"}}
+                    ]
+                }).get("inprog", [])
+            except Exception:
+                continue
+            for op in ops:
+                if "msg" in op:
+                    self.report("    {0}: {1}".format(op.get("ns"),
+                                                      op["msg"]))
+
+
+def create(documents, background=True, rebuild=False, drop_extra=False,
+           dry_run=False, report=None):
+    """
+    Bring the indexes of documents in line with their declarations.
+
+    Missing indexes are always built, and TTL changes are applied in
+    place; an index losing its TTL is dropped, and rebuilt if declared,
+    since that cannot be done in place. With rebuild, indexes whose
+    other options changed are dropped and built again; with drop_extra,
+    undeclared indexes are dropped.
+    Returns the number of indexes created, changed or dropped (or, with
+    dry_run, that would be).
+    """
+    report = report or (lambda line: None)
+    changes = 0
+    progress = None
+    if not dry_run:
+        progress = BuildProgress(get_db(), report)
+        progress.start()
+    try:
+        for position, document in enumerate(documents, 1):
+            collection = document._get_collection()
+            missing, changed, extra, ttl = plan(document)
+            changed = [change for change in changed if change not in ttl]
+            to_create = list(missing)
+            to_drop = []
+            for name, spec in list(ttl):
+                if spec is None or \
+                        spec[1].get("expireAfterSeconds") is None:
+                    ttl.remove((name, spec))
+                    to_drop.append(name)
+                    if spec is not None:
+                        to_create.append(spec)
+            if rebuild:
+                to_drop.extend(name for name, _ in changed)
+                to_create.extend(spec for _, spec in changed)
+            elif changed:
+                report("    {0} changed indexes left as they are; "
+                       "run migrate to rebuild them".format(len(changed)))
+            if drop_extra:
+                to_drop.extend(name for name in extra if name not in to_drop)
+            report("[{0}/{1}] {2}: {3} to create, {4} to drop".format(
+                position, len(documents), collection.name,
+                len(to_create), len(to_drop)))
+            for name, (keys, options) in ttl:
+                report("    expire {0} after {1}s".format(
+                    name, options["expireAfterSeconds"]))
+                changes += 1
+                if not dry_run:
+                    collection.database.command(
+                        "collMod", collection.name,
+                        index={"keyPattern": SON(keys),
+                               "expireAfterSeconds":
+                                   options["expireAfterSeconds"]})
+            for name in to_drop:
+                report("    drop {0}".format(name))
+                if not dry_run:
+                    collection.drop_index(name)
+                changes += 1
+            for keys, options in to_create:
+                options = dict(options, background=background)
+                report("    create {0} {1}".format(keys, options))
+                changes += 1
+                if dry_run:
+                    continue
+                start = time.time()
+                collection.create_index(keys, **options)
+                report("    done in {0:.1f}s".format(time.time() - start))
+    finally:
+        if progress is not None:
+            progress.finished.set()
+    return changes
+
+
+def verify(documents, report=None):
+    """Report missing or changed indexes; return how many there are."""
+    report = report or (lambda line: None)
+    problems = 0
+    for document in documents:
+        missing, changed, _, _ = plan(document)
+        for keys, options in missing:
+            report("{0}: missing index {1} {2}".format(
+                document._get_collection_name(), keys, options))
+        for name, (keys, options) in changed:
+            report("{0}: index {1} differs from {2} {3}".format(
+                document._get_collection_name(), name, keys, options))
+        problems += len(missing) + len(changed)
+    return problems
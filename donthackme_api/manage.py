@@ -0,0 +1,544 @@
+"""Management commands for the donthack.me API."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import os
+import sys
+
+from datetime import datetime, timedelta
+
+from bson import json_util
+
+from mongoengine.connection import get_db
+
+from donthackme_api import indexes
+from donthackme_api import mongo
+from donthackme_api import partitions
+from donthackme_api import retention
+
+
+def report(line):
+    """Print a progress line straight away."""
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def select_documents(names):
+    """Return the documents whose collection is in names (or all)."""
+    documents = sorted(mongo.documents(),
+                       key=partitions.base_collection_name)
+    if names:
+        documents = [doc for doc in documents
+                     if partitions.base_collection_name(doc) in names]
+    return documents
+
+
+def partitioned_documents():
+    """Return the documents stored in time partitions."""
+    return [doc for doc in select_documents(None)
+            if issubclass(doc, partitions.PartitionedDocument)]
+
+
+def each_partition(documents):
+    """
+    Yield (suffix, documents) for the base collections and every partition.
+
+    The suffix is active while the caller handles each pair.
+    """
+    yield None, documents
+    if not partitions.ROUTER.enabled:
+        return
+    suffixes = set()
+    for document in documents:
+        if issubclass(document, partitions.PartitionedDocument):
+            suffixes.update(partitions.ROUTER.existing(
+                partitions.base_collection_name(document)))
+    for suffix in sorted(suffixes):
+        with partitions.use(suffix):
+            yield suffix, [
+                doc for doc in documents
+                if issubclass(doc, partitions.PartitionedDocument) and
+                suffix in partitions.ROUTER.existing(
+                    partitions.base_collection_name(doc))]
+
+
+def indexes_command(app, args):
+    """Create, verify or migrate the indexes declared in models.py."""
+    documents = select_documents(args.collection)
+    if args.action == "verify":
+        problems = 0
+        for _, selected in each_partition(documents):
+            problems += indexes.verify(selected, report)
+        report("{0} missing or changed indexes.".format(problems))
+        return 1 if problems else 0
+
+    changes = 0
+    for _, selected in each_partition(documents):
+        changes += indexes.create(
+            selected,
+            background=not args.foreground,
+            rebuild=args.action == "migrate",
+            drop_extra=args.action == "migrate" and args.drop_extra,
+            dry_run=args.dry_run,
+            report=report
+        )
+    report("{0} index changes{1}.".format(
+        changes, " planned" if args.dry_run else ""))
+    return 0
+
+
+def partitions_command(app, args):
+    """List, pre-create, drop or compact time partitions."""
+    router = partitions.ROUTER
+    if not router.enabled:
+        report("PARTITION_SCHEME is not set; nothing is partitioned.")
+        return 1
+    documents = partitioned_documents()
+    db = get_db()
+
+    if args.action == "ensure":
+        now = datetime.utcnow()
+        suffixes = [router.suffix_for(now)]
+        for _ in range(args.ahead):
+            suffixes.append(router.suffix_for(
+                router.bounds(suffixes[-1])[1]))
+        for suffix in suffixes:
+            with partitions.use(suffix):
+                for document in documents:
+                    # Creates the collection and any missing indexes.
+                    name = document._get_collection_name()
+                    partitions.create(document, db[name])
+                    report("{0} ready".format(name))
+        return 0
+
+    if args.action == "drop" and args.before is None:
+        report("drop needs --before DATE.")
+        return 1
+    before = None
+    if args.before is not None:
+        before = partitions.to_datetime(args.before)
+
+    for document in documents:
+        base = partitions.base_collection_name(document)
+        for suffix in router.existing(base):
+            name = "{0}_{1}".format(base, suffix)
+            start, end = router.bounds(suffix)
+            if args.action == "list":
+                stats = db.command("collstats", name)
+                report("{0}  {1:%Y-%m-%d} - {2:%Y-%m-%d}  {3} documents, "
+                       "{4} bytes".format(name, start, end, stats["count"],
+                                          stats.get("storageSize", 0)))
+            elif args.action == "drop":
+                if end > before:
+                    continue
+                if args.yes:
+                    db.drop_collection(name)
+                    report("dropped {0}".format(name))
+                else:
+                    report("would drop {0}".format(name))
+            elif args.action == "compact":
+                if before is not None and end > before:
+                    continue
+                report("compacting {0}".format(name))
+                db.command("compact", name)
+    partitions.reset()
+    if args.action == "drop" and not args.yes:
+        report("Nothing dropped; pass --yes to drop these partitions.")
+    return 0
+
+
+def retention_command(app, args):
+    """Apply TTL retention, archive old sessions or read the archive."""
+    if args.action == "lookup":
+        if not args.session:
+            report("lookup needs a session id.")
+            return 1
+        documents = retention.archive().lookup(args.session,
+                                               args.sensor_name)
+        for document in documents:
+            report(json_util.dumps(document, indent=2))
+        return 0 if documents else 1
+
+    if args.action == "archive":
+        if args.older_than is not None:
+            before = datetime.utcnow() - timedelta(days=args.older_than)
+        else:
+            before = retention.POLICY.archive_cutoff()
+        if before is None:
+            report("No retention is configured for sessions or their "
+                   "children; pass --older-than to archive anyway.")
+            return 0
+        total = retention.archive_sessions(before, args.batch_size, report)
+        report("{0} sessions started before {1:%Y-%m-%d %H:%M} "
+               "archived.".format(total, before))
+        return 0
+
+    changes = 0
+    for _, selected in each_partition(select_documents(None)):
+        changes += indexes.create(selected, report=report)
+    report("{0} index changes.".format(changes))
+    retention.strip_ttylogs(report)
+    return 0
+
+
+def blobs_command(app, args):
+    """Report on, recount or garbage collect the blob store."""
+    from donthackme_api import blobstore
+    from donthackme_api.models import Blob
+
+    if args.action == "recount":
+        changed = blobstore.recount(report)
+        report("{0} reference counts corrected.".format(changed))
+        return 0
+    if args.action == "gc":
+        if args.recount:
+            blobstore.recount(report)
+        blobstore.collect(timedelta(hours=args.grace), report)
+        return 0
+
+    stats = list(Blob._get_collection().aggregate([{"$group": {
+        "_id": None,
+        "blobs": {"$sum": 1},
+        "bytes": {"$sum": "$size"},
+        "refs": {"$sum": "$refs"},
+        "referenced_bytes": {"$sum": {"$multiply": ["$size", "$refs"]}},
+        "unreferenced": {"$sum": {"$cond": [{"$lte": ["$refs", 0]}, 1, 0]}}
+    }}]))
+    if not stats:
+        report("The blob store is empty.")
+        return 0
+    stats = stats[0]
+    report("{0} blobs, {1} bytes stored for {2} references to {3} "
+           "bytes ({4:.1f}x); {5} unreferenced.".format(
+               stats["blobs"], stats["bytes"], stats["refs"],
+               stats["referenced_bytes"],
+               float(stats["referenced_bytes"]) / (stats["bytes"] or 1),
+               stats["unreferenced"]))
+    return 0
+
+
+def search_command(app, args):
+    """Index stored commands, or sign stored sessions, for search."""
+    if args.action == "signatures":
+        return signatures_command(app, args)
+    if args.action == "clients":
+        return clients_command(app, args)
+
+    from donthackme_api.models import Command
+    from donthackme_api.search import index
+
+    pipeline = [{"$group": {
+        "_id": "$command",
+        "first_seen": {"$min": "$timestamp"},
+        "last_seen": {"$max": "$timestamp"},
+        "count": {"$sum": 1}
+    }}]
+    seen = added = 0
+    for suffix in partitions.ROUTER.partitions(Command):
+        with partitions.use(suffix):
+            report("{0}:".format(Command._get_collection_name()))
+            for group in Command._get_collection().aggregate(
+                    pipeline, allowDiskUse=True):
+                if not group["_id"]:
+                    continue
+                seen += 1
+                added += index.backfill_command(
+                    group["_id"], group["first_seen"], group["last_seen"],
+                    group["count"])
+                if seen % 10000 == 0:
+                    report("    {0} commands, {1} new".format(seen, added))
+    report("{0} distinct commands, {1} newly indexed.".format(seen, added))
+    return 0
+
+
+def signatures_command(app, args):
+    """Store the similarity signature of every closed session."""
+    from donthackme_api.models import Session
+    from donthackme_api.search import minhash
+
+    signed = seen = 0
+    for suffix in partitions.ROUTER.partitions(Session):
+        with partitions.use(suffix):
+            report("{0}:".format(Session._get_collection_name()))
+            for session in Session.objects(end_time__ne=None).only(
+                    "id").order_by("start_time"):
+                seen += 1
+                signed += minhash.record_session(
+                    session.id,
+                    app.config.get("SIMILARITY_THRESHOLD", 0.5),
+                    app.config.get("SIMILARITY_MAX_CANDIDATES", 1000)
+                ) is not None
+                if seen % 10000 == 0:
+                    report("    {0} sessions, {1} signed".format(seen,
+                                                                signed))
+    report("{0} closed sessions, {1} signed.".format(seen, signed))
+    return 0
+
+
+def clients_command(app, args):
+    """Fingerprint stored sessions and rebuild the client catalog."""
+    from pymongo import UpdateOne
+
+    from donthackme_api import hassh
+    from donthackme_api.models import Session
+
+    fields = dict((name, True) for name in (
+        "ssh_kexAlgs", "ssh_encCS", "ssh_macCS", "ssh_compCS"))
+    groups = {}
+    for suffix in partitions.ROUTER.partitions(Session):
+        with partitions.use(suffix):
+            collection = Session._get_collection()
+            report("{0}:".format(Session._get_collection_name()))
+            updates = []
+            for session in collection.find({
+                    "ssh_kexAlgs.0": {"$exists": True},
+                    "ssh_hassh": None}, fields):
+                updates.append(UpdateOne(
+                    {"_id": session["_id"]},
+                    {"$set": {"ssh_hassh": hassh.from_session(session)[0]}}))
+                if len(updates) == 1000:
+                    collection.bulk_write(updates, ordered=False)
+                    updates = []
+            if updates:
+                collection.bulk_write(updates, ordered=False)
+            for group in collection.aggregate([
+                    {"$match": {"ssh_hassh": {"$ne": None},
+                                "start_time": {"$ne": None}}},
+                    {"$group": {
+                        "_id": "$ssh_hassh",
+                        "kex": {"$first": "$ssh_kexAlgs"},
+                        "enc": {"$first": "$ssh_encCS"},
+                        "mac": {"$first": "$ssh_macCS"},
+                        "comp": {"$first": "$ssh_compCS"},
+                        "sessions": {"$sum": 1},
+                        "first_seen": {"$min": "$start_time"},
+                        "last_seen": {"$max": "$start_time"},
+                        "versions": {"$addToSet": "$ssh_version"}
+                    }}], allowDiskUse=True):
+                total = groups.get(group["_id"])
+                if total is None:
+                    group["algorithms"] = hassh.algorithms(
+                        group["kex"], group["enc"], group["mac"],
+                        group["comp"])
+                    groups[group["_id"]] = group
+                    continue
+                total["sessions"] += group["sessions"]
+                total["first_seen"] = min(total["first_seen"],
+                                          group["first_seen"])
+                total["last_seen"] = max(total["last_seen"],
+                                         group["last_seen"])
+                total["versions"] = list(set(total["versions"]) |
+                                         set(group["versions"]))
+    for group in groups.values():
+        hassh.backfill(group)
+    report("{0} client fingerprints catalogued.".format(len(groups)))
+    return 0
+
+
+def import_command(app, args):
+    """Import Cowrie JSON log files, in parallel, without the API."""
+    from donthackme_api.importer import Importer
+
+    missing = [path for path in args.files if not os.path.exists(path)]
+    if missing:
+        report("No such file: {0}".format(", ".join(missing)))
+        return 1
+    importer = Importer(
+        app,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        checkpoint_every=args.checkpoint_every,
+        checkpoint=args.checkpoint,
+        report=report
+    )
+    try:
+        importer.run(args.files)
+    except RuntimeError as e:
+        report(str(e))
+        return 1
+    return 0
+
+
+def build_parser():
+    """Build the argument parser for every command."""
+    parser = argparse.ArgumentParser(
+        prog="python -m donthackme_api.manage",
+        description=__doc__
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    parser_indexes = commands.add_parser(
+        "indexes",
+        help=indexes_command.__doc__
+    )
+    parser_indexes.add_argument(
+        "action",
+        choices=["create", "verify", "migrate"],
+        help="create: build missing indexes; verify: report missing or "
+             "changed indexes; migrate: also rebuild changed ones"
+    )
+    parser_indexes.add_argument(
+        "--collection", action="append",
+        help="Only this collection (repeatable)"
+    )
+    parser_indexes.add_argument(
+        "--foreground", action="store_true",
+        help="Build in the foreground (faster, blocks the collection)"
+    )
+    parser_indexes.add_argument(
+        "--drop-extra", action="store_true",
+        help="migrate: drop indexes that models.py no longer declares"
+    )
+    parser_indexes.add_argument(
+        "--dry-run", action="store_true",
+        help="Only print what would change"
+    )
+    parser_indexes.set_defaults(func=indexes_command)
+
+    parser_partitions = commands.add_parser(
+        "partitions",
+        help=partitions_command.__doc__
+    )
+    parser_partitions.add_argument(
+        "action",
+        choices=["list", "ensure", "drop", "compact"],
+        help="list: show partitions and their size; ensure: create the "
+             "current and upcoming partitions; drop: drop partitions that "
+             "end before --before; compact: compact partitions (all, or "
+             "those ending before --before)"
+    )
+    parser_partitions.add_argument(
+        "--ahead", type=int, default=1,
+        help="ensure: number of upcoming partitions to create"
+    )
+    parser_partitions.add_argument(
+        "--before",
+        help="Only partitions whose period ends before this date"
+    )
+    parser_partitions.add_argument(
+        "--yes", action="store_true",
+        help="drop: really drop, instead of listing what would be dropped"
+    )
+    parser_partitions.set_defaults(func=partitions_command)
+
+    parser_retention = commands.add_parser(
+        "retention",
+        help=retention_command.__doc__
+    )
+    parser_retention.add_argument(
+        "action",
+        choices=["apply", "archive", "lookup"],
+        help="apply: set TTL indexes from RETENTION_DAYS and remove old "
+             "TTY logs of archived sessions; archive: archive sessions "
+             "before they expire; lookup: print archived sessions"
+    )
+    parser_retention.add_argument(
+        "session", nargs="?",
+        help="lookup: the cowrie session id"
+    )
+    parser_retention.add_argument(
+        "--sensor-name",
+        help="lookup: only sessions of this sensor"
+    )
+    parser_retention.add_argument(
+        "--older-than", type=float,
+        help="archive: sessions started more than this many days ago, "
+             "instead of RETENTION_DAYS less the lead time"
+    )
+    parser_retention.add_argument(
+        "--batch-size", type=int, default=100,
+        help="archive: sessions per batch"
+    )
+    parser_retention.set_defaults(func=retention_command)
+
+    parser_blobs = commands.add_parser(
+        "blobs",
+        help=blobs_command.__doc__
+    )
+    parser_blobs.add_argument(
+        "action",
+        choices=["stats", "recount", "gc"],
+        help="stats: size and deduplication ratio; recount: correct "
+             "reference counts from the documents using blobs; gc: "
+             "remove unreferenced blobs"
+    )
+    parser_blobs.add_argument(
+        "--recount", action="store_true",
+        help="gc: recount references first, for blobs of dropped "
+             "partitions or expired sessions"
+    )
+    parser_blobs.add_argument(
+        "--grace", type=float, default=1,
+        help="gc: keep blobs referenced within this many hours"
+    )
+    parser_blobs.set_defaults(func=blobs_command)
+
+    parser_search = commands.add_parser(
+        "search",
+        help=search_command.__doc__
+    )
+    parser_search.add_argument(
+        "action",
+        choices=["backfill", "signatures", "clients"],
+        help="backfill: add existing commands to the search index; "
+             "signatures: compute similarity signatures of existing "
+             "closed sessions, oldest first; clients: fingerprint existing "
+             "sessions and rebuild the client catalog"
+    )
+    parser_search.set_defaults(func=search_command)
+
+    parser_import = commands.add_parser(
+        "import",
+        help=import_command.__doc__
+    )
+    parser_import.add_argument(
+        "files", nargs="+",
+        help="cowrie.json log files, plain or gzipped, oldest first"
+    )
+    parser_import.add_argument(
+        "--workers", type=int,
+        help="Worker processes (default: one per CPU)"
+    )
+    parser_import.add_argument(
+        "--batch-size", type=int, default=1000,
+        help="Events per bulk write"
+    )
+    parser_import.add_argument(
+        "--checkpoint",
+        help="File recording progress; a run given the same file resumes "
+             "where the last one stopped"
+    )
+    parser_import.add_argument(
+        "--checkpoint-every", type=int, default=50000,
+        help="Events between checkpoints and progress reports"
+    )
+    parser_import.set_defaults(func=import_command)
+
+    return parser
+
+
+def main(argv=None):
+    """Run a management command against the configured database."""
+    from donthackme_api.app import create_app
+
+    args = build_parser().parse_args(argv)
+    app = create_app(app_name="donthackme_manage")
+    with app.app_context():
+        return args.func(app, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,577 @@
+"""Prometheus-style metrics shared across uWSGI worker processes."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import g, request
+
+from pymongo import monitoring
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+FILE_PATTERN = "metrics-{0}.json"
+
+
+class Registry(object):
+    """
+    Per-process store of counters, gauges and histograms.
+
+    Each worker periodically writes its own values to
+    ``<directory>/metrics-<pid>.json``; rendering merges every file in
+    the directory so that a scrape of any one worker reports the totals
+    for all of them. Gauges are only summed over workers that are still
+    running, counters and histograms over every file.
+    """
+
+    def __init__(self):
+        """init."""
+        self.directory = None
+        self.flush_interval = 5
+        self._lock = threading.Lock()
+        self._collectors = []
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._buckets = {}
+        self._help = {}
+        self._last_flush = 0
+        self._dirty = False
+
+    def _check_fork(self):
+        """Start from zero in a freshly forked worker."""
+        if self._pid != os.getpid():
+            help_text = self._help
+            self._reset()
+            self._help = help_text
+
+    def describe(self, name, help_text):
+        """Register the HELP text for a metric."""
+        self._help[name] = help_text
+
+    def add_collector(self, collector):
+        """
+        Register a function that measures gauges at scrape time.
+
+        collector() returns [(name, labels, value)]. It is meant for
+        values shared by every worker, such as a count in the database,
+        which must not be summed per process.
+        """
+        self._collectors.append(collector)
+
+    def inc(self, name, labels=None, amount=1):
+        """Increment a counter."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_fork()
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._dirty = True
+
+    def set_gauge(self, name, value, labels=None):
+        """Set a gauge to value."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_fork()
+            self._gauges[key] = value
+            self._dirty = True
+
+    def inc_gauge(self, name, labels=None, amount=1):
+        """Move a gauge up (or down, with a negative amount)."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_fork()
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+            self._dirty = True
+
+    def observe(self, name, value, labels=None, buckets=DEFAULT_BUCKETS):
+        """Record a value in a histogram."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_fork()
+            self._buckets.setdefault(name, tuple(buckets))
+            bounds = self._buckets[name]
+            series = self._histograms.get(key)
+            if series is None:
+                # bucket counts, then sum, then count
+                series = [0] * (len(bounds) + 2)
+                self._histograms[key] = series
+            for index, bound in enumerate(bounds):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+            self._dirty = True
+
+    def total(self, name):
+        """Sum a counter, or a histogram's count, over this process."""
+        with self._lock:
+            self._check_fork()
+            total = sum(value for (key, _), value in self._counters.items()
+                        if key == name)
+            total += sum(series[-1] for (key, _), series in
+                         self._histograms.items() if key == name)
+            return total
+
+    def snapshot(self):
+        """Return this process's values in a json-serializable form."""
+        with self._lock:
+            self._check_fork()
+            return {
+                "pid": self._pid,
+                "counters": [[name, list(labels), value] for
+                             (name, labels), value in
+                             self._counters.items()],
+                "gauges": [[name, list(labels), value] for
+                           (name, labels), value in
+                           self._gauges.items()],
+                "histograms": [[name, list(labels), list(series)] for
+                               (name, labels), series in
+                               self._histograms.items()],
+                "buckets": dict((name, list(bounds)) for
+                                name, bounds in self._buckets.items())
+            }
+
+    def flush(self, force=False):
+        """Write this process's values to the shared directory."""
+        if self.directory is None:
+            return
+        now = time.time()
+        if not force and (not self._dirty or
+                          now - self._last_flush < self.flush_interval):
+            return
+        self._last_flush = now
+        self._dirty = False
+        data = self.snapshot()
+        path = os.path.join(self.directory,
+                            FILE_PATTERN.format(os.getpid()))
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as tmp:
+            json.dump(data, tmp)
+        os.rename(tmp_path, path)
+
+    def collect(self):
+        """Merge the values of every worker process."""
+        if self.directory is None:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush(force=True)
+            snapshots = []
+            pattern = os.path.join(self.directory, FILE_PATTERN.format("*"))
+            for path in glob.glob(pattern):
+                try:
+                    with open(path) as handle:
+                        snapshots.append(json.load(handle))
+                except (IOError, ValueError):
+                    continue
+
+        counters = {}
+        gauges = {}
+        histograms = {}
+        buckets = {}
+        for data in snapshots:
+            buckets.update(data.get("buckets", {}))
+            for name, labels, value in data.get("counters", []):
+                key = (name, _label_key(labels))
+                counters[key] = counters.get(key, 0) + value
+            if _pid_alive(data.get("pid")):
+                for name, labels, value in data.get("gauges", []):
+                    key = (name, _label_key(labels))
+                    gauges[key] = gauges.get(key, 0) + value
+            for name, labels, series in data.get("histograms", []):
+                key = (name, _label_key(labels))
+                merged = histograms.get(key)
+                if merged is None:
+                    histograms[key] = list(series)
+                else:
+                    histograms[key] = [a + b for a, b in zip(merged, series)]
+        return counters, gauges, histograms, buckets
+
+    def render(self):
+        """Render the merged values in the Prometheus text format."""
+        counters, gauges, histograms, buckets = self.collect()
+        lines = []
+
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            by_name = {}
+            for (name, labels), value in values.items():
+                by_name.setdefault(name, []).append((labels, value))
+            for name in sorted(by_name):
+                self._header(lines, name, kind)
+                for labels, value in sorted(by_name[name]):
+                    lines.append("{0}{1} {2}".format(
+                        name, _format_labels(labels), _format_value(value)))
+
+        by_name = {}
+        for (name, labels), series in histograms.items():
+            by_name.setdefault(name, []).append((labels, series))
+        for name in sorted(by_name):
+            self._header(lines, name, "histogram")
+            bounds = buckets.get(name, DEFAULT_BUCKETS)
+            for labels, series in sorted(by_name[name]):
+                cumulative = 0
+                for bound, count in zip(bounds, series):
+                    cumulative += count
+                    bucket_labels = labels + (("le", _format_value(bound)),)
+                    lines.append("{0}_bucket{1} {2}".format(
+                        name, _format_labels(bucket_labels), cumulative))
+                inf_labels = labels + (("le", "+Inf"),)
+                lines.append("{0}_bucket{1} {2}".format(
+                    name, _format_labels(inf_labels), series[-1]))
+                lines.append("{0}_sum{1} {2}".format(
+                    name, _format_labels(labels), _format_value(series[-2])))
+                lines.append("{0}_count{1} {2}".format(
+                    name, _format_labels(labels), series[-1]))
+
+        self._render_cache_ratios(lines, counters)
+        self._render_collectors(lines)
+        return "\n".join(lines) + "\n"
+
+    def _render_collectors(self, lines):
+        by_name = {}
+        for collector in self._collectors:
+            try:
+                values = collector()
+            except Exception:
+                # A scrape still reports everything else.
+                continue
+            for name, labels, value in values:
+                by_name.setdefault(name, []).append(
+                    (_label_key(labels), value))
+        for name in sorted(by_name):
+            self._header(lines, name, "gauge")
+            for labels, value in sorted(by_name[name]):
+                lines.append("{0}{1} {2}".format(
+                    name, _format_labels(labels), _format_value(value)))
+
+    def _render_cache_ratios(self, lines, counters):
+        totals = {}
+        for (name, labels), value in counters.items():
+            if name != "donthackme_cache_requests_total":
+                continue
+            labels = dict(labels)
+            hits, lookups = totals.get(labels["cache"], (0, 0))
+            if labels["result"] == "hit":
+                hits += value
+            totals[labels["cache"]] = (hits, lookups + value)
+        if not totals:
+            return
+        name = "donthackme_cache_hit_ratio"
+        self._header(lines, name, "gauge")
+        for cache in sorted(totals):
+            hits, lookups = totals[cache]
+            lines.append("{0}{1} {2}".format(
+                name,
+                _format_labels((("cache", cache),)),
+                _format_value(float(hits) / lookups if lookups else 0.0)))
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append("# HELP {0} {1}".format(name, self._help[name]))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+
+
+def _pid_alive(pid):
+    if pid is None:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _label_key(labels):
+    if not labels:
+        return ()
+    if isinstance(labels, dict):
+        labels = labels.items()
+    return tuple(sorted((str(k), str(v)) for k, v in labels))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = value.replace("\\", "\\\\").replace("\n", "\\n")
+        pairs.append('{0}="{1}"'.format(key, value.replace('"', '\\"')))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+REGISTRY.describe("donthackme_http_requests_total",
+                  "HTTP requests by route, method and status.")
+REGISTRY.describe("donthackme_http_request_duration_seconds",
+                  "HTTP request latency by route and method.")
+REGISTRY.describe("donthackme_event_duration_seconds",
+                  "Ingest latency by cowrie event type.")
+REGISTRY.describe("donthackme_mongo_command_duration_seconds",
+                  "MongoDB command latency by collection and operation.")
+REGISTRY.describe("donthackme_mongo_command_errors_total",
+                  "Failed MongoDB commands by collection and operation.")
+REGISTRY.describe("donthackme_mongo_pool_checkout_wait_seconds",
+                  "Time spent waiting for a pooled MongoDB connection.")
+REGISTRY.describe("donthackme_mongo_pool_connections_in_use",
+                  "Pooled MongoDB connections currently checked out.")
+REGISTRY.describe("donthackme_mongo_pool_checkout_failures_total",
+                  "Failed MongoDB connection checkouts by reason.")
+REGISTRY.describe("donthackme_cache_requests_total",
+                  "Cache lookups by cache and result.")
+REGISTRY.describe("donthackme_cache_hit_ratio",
+                  "Share of cache lookups answered from the cache.")
+
+
+def set_gauge(name, value, labels=None):
+    """Set a gauge in the process registry."""
+    REGISTRY.set_gauge(name, value, labels)
+
+
+def inc(name, labels=None, amount=1):
+    """Increment a counter in the process registry."""
+    REGISTRY.inc(name, labels, amount)
+
+
+def observe(name, value, labels=None, buckets=DEFAULT_BUCKETS):
+    """Record a histogram value in the process registry."""
+    REGISTRY.observe(name, value, labels, buckets)
+
+
+def cache_lookup(cache, hit):
+    """Count a cache lookup."""
+    REGISTRY.inc("donthackme_cache_requests_total", {
+        "cache": cache,
+        "result": "hit" if hit else "miss"
+    })
+
+
+def event_type(rule):
+    """
+    Map an events blueprint route to its cowrie event id.
+
+    /events/login/failed -> cowrie.login.failed
+    """
+    if rule is None or not rule.startswith("/events/"):
+        return None
+    return "cowrie." + rule[len("/events/"):].replace("/", ".")
+
+
+class CommandListener(monitoring.CommandListener):
+    """Time every MongoDB command by collection and operation."""
+
+    def __init__(self):
+        """init."""
+        self._inflight = {}
+
+    def started(self, event):
+        """Remember which collection a command targets."""
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, basestring):
+            collection = ""
+        self._inflight[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        """Record the duration of a successful command."""
+        labels = self._labels(event)
+        observe("donthackme_mongo_command_duration_seconds",
+                event.duration_micros / 1e6, labels)
+
+    def failed(self, event):
+        """Record the duration and failure of a command."""
+        labels = self._labels(event)
+        observe("donthackme_mongo_command_duration_seconds",
+                event.duration_micros / 1e6, labels)
+        inc("donthackme_mongo_command_errors_total", labels)
+
+    def _labels(self, event):
+        collection = self._inflight.pop(
+            (event.connection_id, event.request_id), "")
+        return {"collection": collection, "command": event.command_name}
+
+
+class PoolStats(object):
+    """Connection pool usage for this process, as seen by PoolListener."""
+
+    def __init__(self, window=256):
+        """init."""
+        self.in_use = 0
+        self.waits = []
+        self.window = window
+        self._lock = threading.Lock()
+
+    def checked_out(self, wait):
+        """Record a checkout that waited ``wait`` seconds."""
+        with self._lock:
+            self.in_use += 1
+            self.waits.append(wait)
+            if len(self.waits) > self.window:
+                del self.waits[:-self.window]
+        set_gauge("donthackme_mongo_pool_connections_in_use", self.in_use)
+        observe("donthackme_mongo_pool_checkout_wait_seconds", wait)
+
+    def checked_in(self):
+        """Record a connection returned to the pool."""
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+        set_gauge("donthackme_mongo_pool_connections_in_use", self.in_use)
+
+    def to_dict(self):
+        """Summarize the recent checkout waits of this process."""
+        with self._lock:
+            waits = sorted(self.waits)
+            in_use = self.in_use
+        response = {"in_use": in_use, "recent_checkouts": len(waits)}
+        if waits:
+            response["wait_ms"] = {
+                "mean": 1000.0 * sum(waits) / len(waits),
+                "p95": 1000.0 * waits[int(0.95 * (len(waits) - 1))],
+                "max": 1000.0 * waits[-1]
+            }
+        return response
+
+
+POOL_STATS = PoolStats()
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """Track checkout wait times and connections in use."""
+
+    def __init__(self):
+        """init."""
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        """Start timing a checkout."""
+        self._local.started = time.time()
+
+    def connection_checked_out(self, event):
+        """Record how long the checkout waited."""
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        wait = time.time() - started if started is not None else 0.0
+        POOL_STATS.checked_out(wait)
+
+    def connection_check_out_failed(self, event):
+        """Count a checkout that timed out or hit a closed pool."""
+        self._local.started = None
+        inc("donthackme_mongo_pool_checkout_failures_total", {
+            "reason": event.reason
+        })
+
+    def connection_checked_in(self, event):
+        """Record a connection returned to the pool."""
+        POOL_STATS.checked_in()
+
+    def pool_created(self, event):
+        """Not tracked."""
+
+    def pool_cleared(self, event):
+        """Not tracked."""
+
+    def pool_closed(self, event):
+        """Not tracked."""
+
+    def connection_created(self, event):
+        """Not tracked."""
+
+    def connection_ready(self, event):
+        """Not tracked."""
+
+    def connection_closed(self, event):
+        """Not tracked."""
+
+
+_listener_registered = False
+
+
+def register_listeners():
+    """
+    Register the MongoDB command and connection pool listeners.
+
+    Must run before the MongoClient is created, as pymongo only applies
+    global listeners to clients constructed afterwards.
+    """
+    global _listener_registered
+    if not _listener_registered:
+        monitoring.register(CommandListener())
+        monitoring.register(PoolListener())
+        _listener_registered = True
+
+
+def _start_timer():
+    g.metrics_start = time.time()
+
+
+def _record_request(response):
+    start = getattr(g, "metrics_start", None)
+    if start is None:
+        return response
+    elapsed = time.time() - start
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+
+    inc("donthackme_http_requests_total", {
+        "route": rule,
+        "method": request.method,
+        "status": response.status_code
+    })
+    observe("donthackme_http_request_duration_seconds", elapsed, {
+        "route": rule,
+        "method": request.method
+    })
+    event = event_type(rule)
+    if event is not None:
+        observe("donthackme_event_duration_seconds", elapsed, {
+            "event": event
+        })
+    REGISTRY.flush()
+    return response
+
+
+def init_app(app):
+    """Attach request timing to the app and configure aggregation."""
+    directory = app.config.get("METRICS_DIR")
+    if directory:
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        REGISTRY.directory = directory
+    REGISTRY.flush_interval = app.config.get("METRICS_FLUSH_INTERVAL", 5)
+
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
@@ -25,10 +25,17 @@ from datetime import datetime
 from flask import current_app
 
 from passlib.apps import custom_app_context as pwd_context
+
+from donthackme_api.partitions import PartitionedDocument
 from itsdangerous import (TimedJSONWebSignatureSerializer
                           as Serializer, BadSignature, SignatureExpired)
 
 
+# Indexes are built ahead of deploys with
+# ``python -m donthackme_api.manage indexes migrate``, never implicitly by a
+# worker on its first access to a collection.
+
+
 class User(me.Document):
     """User Document for Auth."""
 
@@ -57,6 +64,7 @@ class User(me.Document):
     )
 
     meta = {
+        "auto_create_index": False,
         "indexes": [
             {"fields": ["username", "deleted"], "unique": True},
             {"fields": ["email", "deleted"], "unique": True},
@@ -158,7 +166,10 @@ class TransactionLog(me.Document):
     doc_id = me.DynamicField()
     ts = me.SequenceField()
 
-    meta = {"max_documents": 100000}
+    meta = {
+        "max_documents": 100000,
+        "auto_create_index": False
+    }
 
 
 class Sensor(me.Document):
@@ -167,10 +178,16 @@ class Sensor(me.Document):
     timestamp = me.DateTimeField(required=True)
     name = me.StringField(required=True)
     ip = me.StringField()
+    # Written in bulk by each worker every HEARTBEAT_FLUSH_INTERVAL.
+    last_seen = me.DateTimeField()
+    # Events received, by event id with "." replaced by "_".
+    event_counts = me.DictField()
 
     meta = {
+        "auto_create_index": False,
         "indexes": [
             {"fields": ["ip"], "unique": True},
+            {"fields": ["name"]},
         ]
     }
 
@@ -179,6 +196,8 @@ class Sensor(me.Document):
         response = self.to_mongo()
 
         response["timestamp"] = self.timestamp.isoformat()
+        if self.last_seen is not None:
+            response["last_seen"] = self.last_seen.isoformat()
         response.pop("_id", None)
         return response
 
@@ -187,7 +206,7 @@ class Sensor(me.Document):
         return json.dumps(self.to_dict())
 
 
-class Command(me.Document):
+class Command(PartitionedDocument, me.Document):
     """Command Subdocument (Listed)."""
 
     session = me.ReferenceField('Session')
@@ -198,6 +217,7 @@ class Command(me.Document):
     success = me.BooleanField()
 
     meta = {
+        "auto_create_index": False,
         "indexes": [
             {"fields": ["session"]},
             {"fields": ["command"]},
@@ -213,6 +233,8 @@ class Command(me.Document):
         response["timestamp"] = self.timestamp.isoformat()
         response.pop("_id", None)
         response.pop("sensor_ip", None)
+        if "session" in response:
+            response["session"] = str(response["session"])
         return response
 
     def to_json(self):
@@ -220,7 +242,7 @@ class Command(me.Document):
         return json.dumps(self.to_dict())
 
 
-class Credentials(me.Document):
+class Credentials(PartitionedDocument, me.Document):
     """Credential Subdocument."""
 
     session = me.ReferenceField('Session')
@@ -232,6 +254,7 @@ class Credentials(me.Document):
     timestamp = me.DateTimeField()
 
     meta = {
+        "auto_create_index": False,
         "indexes": [
             {"fields": ["session"]},
             {"fields": ["success"]},
@@ -247,6 +270,8 @@ class Credentials(me.Document):
         response["timestamp"] = self.timestamp.isoformat()
         response.pop("_id", None)
         response.pop("sensor_ip", None)
+        if "session" in response:
+            response["session"] = str(response["session"])
         return response
 
     def to_json(self):
@@ -265,6 +290,7 @@ class Fingerprint(me.Document):
     timestamp = me.DateTimeField()
 
     meta = {
+        "auto_create_index": False,
         "indexes": [
             {"fields": ["session"]},
             {"fields": ["username"]},
@@ -279,6 +305,8 @@ class Fingerprint(me.Document):
         response["timestamp"] = self.timestamp.isoformat()
         response.pop("_id", None)
         response.pop("sensor_ip", None)
+        if "session" in response:
+            response["session"] = str(response["session"])
         return response
 
     def to_json(self):
@@ -294,14 +322,18 @@ class Download(me.Document):
     sensor_ip = me.StringField()
     timestamp = me.DateTimeField()
     realm = me.StringField()
+    # sha256 of the file, under which the blob store keeps it when the
+    # sensor uploads it to /events/artifacts.
     shasum = me.StringField()
     url = me.StringField()
     outfile = me.StringField()
 
     meta = {
+        "auto_create_index": False,
         "indexes": [
             {"fields": ["session"]},
-            {"fields": ["timestamp"]}
+            {"fields": ["timestamp"]},
+            {"fields": ["shasum"]}
         ]
     }
 
@@ -312,6 +344,8 @@ class Download(me.Document):
         response["timestamp"] = self.timestamp.isoformat()
         response.pop("_id", None)
         response.pop("sensor_ip", None)
+        if "session" in response:
+            response["session"] = str(response["session"])
         return response
 
     def to_json(self):
@@ -329,6 +363,8 @@ class TcpConnection(me.Document):
     dest_port = me.IntField()
     dest_ip = me.StringField()
 
+    meta = {"auto_create_index": False}
+
     def to_dict(self):
         """Convert object to a sanitized python dictionary."""
         response = self.to_mongo()
@@ -336,6 +372,8 @@ class TcpConnection(me.Document):
         response["timestamp"] = self.timestamp.isoformat()
         response.pop("_id", None)
         response.pop("sensor_ip", None)
+        if "session" in response:
+            response["session"] = str(response["session"])
         return response
 
     def to_json(self):
@@ -355,10 +393,13 @@ class TtyLog(me.EmbeddedDocument):
 
     size = me.IntField()
     log_location = me.StringField()
+    # The log is kept in the blob store under its sha256; log_binary only
+    # holds logs stored before that.
+    sha256 = me.StringField()
     log_binary = me.BinaryField()
 
 
-class Session(me.Document):
+class Session(PartitionedDocument, me.Document):
     """Main Log Entry - Cowrie."""
 
     session = me.StringField(required=True)
@@ -373,7 +414,11 @@ class Session(me.Document):
     ssh_version = me.StringField()
     ssh_kexAlgs = me.ListField(me.StringField())
     ssh_keyAlgs = me.ListField(me.StringField())
+    ssh_encCS = me.ListField(me.StringField())
     ssh_macCS = me.ListField(me.StringField())
+    ssh_compCS = me.ListField(me.StringField())
+    # HASSH of the client's algorithm lists, see hassh.py.
+    ssh_hassh = me.StringField()
 
     sensor = me.ReferenceField(Sensor)
     fingerprints = me.ListField(me.ReferenceField(Fingerprint))
@@ -383,7 +428,12 @@ class Session(me.Document):
     downloads = me.ListField(me.ReferenceField(Download))
     tcpconnections = me.ListField(me.ReferenceField(TcpConnection))
 
+    # Set once "manage retention archive" has copied the session, with
+    # its children, to the archive.
+    archived = me.DateTimeField()
+
     meta = {
+        "auto_create_index": False,
         "indexes": [
             {
                 "fields": ["session", "sensor_ip"],
@@ -391,7 +441,8 @@ class Session(me.Document):
             },
             {"fields": ["source_ip"]},
             {"fields": ["sensor_ip"]},
-            {"fields": ["start_time"]}
+            {"fields": ["start_time"]},
+            {"fields": ["ssh_hassh", "-start_time"]}
         ]
     }
 
@@ -399,7 +450,8 @@ class Session(me.Document):
         """Convert object to a sanitized python dictionary."""
         response = self.to_mongo()
 
-        response["start_time"] = self.start_time.isoformat()
+        if "start_time" in response:
+            response["start_time"] = self.start_time.isoformat()
         if "end_time" in response:
             response["end_time"] = self.end_time.isoformat()
 
@@ -407,7 +459,8 @@ class Session(me.Document):
         if "ttylog" in response:
             response["ttylog"].pop("log_binary", None)
 
-        response["sensor"] = self.sensor.to_dict()
+        if self.sensor is not None:
+            response["sensor"] = self.sensor.to_dict()
         response["fingerprints"] = [item.to_dict() for
                                     item in self.fingerprints]
         response["commands"] = [item.to_dict() for
@@ -424,3 +477,220 @@ class Session(me.Document):
     def to_json(self):
         """Hijack class method to return our dict."""
         return json.dumps(self.to_dict())
+
+
+class PendingEvent(me.Document):
+    """Event that arrived before its session, held until it is created."""
+
+    session = me.StringField(required=True)
+    sensor_name = me.StringField()
+    event = me.StringField(required=True)
+    timestamp = me.DateTimeField()
+    received = me.DateTimeField(required=True)
+    payload = me.DictField()
+
+    meta = {
+        "auto_create_index": False,
+        "indexes": [
+            {"fields": ["session", "sensor_name", "timestamp", "received"]},
+            # Expiry is counted by pending.sweep(), well before this
+            # backstop removes anything.
+            {"fields": ["received"], "expireAfterSeconds": 86400}
+        ]
+    }
+
+
+class CommandText(me.Document):
+    """Distinct command text, the unit of the command search index."""
+
+    # sha1 of the text, so that long commands make short keys.
+    id = me.StringField(primary_key=True)
+    text = me.StringField(required=True)
+    count = me.IntField(default=0)
+    first_seen = me.DateTimeField()
+    last_seen = me.DateTimeField()
+
+    meta = {
+        "auto_create_index": False,
+        "indexes": [
+            {"fields": ["-last_seen"]}
+        ]
+    }
+
+    def to_dict(self):
+        """Convert object to a sanitized python dictionary."""
+        return {
+            "command": self.text,
+            "count": self.count,
+            "first_seen": self.first_seen.isoformat()
+            if self.first_seen else None,
+            "last_seen": self.last_seen.isoformat()
+            if self.last_seen else None
+        }
+
+
+class SearchPosting(me.Document):
+    """Entry of the inverted index: a term occurs in a command text."""
+
+    term = me.StringField(required=True)
+    text = me.StringField(required=True)
+
+    meta = {
+        "auto_create_index": False,
+        "indexes": [
+            {"fields": ["term", "text"], "unique": True}
+        ]
+    }
+
+
+class SearchTerm(me.Document):
+    """Number of command texts a search term occurs in."""
+
+    id = me.StringField(primary_key=True)
+    postings = me.IntField(default=0)
+
+    meta = {"auto_create_index": False}
+
+
+class SessionSignature(me.Document):
+    """MinHash signature of a closed session's command sequence."""
+
+    # The Session's id.
+    id = me.ObjectIdField(primary_key=True)
+    session = me.StringField(required=True)
+    sensor_name = me.StringField()
+    start_time = me.DateTimeField()
+    commands = me.IntField()
+    minhash = me.ListField(me.LongField())
+    bands = me.ListField(me.StringField())
+    # Id of the first session of the campaign this one belongs to.
+    cluster = me.ObjectIdField()
+
+    meta = {
+        "auto_create_index": False,
+        "indexes": [
+            {"fields": ["bands"]},
+            {"fields": ["cluster", "-start_time"]},
+            {"fields": ["session", "sensor_name"]},
+            {"fields": ["start_time"]}
+        ]
+    }
+
+    def to_dict(self):
+        """Convert object to a sanitized python dictionary."""
+        return {
+            "id": str(self.id),
+            "session": self.session,
+            "sensor_name": self.sensor_name,
+            "start_time": self.start_time.isoformat()
+            if self.start_time else None,
+            "commands": self.commands,
+            "cluster": str(self.cluster)
+        }
+
+
+class Blob(me.Document):
+    """Reference count of content in the blob store, keyed by sha256."""
+
+    id = me.StringField(primary_key=True)
+    size = me.IntField()
+    refs = me.IntField(default=0)
+    # False until the content itself has been written to GridFS.
+    stored = me.BooleanField(default=False)
+    created = me.DateTimeField()
+    last_referenced = me.DateTimeField()
+
+    meta = {
+        "auto_create_index": False,
+        "indexes": [
+            {"fields": ["refs"]}
+        ]
+    }
+
+
+class ClientFingerprint(me.Document):
+    """Catalog of SSH clients seen, by HASSH fingerprint."""
+
+    # The HASSH: md5 of the algorithms string.
+    id = me.StringField(primary_key=True)
+    algorithms = me.StringField()
+    sessions = me.IntField(default=0)
+    first_seen = me.DateTimeField()
+    last_seen = me.DateTimeField()
+    versions = me.ListField(me.StringField())
+
+    meta = {
+        "auto_create_index": False,
+        "indexes": [
+            {"fields": ["-last_seen"]}
+        ]
+    }
+
+    def to_dict(self):
+        """Convert object to a sanitized python dictionary."""
+        return {
+            "hassh": self.id,
+            "algorithms": self.algorithms,
+            "sessions": self.sessions,
+            "first_seen": self.first_seen.isoformat()
+            if self.first_seen else None,
+            "last_seen": self.last_seen.isoformat()
+            if self.last_seen else None,
+            "versions": self.versions
+        }
+
+
+class AttackerProfile(me.Document):
+    """Activity of one source IP, kept up to date at ingest."""
+
+    # The source IP.
+    id = me.StringField(primary_key=True)
+    sessions = me.IntField(default=0)
+    first_seen = me.DateTimeField()
+    last_seen = me.DateTimeField()
+    login_attempts = me.IntField(default=0)
+    logins = me.IntField(default=0)
+    commands = me.IntField(default=0)
+    # Distinct values, each list capped by PROFILE_MAX_VALUES.
+    sensors = me.ListField(me.StringField())
+    credentials = me.ListField(me.ListField(me.StringField()))
+    downloads = me.ListField(me.StringField())
+    clients = me.ListField(me.StringField())
+
+    meta = {
+        "auto_create_index": False,
+        "indexes": [
+            {"fields": ["-last_seen"]}
+        ]
+    }
+
+    def to_dict(self):
+        """Convert object to a sanitized python dictionary."""
+        response = self.to_mongo().to_dict()
+        response["source_ip"] = response.pop("_id")
+        for field in ("first_seen", "last_seen"):
+            if response.get(field) is not None:
+                response[field] = response[field].isoformat()
+        response["credentials"] = [
+            {"username": pair[0], "password": pair[1]}
+            for pair in self.credentials if len(pair) == 2]
+        return response
+
+
+class SensorActivity(me.Document):
+    """Events received from a sensor in one minute, for ingest rates."""
+
+    # "<sensor name>:<YYYYmmddHHMM>".
+    id = me.StringField(primary_key=True)
+    sensor = me.StringField(required=True)
+    minute = me.DateTimeField(required=True)
+    events = me.IntField(default=0)
+    # Events by event id, as in Sensor.event_counts.
+    counts = me.DictField()
+
+    meta = {
+        "auto_create_index": False,
+        "indexes": [
+            {"fields": ["minute"], "expireAfterSeconds": 7 * 86400}
+        ]
+    }
@@ -0,0 +1,152 @@
+"""MongoDB connection setup for forking uWSGI workers."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+import mongoengine as me
+
+from mongoengine import connection
+from mongoengine.base.common import _document_registry
+
+from flask_mongoengine import MongoEngine
+
+from donthackme_api import indexes
+from donthackme_api import partitions
+
+
+# app config key -> MongoClient keyword argument
+POOL_SETTINGS = {
+    "MONGODB_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGODB_MIN_POOL_SIZE": "minPoolSize",
+    "MONGODB_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGODB_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGODB_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGODB_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+    "MONGODB_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+}
+
+
+def documents():
+    """Return every collection-backed Document class that is defined."""
+    return [doc for doc in _document_registry.values()
+            if issubclass(doc, me.Document) and
+            not doc._meta.get("abstract")]
+
+
+def connection_settings(app):
+    """
+    Build MONGODB_SETTINGS with the pool options from configuration.
+
+    Explicit keys in MONGODB_SETTINGS win. ``connect`` is forced off so
+    that creating the client in the uWSGI master opens no sockets and
+    starts no monitor threads before the workers are forked.
+    """
+    settings = dict(app.config.get("MONGODB_SETTINGS", {}))
+    for key, option in POOL_SETTINGS.items():
+        value = app.config.get(key)
+        if value is not None:
+            settings.setdefault(option, value)
+    settings["connect"] = False
+    return settings
+
+
+def init_app(app):
+    """Configure MongoEngine without contacting the server."""
+    app.config["MONGODB_SETTINGS"] = connection_settings(app)
+    db = MongoEngine()
+    db.app = app
+    db.init_app(app)
+    return db
+
+
+def reset_connections():
+    """
+    Forget the MongoClients inherited from the parent process.
+
+    The clients are dropped rather than closed, since their sockets (if
+    any) belong to the parent. The connection settings are kept, so the
+    next query in this process creates a fresh client. Document classes
+    cache their collection, which is bound to the old client, so those
+    caches are cleared too, along with those of the partitions.
+    """
+    for alias in list(connection._connections):
+        connection._connections.pop(alias, None)
+        connection._dbs.pop(alias, None)
+    for document in documents():
+        document._collection = None
+    partitions.reset()
+
+
+def warm_up(app):
+    """
+    Open this worker's connections before its first request.
+
+    Pings the server from MONGODB_MIN_POOL_SIZE threads at once, so
+    that many pooled sockets are connected. Indexes are only verified:
+    they are built ahead of deploys by ``manage indexes``, so a worker
+    never blocks on an index build.
+    """
+    start = time.time()
+    db = me.connection.get_db()
+
+    def ping():
+        db.command("ping")
+
+    threads = [threading.Thread(target=ping) for _ in
+               range(max(app.config.get("MONGODB_MIN_POOL_SIZE") or 1, 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if app.config.get("MONGODB_VERIFY_INDEXES", True):
+        problems = indexes.verify(documents(), app.logger.warning)
+        if problems:
+            msg = ("{0} declared indexes are missing or changed; run "
+                   "python -m donthackme_api.manage indexes migrate")
+            app.logger.warning(msg.format(problems))
+
+    msg = "MongoDB warm-up finished in {0:.0f} ms."
+    app.logger.info(msg.format((time.time() - start) * 1000))
+
+
+def register_postfork(app):
+    """
+    Connect in each uWSGI worker after it has been forked.
+
+    Outside uWSGI (the development server, scripts) there is no fork, so
+    the warm-up runs straight away. MONGODB_WARM_UP = False skips the
+    warm-up in both cases.
+    """
+    def setup():
+        reset_connections()
+        if not app.config.get("MONGODB_WARM_UP", True):
+            return
+        try:
+            warm_up(app)
+        except Exception as e:
+            # The worker still serves requests and will retry on use.
+            app.logger.error("MongoDB warm-up failed: {0}".format(e))
+
+    try:
+        import uwsgi  # noqa
+        from uwsgidecorators import postfork
+    except ImportError:
+        if app.config.get("MONGODB_WARM_UP", True):
+            setup()
+    else:
+        postfork(setup)
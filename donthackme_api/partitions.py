@@ -0,0 +1,327 @@
+"""Time-partitioned event collections and the router that picks them."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from dateutil import parser as date_parser
+from dateutil import tz
+
+from flask import current_app, has_request_context
+
+from donthackme_api import metrics
+
+
+_local = threading.local()
+
+_collections = {}
+_known = {"names": set(), "checked": 0}
+_lock = threading.Lock()
+
+SUFFIX_PATTERNS = {
+    "monthly": re.compile(r"^(\d{4})_(\d{2})$"),
+    "weekly": re.compile(r"^(\d{4})_w(\d{2})$"),
+}
+
+# A collection name ending in a suffix of either scheme.
+PARTITIONED_NAME = re.compile(r"^(.+)_(\d{4}_w?\d{2})$")
+
+metrics.REGISTRY.describe("donthackme_partitions_missing_total",
+                          "Writes that found their partition not created "
+                          "by manage partitions ensure.")
+
+
+class Router(object):
+    """
+    Map timestamps to partitions and partitions to collections.
+
+    A partition is named by a suffix (``2016_07`` when monthly,
+    ``2016_w27`` when weekly) appended to the base collection name of
+    every partitioned document. Sessions are partitioned by start_time and
+    their commands and credentials follow them into the same partition,
+    so that a session and its children can be read from one place.
+
+    With no scheme configured every suffix is None and documents use their
+    base collection, exactly as before partitioning existed.
+    """
+
+    def __init__(self):
+        """init."""
+        self.scheme = None
+        self.session_max_age = timedelta(days=1)
+        self.include_legacy = True
+
+    @property
+    def enabled(self):
+        """Return True when a partition scheme is configured."""
+        return self.scheme is not None
+
+    def suffix_for(self, when):
+        """Return the partition suffix that holds timestamp when."""
+        if not self.enabled:
+            return None
+        when = to_datetime(when)
+        if self.scheme == "weekly":
+            year, week, _ = when.isocalendar()
+            return "{0:04d}_w{1:02d}".format(year, week)
+        return "{0:04d}_{1:02d}".format(when.year, when.month)
+
+    def bounds(self, suffix):
+        """Return the [start, end) datetimes covered by a suffix."""
+        match = SUFFIX_PATTERNS[self.scheme].match(suffix)
+        year, number = int(match.group(1)), int(match.group(2))
+        if self.scheme == "weekly":
+            start = iso_week_start(year, number)
+            return start, start + timedelta(days=7)
+        start = datetime(year, number, 1)
+        if number == 12:
+            return start, datetime(year + 1, 1, 1)
+        return start, datetime(year, number + 1, 1)
+
+    def suffixes_between(self, start, end):
+        """Return every suffix, existing or not, from start to end."""
+        suffixes = []
+        when = to_datetime(start)
+        end = to_datetime(end)
+        while True:
+            suffix = self.suffix_for(when)
+            if not suffixes or suffixes[-1] != suffix:
+                suffixes.append(suffix)
+            if when >= end:
+                break
+            when = min(self.bounds(suffix)[1], end)
+        return suffixes
+
+    def existing(self, base_name):
+        """Return the suffixes that exist for a base collection name."""
+        prefix = base_name + "_"
+        pattern = SUFFIX_PATTERNS[self.scheme]
+        return sorted(name[len(prefix):] for name in collection_names()
+                      if name.startswith(prefix) and
+                      pattern.match(name[len(prefix):]))
+
+    def partitions(self, document, start=None, end=None):
+        """
+        Return the partitions of document overlapping [start, end].
+
+        Newest first, followed by None (the unpartitioned base collection)
+        when it may hold data from before partitioning was enabled.
+        """
+        if not self.enabled:
+            return [None]
+        base = base_collection_name(document)
+        existing = self.existing(base)
+        if start is not None:
+            start = to_datetime(start)
+            existing = [suffix for suffix in existing
+                        if self.bounds(suffix)[1] > start]
+        if end is not None:
+            end = to_datetime(end)
+            existing = [suffix for suffix in existing
+                        if self.bounds(suffix)[0] <= end]
+        existing.reverse()
+        if self.include_legacy and base in collection_names():
+            existing.append(None)
+        return existing
+
+    def session_partitions(self, hint=None):
+        """
+        Return the partitions that may hold a session seen at hint.
+
+        A session lives in the partition of its start_time, which is at
+        most PARTITION_SESSION_MAX_AGE before any of its events.
+        """
+        if not self.enabled:
+            return [None]
+        hint = to_datetime(hint) if hint is not None else datetime.utcnow()
+        suffixes = self.suffixes_between(hint - self.session_max_age, hint)
+        suffixes.reverse()
+        if self.include_legacy:
+            suffixes.append(None)
+        return suffixes
+
+
+ROUTER = Router()
+
+
+def to_datetime(value):
+    """
+    Return value as a naive UTC datetime.
+
+    Accepts datetimes, date strings and numbers of seconds since the
+    epoch; anything else raises ValueError.
+    """
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, (int, long, float)) and \
+            not isinstance(value, bool):
+        parsed = datetime.utcfromtimestamp(value)
+    elif isinstance(value, basestring):
+        parsed = date_parser.parse(value)
+    else:
+        raise ValueError("{0!r} is not a timestamp.".format(value))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return parsed
+
+
+def iso_week_start(year, week):
+    """Return the Monday starting ISO week number week of year."""
+    fourth = datetime(year, 1, 4)
+    return fourth - timedelta(days=fourth.isoweekday() - 1) + \
+        timedelta(weeks=week - 1)
+
+
+def current_suffix():
+    """Return the partition suffix active in this thread, if any."""
+    return getattr(_local, "suffix", None)
+
+
+def activate(suffix):
+    """Route partitioned documents to suffix until deactivate()."""
+    _local.suffix = suffix
+
+
+def deactivate(*args):
+    """Route partitioned documents back to their base collections."""
+    _local.suffix = None
+
+
+@contextmanager
+def use(suffix):
+    """Route partitioned documents to suffix within the block."""
+    previous = current_suffix()
+    _local.suffix = suffix
+    try:
+        yield suffix
+    finally:
+        _local.suffix = previous
+
+
+def collection_names(max_age=30):
+    """Return the collection names of the database, cached briefly."""
+    from mongoengine.connection import get_db
+
+    now = time.time()
+    if now - _known["checked"] > max_age:
+        db = get_db()
+        if hasattr(db, "list_collection_names"):
+            names = set(db.list_collection_names())
+        else:
+            names = set(db.collection_names())
+        with _lock:
+            _known["names"] = names
+            _known["checked"] = now
+    return _known["names"]
+
+
+def reset():
+    """Forget cached collection objects, e.g. after a fork."""
+    with _lock:
+        _collections.clear()
+        _known["names"] = set()
+        _known["checked"] = 0
+
+
+def base_collection_name(document):
+    """Return the unpartitioned collection name of a document class."""
+    return document._meta.get("collection")
+
+
+def strip_suffix(name):
+    """Return a collection name without its partition suffix, if any."""
+    match = PARTITIONED_NAME.match(name)
+    return match.group(1) if match is not None else name
+
+
+class PartitionedDocument(object):
+    """
+    Mixin for documents stored in time partitions.
+
+    Every collection lookup MongoEngine makes, whether to save, query or
+    dereference, goes through _get_collection_name and _get_collection,
+    so overriding both routes all of them to the partition active in the
+    current thread.
+    """
+
+    @classmethod
+    def _get_collection_name(cls):
+        """Return the collection name in the active partition."""
+        base = base_collection_name(cls)
+        suffix = current_suffix()
+        if suffix is None or not ROUTER.enabled:
+            return base
+        return "{0}_{1}".format(base, suffix)
+
+    @classmethod
+    def _get_collection(cls):
+        """Return the collection of the active partition."""
+        suffix = current_suffix()
+        if suffix is None or not ROUTER.enabled:
+            return super(PartitionedDocument, cls)._get_collection()
+        name = cls._get_collection_name()
+        collection = _collections.get(name)
+        if collection is None:
+            collection = cls._get_db()[name]
+            if name not in collection_names(max_age=0):
+                create(cls, collection)
+            with _lock:
+                _collections[name] = collection
+        return collection
+
+
+def create(document, collection):
+    """
+    Build the indexes of a partition, which may not exist yet.
+
+    "manage partitions ensure" does this ahead of each period. A request
+    that finds its partition missing only builds the unique indexes,
+    which keep duplicates out and cost nothing on an empty collection;
+    the others wait for the next ensure, so as not to stall the request.
+    """
+    from donthackme_api import indexes
+
+    _known["names"].add(collection.name)
+    specs = indexes.declared(document)
+    if has_request_context():
+        metrics.inc("donthackme_partitions_missing_total",
+                    {"collection": collection.name})
+        current_app.logger.warning(
+            "Partition {0} was not created ahead of time; run "
+            "manage partitions ensure.".format(collection.name))
+        specs = [(keys, options) for keys, options in specs
+                 if options.get("unique")]
+    # A partition is created empty, so building its indexes here never
+    # blocks on existing data.
+    for keys, options in specs:
+        collection.create_index(keys, background=True, **options)
+
+
+def init_app(app):
+    """Configure the router and clear the partition after each request."""
+    scheme = app.config.get("PARTITION_SCHEME")
+    if scheme is not None and scheme not in SUFFIX_PATTERNS:
+        raise ValueError("PARTITION_SCHEME must be None, 'monthly' or "
+                         "'weekly', not {0!r}".format(scheme))
+    ROUTER.scheme = scheme
+    ROUTER.session_max_age = timedelta(
+        seconds=app.config.get("PARTITION_SESSION_MAX_AGE", 86400))
+    ROUTER.include_legacy = app.config.get("PARTITION_INCLUDE_LEGACY", True)
+    app.teardown_request(deactivate)
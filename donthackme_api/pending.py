@@ -0,0 +1,183 @@
+"""Buffer for events that arrive before their session exists."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from flask import current_app, g
+
+from donthackme_api import metrics
+from donthackme_api import tracing
+from donthackme_api.models import PendingEvent
+
+# cowrie event id -> function(payload, session_id) that applies it.
+APPLIERS = {}
+
+# cowrie event id -> function(payload) undoing what was done on receipt,
+# for events dropped unapplied.
+EXPIRERS = {}
+
+_sweep = {"last": 0}
+_sweep_lock = threading.Lock()
+
+metrics.REGISTRY.describe("donthackme_pending_events",
+                          "Events waiting for their session.")
+metrics.REGISTRY.describe("donthackme_pending_buffered_total",
+                          "Events buffered because their session did not "
+                          "exist yet.")
+metrics.REGISTRY.describe("donthackme_pending_applied_total",
+                          "Buffered events applied once their session "
+                          "was created.")
+metrics.REGISTRY.describe("donthackme_pending_expired_total",
+                          "Buffered events dropped after PENDING_TTL.")
+metrics.REGISTRY.describe("donthackme_pending_rejected_total",
+                          "Events rejected because their session already "
+                          "had PENDING_MAX_PER_SESSION events buffered.")
+
+
+def applies(*events):
+    """Register the decorated function as the applier of events."""
+    def register(f):
+        for event in events:
+            APPLIERS[event] = f
+        return f
+    return register
+
+
+def expires(*events):
+    """Register the decorated function as the cleanup of expired events."""
+    def register(f):
+        for event in events:
+            EXPIRERS[event] = f
+        return f
+    return register
+
+
+def enabled():
+    """Return True when early events are buffered rather than refused."""
+    return bool(current_app.config.get("PENDING_EVENTS", True))
+
+
+def hold(event, payload):
+    """
+    Buffer an event whose session does not exist yet.
+
+    Returns False when the session already has PENDING_MAX_PER_SESSION
+    events waiting, in which case the event is not kept.
+    """
+    if event not in APPLIERS:
+        return False
+    limit = current_app.config.get("PENDING_MAX_PER_SESSION", 500)
+    pending = PendingEvent.objects(
+        session=payload["session"],
+        sensor_name=payload.get("sensor_name")
+    ).limit(limit)
+    if pending.count(with_limit_and_skip=True) >= limit:
+        metrics.inc("donthackme_pending_rejected_total", {"event": event})
+        return False
+    PendingEvent(
+        session=payload["session"],
+        sensor_name=payload.get("sensor_name"),
+        event=event,
+        timestamp=payload.get("timestamp"),
+        received=datetime.utcnow(),
+        payload=payload
+    ).save()
+    metrics.inc("donthackme_pending_buffered_total", {"event": event})
+    return True
+
+
+@tracing.traced("drain_pending")
+def drain(session, sensor_name, session_id):
+    """
+    Apply the buffered events of a session in timestamp order.
+
+    Each event is removed atomically before it is applied, so concurrent
+    drains of the same session never apply an event twice. Returns the
+    number applied.
+    """
+    previous = getattr(g, "write_concern_event", None)
+    applied = 0
+    try:
+        while True:
+            item = PendingEvent.objects(
+                session=session,
+                sensor_name=sensor_name
+            ).order_by("timestamp", "received").modify(remove=True)
+            if item is None:
+                break
+            g.write_concern_event = item.event
+            try:
+                APPLIERS[item.event](dict(item.payload), session_id)
+            except Exception:
+                current_app.logger.exception(
+                    "Buffered {0} event of session {1} could not be "
+                    "applied.".format(item.event, session))
+                continue
+            metrics.inc("donthackme_pending_applied_total",
+                        {"event": item.event})
+            applied += 1
+    finally:
+        g.write_concern_event = previous
+    return applied
+
+
+def sweep(force=False):
+    """
+    Drop buffered events older than PENDING_TTL and count them.
+
+    Events with a registered expirer are removed one at a time and
+    handed to it, so that what was taken on their receipt is given back.
+    Runs at most once per PENDING_SWEEP_INTERVAL in each worker, before
+    requests to the events endpoints.
+    """
+    now = time.time()
+    interval = current_app.config.get("PENDING_SWEEP_INTERVAL", 30)
+    with _sweep_lock:
+        if not force and now - _sweep["last"] < interval:
+            return 0
+        _sweep["last"] = now
+    ttl = current_app.config.get("PENDING_TTL", 300)
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    expired = 0
+    for item in PendingEvent.objects(received__lt=cutoff,
+                                     event__in=list(EXPIRERS)):
+        # Only the remover cleans up: a drain may have taken it since.
+        if not PendingEvent.objects(id=item.id).delete():
+            continue
+        expired += 1
+        try:
+            EXPIRERS[item.event](dict(item.payload))
+        except Exception:
+            current_app.logger.exception(
+                "Expired {0} event of session {1} could not be cleaned "
+                "up.".format(item.event, item.session))
+    expired += PendingEvent.objects(received__lt=cutoff).delete()
+    if expired:
+        metrics.inc("donthackme_pending_expired_total", amount=expired)
+    return expired
+
+
+def depth():
+    """Report the number of buffered events, for /admin/metrics."""
+    return [("donthackme_pending_events", None, PendingEvent.objects.count())]
+
+
+def init_app(app):
+    """Report the number of buffered events."""
+    metrics.REGISTRY.add_collector(depth)
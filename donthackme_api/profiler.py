@@ -0,0 +1,218 @@
+"""On-demand statistical sampling profiler for running workers."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import fnmatch
+import json
+import os
+import sys
+import threading
+import time
+
+from flask import request
+
+
+TRIGGER_FILE = "trigger.json"
+
+
+class SamplingProfiler(object):
+    """
+    Sample the stacks of in-flight requests from a background thread.
+
+    Every request registers its thread and path for its duration; during
+    a run the sampler wakes every ``interval`` seconds, collects the stack of
+    each registered thread whose path or route matches the filter, and
+    counts identical stacks. At the end of the run the counts are written
+    in the collapsed-stack format read by flamegraph.pl and speedscope.
+    Outside a run the request hooks only update that registry and, at
+    most once a second, look for the trigger file of ``trigger_all``.
+    """
+
+    def __init__(self):
+        """init."""
+        self.directory = None
+        self.active = False
+        self.run = None
+        self._requests = {}
+        self._lock = threading.Lock()
+        self._last_trigger_check = 0
+        self._last_trigger = None
+
+    def start(self, seconds, route=None, interval=0.01):
+        """Start a run in this worker; return False if one is running."""
+        with self._lock:
+            if self.active:
+                return False
+            self.active = True
+            self.run = {
+                "pid": os.getpid(),
+                "route": route,
+                "seconds": seconds,
+                "interval": interval,
+                "started": time.time(),
+                "samples": 0,
+                "output": None
+            }
+        thread = threading.Thread(
+            target=self._sample,
+            args=(seconds, route, interval)
+        )
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def status(self):
+        """Describe the current or most recent run."""
+        with self._lock:
+            response = {"active": self.active, "pid": os.getpid()}
+            if self.run is not None:
+                response["run"] = dict(self.run)
+            return response
+
+    def request_started(self, path, rule):
+        """Register the current thread as serving path."""
+        self._requests[threading.current_thread().ident] = (path, rule)
+
+    def request_finished(self):
+        """Unregister the current thread."""
+        self._requests.pop(threading.current_thread().ident, None)
+
+    def check_trigger(self):
+        """Start a run if another worker asked all workers to profile."""
+        if self.directory is None:
+            return
+        now = time.time()
+        if now - self._last_trigger_check < 1:
+            return
+        self._last_trigger_check = now
+        path = os.path.join(self.directory, TRIGGER_FILE)
+        try:
+            with open(path) as handle:
+                trigger = json.load(handle)
+        except (IOError, ValueError):
+            return
+        if trigger.get("id") == self._last_trigger:
+            return
+        self._last_trigger = trigger.get("id")
+        remaining = trigger["started"] + trigger["seconds"] - now
+        if remaining > 0:
+            self.start(remaining, trigger.get("route"),
+                       trigger.get("interval", 0.01))
+
+    def trigger_all(self, seconds, route=None, interval=0.01):
+        """Ask every worker to start a run within about a second."""
+        trigger = {
+            "id": "{0}-{1}".format(os.getpid(), time.time()),
+            "started": time.time(),
+            "seconds": seconds,
+            "route": route,
+            "interval": interval
+        }
+        path = os.path.join(self.directory, TRIGGER_FILE)
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as handle:
+            json.dump(trigger, handle)
+        os.rename(tmp_path, path)
+        self._last_trigger = trigger["id"]
+        return self.start(seconds, route, interval)
+
+    def _matches(self, route, path, rule):
+        if route is None:
+            return True
+        return (fnmatch.fnmatchcase(path, route) or
+                (rule is not None and fnmatch.fnmatchcase(rule, route)))
+
+    def _sample(self, seconds, route, interval):
+        counts = {}
+        samples = 0
+        own_ident = threading.current_thread().ident
+        output = None
+        deadline = time.time() + seconds
+        try:
+            while time.time() < deadline:
+                time.sleep(interval)
+                frames = sys._current_frames()
+                for ident, (path, rule) in self._requests.items():
+                    if ident == own_ident or ident not in frames:
+                        continue
+                    if not self._matches(route, path, rule):
+                        continue
+                    stack = collapse(frames[ident])
+                    counts[stack] = counts.get(stack, 0) + 1
+                    samples += 1
+                del frames
+            output = self._write(counts)
+        finally:
+            with self._lock:
+                self.active = False
+                self.run["samples"] = samples
+                self.run["output"] = output
+
+    def _write(self, counts):
+        if self.directory is None or not counts:
+            return None
+        filename = "profile-{0}-{1}.collapsed".format(
+            os.getpid(),
+            time.strftime("%Y%m%dT%H%M%S")
+        )
+        path = os.path.join(self.directory, filename)
+        with open(path, "w") as handle:
+            for stack, count in sorted(counts.items()):
+                handle.write("{0} {1}\n".format(stack, count))
+        return path
+
+
+def collapse(frame):
+    """Render a frame's stack root-first as ``file:function;...``."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{0}:{1}".format(
+            os.path.basename(code.co_filename),
+            code.co_name
+        ))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+PROFILER = SamplingProfiler()
+
+
+def _request_started():
+    PROFILER.check_trigger()
+    PROFILER.request_started(
+        request.path,
+        request.url_rule.rule if request.url_rule else None
+    )
+
+
+def _request_finished(exc=None):
+    PROFILER.request_finished()
+
+
+def init_app(app):
+    """Register request hooks and the profile output directory."""
+    directory = app.config.get("PROFILE_DIR")
+    if directory:
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        PROFILER.directory = directory
+
+    app.before_request(_request_started)
+    app.teardown_request(_request_finished)
@@ -0,0 +1,225 @@
+"""Attacker profiles by source IP, maintained at ingest."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from donthackme_api import partitions
+from donthackme_api.bloom import BloomFilter
+from donthackme_api.cache import TTLCache
+from donthackme_api.concurrency import EXECUTOR
+from donthackme_api.models import AttackerProfile, Session
+
+# Keys this worker has written: "ip:<ip>" for profiles that exist.
+SEEN = BloomFilter()
+
+# Session id -> source IP, filled by session/connect.
+session_ips = TTLCache(name="session_ips", maxsize=10000, ttl=600)
+
+settings = {"max_values": 100}
+
+
+def _when(value):
+    if value is None:
+        return datetime.utcnow()
+    return partitions.to_datetime(value)
+
+
+def _update(ip, update, seen):
+    """
+    Apply an update to a profile, creating the profile if need be.
+
+    The filter only chooses how the update is sent: IPs it does not know
+    are upserted, the rest get a plain update. A false positive, or a
+    profile written by another worker, shows as an update that matched
+    nothing, and is retried as an upsert.
+    """
+    collection = AttackerProfile._get_collection()
+    update = dict(update, **{"$min": {"first_seen": seen}})
+    if "ip:" + ip in SEEN:
+        result = EXECUTOR.run(collection.update_one, {"_id": ip}, update)
+        if result.matched_count:
+            return
+    EXECUTOR.run(collection.update_one, {"_id": ip}, update, upsert=True)
+    SEEN.add("ip:" + ip)
+
+
+def _add_values(ip, field, values):
+    """
+    Add values to a capped list of distinct values.
+
+    $addToSet leaves values already in the list alone, so the update is
+    sent every time; it matches nothing once the list holds max_values.
+    """
+    values = [value for value in values if value]
+    if not values:
+        return
+    EXECUTOR.run(AttackerProfile._get_collection().update_one, {
+        "_id": ip,
+        "{0}.{1}".format(field, settings["max_values"] - 1): {
+            "$exists": False}
+    }, {"$addToSet": {field: {"$each": values}}})
+
+
+def source_ip(session_id):
+    """Return the source IP of a session, or None."""
+    ip = session_ips.get(session_id)
+    if ip is None:
+        session = EXECUTOR.run(Session.objects(id=session_id).only(
+            "source_ip").first)
+        if session is None or not session.source_ip:
+            return None
+        ip = session.source_ip
+        session_ips.set(session_id, ip)
+    return ip
+
+
+def session_started(session_id, ip, sensor_name, start_time):
+    """Count a new session of an IP."""
+    if not ip:
+        return
+    session_ips.set(session_id, ip)
+    seen = _when(start_time)
+    _update(ip, {"$inc": {"sessions": 1}, "$max": {"last_seen": seen}},
+            seen)
+    _add_values(ip, "sensors", [sensor_name])
+
+
+def login_attempt(session_id, username, password, success, timestamp):
+    """Count a login attempt and note the credentials tried."""
+    ip = source_ip(session_id)
+    if ip is None:
+        return
+    seen = _when(timestamp)
+    _update(ip, {
+        "$inc": {"login_attempts": 1, "logins": 1 if success else 0},
+        "$max": {"last_seen": seen}
+    }, seen)
+    _add_values(ip, "credentials", [[username or "", password or ""]])
+
+
+def command(session_id, timestamp):
+    """Count a command run."""
+    ip = source_ip(session_id)
+    if ip is None:
+        return
+    seen = _when(timestamp)
+    _update(ip, {"$inc": {"commands": 1}, "$max": {"last_seen": seen}},
+            seen)
+
+
+def download(session_id, shasum):
+    """Note the hash of a file downloaded."""
+    ip = source_ip(session_id)
+    if ip is not None:
+        _add_values(ip, "downloads", [shasum])
+
+
+def client(session_id, fingerprint):
+    """Note the HASSH of a client used."""
+    ip = source_ip(session_id)
+    if ip is not None:
+        _add_values(ip, "clients", [fingerprint])
+
+
+class Tally(object):
+    """
+    Profile changes summed over a batch of events, for the importer.
+
+    The functions above write each event as it arrives. A Tally adds up
+    the events of a batch per IP instead; write() then sends one upsert
+    per IP and one capped $addToSet per list, in two bulk writes.
+    """
+
+    def __init__(self):
+        """init."""
+        self._updates = OrderedDict()
+        self._values = OrderedDict()
+
+    def _count(self, ip, counts, seen):
+        update = self._updates.get(ip)
+        if update is None:
+            update = self._updates[ip] = {
+                "$inc": {},
+                "$min": {"first_seen": seen},
+                "$max": {"last_seen": seen}
+            }
+        for name, count in counts.items():
+            update["$inc"][name] = update["$inc"].get(name, 0) + count
+        update["$min"]["first_seen"] = min(update["$min"]["first_seen"],
+                                           seen)
+        update["$max"]["last_seen"] = max(update["$max"]["last_seen"], seen)
+
+    def _add(self, ip, field, value):
+        if not value:
+            return
+        values = self._values.setdefault((ip, field), [])
+        if value not in values:
+            values.append(value)
+
+    def session_started(self, ip, sensor_name, start_time):
+        """Count a new session of an IP."""
+        self._count(ip, {"sessions": 1}, _when(start_time))
+        self._add(ip, "sensors", sensor_name)
+
+    def login_attempt(self, ip, username, password, success, timestamp):
+        """Count a login attempt and note the credentials tried."""
+        self._count(ip, {"login_attempts": 1, "logins": 1 if success else 0},
+                    _when(timestamp))
+        self._add(ip, "credentials", [username or "", password or ""])
+
+    def command(self, ip, timestamp):
+        """Count a command run."""
+        self._count(ip, {"commands": 1}, _when(timestamp))
+
+    def download(self, ip, shasum):
+        """Note the hash of a file downloaded."""
+        self._add(ip, "downloads", shasum)
+
+    def client(self, ip, fingerprint):
+        """Note the HASSH of a client used."""
+        self._add(ip, "clients", fingerprint)
+
+    def write(self):
+        """Write the changes tallied and start over; return the IPs."""
+        updates, self._updates = self._updates, OrderedDict()
+        values, self._values = self._values, OrderedDict()
+        collection = AttackerProfile._get_collection()
+        if updates:
+            # Profiles first, so that the lists of new IPs have a match.
+            collection.bulk_write([
+                UpdateOne({"_id": ip}, update, upsert=True)
+                for ip, update in updates.items()
+            ], ordered=False)
+        if values:
+            collection.bulk_write([
+                UpdateOne({
+                    "_id": ip,
+                    "{0}.{1}".format(field, settings["max_values"] - 1): {
+                        "$exists": False}
+                }, {"$addToSet": {field: {"$each": items}}})
+                for (ip, field), items in values.items()
+            ], ordered=False)
+        return len(updates)
+
+
+def init_app(app):
+    """Size the seen-before filter and the value lists."""
+    SEEN.configure(app.config.get("PROFILE_BLOOM_CAPACITY", 1000000),
+                   app.config.get("PROFILE_BLOOM_ERROR_RATE", 0.001))
+    settings["max_values"] = app.config.get("PROFILE_MAX_VALUES", 100)
@@ -0,0 +1,140 @@
+"""Token bucket rate limits per API user, shared by all workers."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import fcntl
+import hashlib
+import os
+import struct
+import threading
+import time
+
+from donthackme_api import metrics
+
+# tokens, last refill (seconds since the epoch)
+BUCKET = struct.Struct("<dd")
+
+metrics.REGISTRY.describe("donthackme_ratelimit_rejected_total",
+                          "Requests refused with 429 by user.")
+
+
+class Limiter(object):
+    """
+    Token buckets kept in one small file per user.
+
+    Every uWSGI worker opens the same files, and each update happens
+    under an exclusive flock, so a user's rate is enforced across all
+    workers of the host. File descriptors are kept open per process and
+    reopened after a fork.
+    """
+
+    def __init__(self):
+        """init."""
+        self.directory = None
+        self.enabled = False
+        self.rate = 50.0
+        self.burst = 200.0
+        self.overrides = {}
+        self._pid = None
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def limits(self, user):
+        """Return (rate, burst) for a user, by API key or username."""
+        for key in (str(user.api_key), user.username):
+            if key in self.overrides:
+                override = self.overrides[key]
+                return (float(override.get("rate", self.rate)),
+                        float(override.get("burst", self.burst)))
+        return self.rate, self.burst
+
+    def _file(self, identity):
+        with self._lock:
+            if self._pid != os.getpid():
+                # An inherited descriptor shares its open file, and so its
+                # flock, with the parent: each worker must open its own.
+                for fd in self._files.values():
+                    os.close(fd)
+                self._files = {}
+                self._pid = os.getpid()
+            fd = self._files.get(identity)
+            if fd is None:
+                name = hashlib.sha1(identity.encode("utf-8")).hexdigest()
+                fd = os.open(os.path.join(self.directory, name),
+                             os.O_RDWR | os.O_CREAT, 0o600)
+                self._files[identity] = fd
+            return fd
+
+    def take(self, identity, rate, burst, now=None):
+        """
+        Take one token from identity's bucket.
+
+        Returns 0 when the request may proceed, otherwise the number of
+        seconds until a token is available.
+        """
+        fd = self._file(identity)
+        now = now or time.time()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            data = os.read(fd, BUCKET.size)
+            if len(data) == BUCKET.size:
+                tokens, last = BUCKET.unpack(data)
+                tokens = min(burst, tokens + max(0.0, now - last) * rate)
+            else:
+                tokens = burst
+            if tokens >= 1:
+                wait = 0
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, BUCKET.pack(tokens, now))
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        return wait
+
+    def check(self, user):
+        """Return 0, or the seconds the user must wait before retrying."""
+        if not self.enabled:
+            return 0
+        rate, burst = self.limits(user)
+        if rate <= 0:
+            return 0
+        wait = self.take(str(user.id), rate, burst)
+        if wait:
+            metrics.inc("donthackme_ratelimit_rejected_total",
+                        {"user": user.username})
+        return wait
+
+
+LIMITER = Limiter()
+
+
+def init_app(app):
+    """Read the limits from configuration and create the bucket dir."""
+    LIMITER.enabled = bool(app.config.get("RATELIMIT_ENABLED", True))
+    LIMITER.directory = app.config.get("RATELIMIT_DIR",
+                                       "/tmp/donthackme_ratelimit")
+    LIMITER.rate = float(app.config.get("RATELIMIT_RATE", 50))
+    LIMITER.burst = float(app.config.get("RATELIMIT_BURST", 200))
+    LIMITER.overrides = dict(app.config.get("RATELIMIT_KEYS") or {})
+    if LIMITER.enabled:
+        try:
+            os.makedirs(LIMITER.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
@@ -0,0 +1,340 @@
+"""Retention: TTL expiry of hot data and the compressed session archive."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import sqlite3
+import zlib
+
+from datetime import datetime, timedelta
+
+from bson import Binary, json_util, objectid
+
+DAY = 86400
+
+# zlib window bits that read and write the gzip format.
+GZIP_WBITS = 31
+
+# Collections whose documents belong to a session, by Session list field.
+SESSION_CHILDREN = {
+    "commands": "command",
+    "credentials": "credentials",
+    "fingerprints": "fingerprint",
+    "downloads": "download",
+    "tcpconnections": "tcp_connection",
+}
+
+# Time field each collection expires by, when it is not "timestamp".
+TIME_FIELDS = {
+    "session": "start_time",
+}
+
+
+class Policy(object):
+    """
+    Retention configuration of every collection.
+
+    days maps a collection name to the number of days its documents are
+    kept (None keeps them forever). The "ttylog" entry is not a
+    collection: it is the age after which TTY log binaries are removed
+    from sessions that have been archived.
+    """
+
+    def __init__(self):
+        """init."""
+        self.days = {}
+        self.archive_dir = None
+        self.lead = timedelta(days=7)
+
+    def ttl(self, collection):
+        """Return the TTL in seconds of a collection, or None."""
+        days = self.days.get(collection)
+        if days is None:
+            return None
+        return int(days * DAY)
+
+    def time_field(self, collection):
+        """Return the date field documents of a collection expire by."""
+        return TIME_FIELDS.get(collection, "timestamp")
+
+    def apply(self, collection, specs):
+        """
+        Add the TTL of collection to its declared index specs.
+
+        The TTL goes on the single-field index of the time field, which
+        is declared for most collections; one is added when it is not.
+        """
+        ttl = self.ttl(collection)
+        if ttl is None:
+            return specs
+        keys = [(self.time_field(collection), 1)]
+        for spec_keys, options in specs:
+            if spec_keys == keys:
+                options["expireAfterSeconds"] = ttl
+                return specs
+        specs.append((keys, {"expireAfterSeconds": ttl}))
+        return specs
+
+    def archive_cutoff(self, now=None):
+        """
+        Return the start_time before which sessions should be archived.
+
+        A session is archived lead time before the first of its
+        documents can expire. Its children are never older than the
+        session, so that is the shortest TTL among the session and its
+        child collections. None when none of them expire.
+        """
+        ttls = [self.ttl(collection) for collection in
+                ["session"] + list(SESSION_CHILDREN.values())]
+        ttls = [ttl for ttl in ttls if ttl is not None]
+        if not ttls:
+            return None
+        now = now or datetime.utcnow()
+        return now - timedelta(seconds=min(ttls)) + self.lead
+
+
+POLICY = Policy()
+
+
+def jsonable(value):
+    """Convert an archived document to plain JSON types for the API."""
+    if isinstance(value, dict):
+        return dict((key, jsonable(item)) for key, item in value.items()
+                    if key != "log_binary")
+    if isinstance(value, list):
+        return [jsonable(item) for item in value]
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, objectid.ObjectId):
+        return str(value)
+    return value
+
+
+class Archive(object):
+    """
+    Append-only, compressed store of sessions with their children.
+
+    Each archive file holds one gzip member per session, so the files
+    stay valid gzip streams (zcat reads them whole) while any session can
+    be read alone from its offset. A SQLite index maps session ids to
+    file, offset and length for point lookups.
+    """
+
+    def __init__(self, directory):
+        """init."""
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.sqlite")
+
+    def _index(self, create=False):
+        if not create and not os.path.exists(self.index_path):
+            return None
+        index = sqlite3.connect(self.index_path, timeout=30)
+        if create:
+            index.execute(
+                "CREATE TABLE IF NOT EXISTS archived ("
+                "id TEXT PRIMARY KEY, session TEXT, sensor_name TEXT, "
+                "start_time TEXT, file TEXT, offset INTEGER, "
+                "length INTEGER)")
+            index.execute("CREATE INDEX IF NOT EXISTS archived_session "
+                          "ON archived (session)")
+        return index
+
+    def append(self, documents, now=None):
+        """Archive session documents; return how many were written."""
+        if not documents:
+            return 0
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        now = now or datetime.utcnow()
+        name = "sessions-{0:%Y-%m-%d}.jsonl.gz".format(now)
+        rows = []
+        with open(os.path.join(self.directory, name), "ab") as out:
+            out.seek(0, os.SEEK_END)
+            for document in documents:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+                line = json_util.dumps(document) + "\n"
+                member = compressor.compress(line.encode("utf-8")) + \
+                    compressor.flush()
+                offset = out.tell()
+                out.write(member)
+                start_time = document.get("start_time")
+                rows.append((
+                    str(document["_id"]), document.get("session"),
+                    document.get("sensor_name"),
+                    start_time.isoformat() if start_time else None,
+                    name, offset, len(member)
+                ))
+            out.flush()
+            os.fsync(out.fileno())
+        index = self._index(create=True)
+        try:
+            with index:
+                index.executemany(
+                    "INSERT OR REPLACE INTO archived VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?)", rows)
+        finally:
+            index.close()
+        return len(rows)
+
+    def read(self, name, offset, length):
+        """Return the document stored at offset in archive file name."""
+        with open(os.path.join(self.directory, name), "rb") as archive:
+            archive.seek(offset)
+            member = archive.read(length)
+        return json_util.loads(
+            zlib.decompress(member, GZIP_WBITS).decode("utf-8"))
+
+    def lookup(self, session, sensor_name=None):
+        """Return the archived documents of a cowrie session id."""
+        index = self._index()
+        if index is None:
+            return []
+        query = "SELECT file, offset, length FROM archived WHERE session = ?"
+        params = [session]
+        if sensor_name is not None:
+            query += " AND sensor_name = ?"
+            params.append(sensor_name)
+        try:
+            rows = index.execute(query + " ORDER BY start_time DESC",
+                                 params).fetchall()
+        finally:
+            index.close()
+        return [self.read(*row) for row in rows]
+
+
+def archive():
+    """Return the archive in the configured ARCHIVE_DIR."""
+    return Archive(POLICY.archive_dir)
+
+
+def snapshot(sessions):
+    """
+    Return sessions as archive documents, with their children inlined.
+
+    The children of a batch of sessions are fetched with one query per
+    child collection, in the partition that is active. TTY logs in the
+    blob store are copied in, so the archive stands on its own.
+    """
+    from donthackme_api import blobstore
+    from donthackme_api.models import Session
+
+    ids = [session.id for session in sessions]
+    children = {}
+    for field in SESSION_CHILDREN:
+        document = Session._fields[field].field.document_type
+        children[field] = {}
+        for child in document.objects(session__in=ids):
+            child = child.to_mongo().to_dict()
+            children[field].setdefault(child["session"], []).append(child)
+    documents = []
+    for session in sessions:
+        document = session.to_mongo().to_dict()
+        for field in SESSION_CHILDREN:
+            document[field] = children[field].get(session.id, [])
+        ttylog = document.get("ttylog") or {}
+        if ttylog.get("sha256") and "log_binary" not in ttylog:
+            content = blobstore.read(ttylog["sha256"])
+            if content is not None:
+                ttylog["log_binary"] = Binary(content)
+        documents.append(document)
+    return documents
+
+
+def archive_sessions(before, batch_size=100, report=None):
+    """
+    Archive unarchived sessions that started before a cutoff.
+
+    Sessions are written to the archive and then marked archived, so an
+    interrupted run archives a batch again rather than losing it; the
+    index keeps only the latest copy. Returns the number archived.
+    """
+    from donthackme_api import partitions
+    from donthackme_api.models import Session
+
+    report = report or (lambda line: None)
+    store = archive()
+    total = 0
+    for suffix in partitions.ROUTER.partitions(Session, None, before):
+        with partitions.use(suffix):
+            while True:
+                batch = list(Session.objects(
+                    start_time__lt=before,
+                    archived=None
+                ).no_dereference().order_by("start_time").limit(batch_size))
+                if not batch:
+                    break
+                now = datetime.utcnow()
+                store.append(snapshot(batch), now)
+                Session.objects(id__in=[session.id for session in batch]) \
+                    .update(set__archived=now)
+                total += len(batch)
+                report("{0}: {1} sessions archived".format(
+                    Session._get_collection_name(), total))
+    return total
+
+
+def strip_ttylogs(report=None):
+    """
+    Remove TTY log binaries from archived sessions past their retention.
+
+    The binaries stay readable in the archive. Sessions release their
+    reference to a log in the blob store one at a time, so a log is
+    released once even when runs overlap. Returns the number of sessions
+    changed.
+    """
+    from donthackme_api import blobstore
+    from donthackme_api import partitions
+    from donthackme_api.models import Session
+
+    report = report or (lambda line: None)
+    days = POLICY.days.get("ttylog")
+    if days is None:
+        return 0
+    before = datetime.utcnow() - timedelta(days=days)
+    total = 0
+    for suffix in partitions.ROUTER.partitions(Session, None, before):
+        with partitions.use(suffix):
+            changed = Session.objects(
+                start_time__lt=before,
+                archived__ne=None,
+                ttylog__log_binary__exists=True
+            ).update(unset__ttylog__log_binary=True)
+            for session in Session.objects(
+                    start_time__lt=before,
+                    archived__ne=None,
+                    ttylog__sha256__exists=True).only("ttylog.sha256"):
+                if Session.objects(
+                        id=session.id,
+                        ttylog__sha256=session.ttylog.sha256
+                ).update_one(unset__ttylog__sha256=True):
+                    blobstore.release(session.ttylog.sha256)
+                    changed += 1
+            report("{0}: {1} TTY logs removed".format(
+                Session._get_collection_name(), changed))
+            total += changed
+    return total
+
+
+def init_app(app):
+    """Read the retention policy from configuration."""
+    POLICY.days = dict(app.config.get("RETENTION_DAYS") or {})
+    POLICY.archive_dir = app.config.get("ARCHIVE_DIR")
+    POLICY.lead = timedelta(
+        days=app.config.get("RETENTION_ARCHIVE_LEAD_DAYS", 7))
+
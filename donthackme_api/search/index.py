@@ -0,0 +1,193 @@
+"""Inverted index of command texts by token and trigram."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import re
+
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from donthackme_api.concurrency import EXECUTOR
+from donthackme_api.models import CommandText, SearchPosting, SearchTerm
+
+# Only the start of very long commands (usually encoded payloads) is
+# indexed, which bounds the postings a single command can add.
+MAX_INDEXED_CHARS = 2048
+
+TOKEN = re.compile(r"[\w.:/@-]+", re.UNICODE)
+
+
+class QueryTooBroad(ValueError):
+    """The rarest term of a query matches too many command texts."""
+
+
+def text_id(text):
+    """Return the CommandText id of a command text."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def trigrams(text):
+    """Return the distinct lowercase trigrams of text."""
+    text = text.lower()
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def tokens(text):
+    """Return the distinct lowercase tokens of text."""
+    return set(TOKEN.findall(text.lower()))
+
+
+def terms(text):
+    """
+    Return every index term of a command text.
+
+    Trigrams ("g:wge") answer substring queries of three characters or
+    more; tokens ("t:ls") answer shorter ones, which have no trigram.
+    """
+    text = text[:MAX_INDEXED_CHARS]
+    return set(["g:" + gram for gram in trigrams(text)] +
+               ["t:" + token for token in tokens(text)])
+
+
+def query_terms(query):
+    """Return the terms that every text containing query must have."""
+    if len(query) >= 3:
+        return set("g:" + gram for gram in trigrams(query))
+    return set("t:" + token for token in tokens(query))
+
+
+def add_postings(text_key, text):
+    """Insert the postings of a new text and count them per term."""
+    new_terms = sorted(terms(text))
+    if not new_terms:
+        return 0
+    postings = SearchPosting._get_collection()
+    try:
+        EXECUTOR.run(postings.insert_many,
+                     [{"term": term, "text": text_key}
+                      for term in new_terms],
+                     ordered=False)
+        inserted = new_terms
+    except BulkWriteError as e:
+        # Another worker indexed some of them first.
+        failed = set(error["index"] for error in
+                     e.details.get("writeErrors", []))
+        inserted = [term for position, term in enumerate(new_terms)
+                    if position not in failed]
+    if inserted:
+        EXECUTOR.run(SearchTerm._get_collection().bulk_write,
+                     [UpdateOne({"_id": term}, {"$inc": {"postings": 1}},
+                                upsert=True)
+                      for term in inserted],
+                     ordered=False)
+    return len(inserted)
+
+
+def index_command(text, timestamp, count=1):
+    """
+    Record one or more occurrences of a command text.
+
+    Only the first occurrence of a text adds postings, so indexing costs
+    a single upsert for the repeated commands that make up most sessions.
+    Returns True when the text was new.
+    """
+    if not text:
+        return False
+    key = text_id(text)
+    result = EXECUTOR.run(
+        CommandText._get_collection().update_one,
+        {"_id": key},
+        {
+            "$setOnInsert": {"text": text},
+            "$inc": {"count": count},
+            "$min": {"first_seen": timestamp},
+            "$max": {"last_seen": timestamp}
+        },
+        upsert=True
+    )
+    if result.upserted_id is None:
+        return False
+    add_postings(key, text)
+    return True
+
+
+def backfill_command(text, first_seen, last_seen, count):
+    """
+    Index a command text found in existing data.
+
+    Unlike index_command, the count is only set when the text is new,
+    so running a backfill again does not count commands twice.
+    """
+    key = text_id(text)
+    result = CommandText._get_collection().update_one(
+        {"_id": key},
+        {
+            "$setOnInsert": {"text": text, "count": count},
+            "$min": {"first_seen": first_seen},
+            "$max": {"last_seen": last_seen}
+        },
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        add_postings(key, text)
+        return True
+    # The text may be new but have been interrupted mid-indexing.
+    if not SearchPosting.objects(text=key).limit(1).count(True):
+        add_postings(key, text)
+    return False
+
+
+def search(query, limit=50, max_candidates=100000):
+    """
+    Return the CommandTexts containing query, most recently seen first.
+
+    The posting lists of the query's terms are intersected rarest first,
+    so the work done is bounded by the rarest term rather than by the
+    size of the collection; candidates are then checked for the actual
+    substring. Raises QueryTooBroad when even the rarest term occurs in
+    more than max_candidates texts.
+    """
+    wanted = query_terms(query)
+    if not wanted:
+        return []
+    stats = dict((term.id, term.postings)
+                 for term in SearchTerm.objects(id__in=list(wanted)))
+    if len(stats) < len(wanted):
+        return []
+    ordered = sorted(wanted, key=stats.get)
+    if stats[ordered[0]] > max_candidates:
+        raise QueryTooBroad(
+            "{0!r} matches more than {1} commands; make it more "
+            "specific.".format(query, max_candidates))
+
+    postings = SearchPosting._get_collection()
+    projection = {"text": True, "_id": False}
+    candidates = set(posting["text"] for posting in
+                     postings.find({"term": ordered[0]}, projection))
+    for term in ordered[1:]:
+        if not candidates:
+            return []
+        candidates = set(posting["text"] for posting in postings.find(
+            {"term": term, "text": {"$in": list(candidates)}}, projection))
+
+    needle = query.lower()
+    found = [text for text in CommandText.objects(id__in=list(candidates))
+             if needle in text.text.lower()]
+    found.sort(key=lambda text: text.last_seen or datetime.min,
+               reverse=True)
+    return found[:limit]
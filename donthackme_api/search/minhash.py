@@ -0,0 +1,175 @@
+"""MinHash signatures of command sequences and their LSH band index."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import random
+import re
+
+from donthackme_api.models import Command, Session, SessionSignature
+
+# Mersenne prime for the universal hash family, above every 60-bit value.
+PRIME = (1 << 61) - 1
+
+NUMBERS = re.compile(r"\d+")
+SPACES = re.compile(r"\s+")
+
+
+class MinHasher(object):
+    """
+    MinHash over the shingles of a session's command sequence.
+
+    A shingle is a run of `shingle` consecutive normalised commands, so
+    two sessions are similar when they ran the same steps in the same
+    order. The signature (`bands` times `rows` values) is cut into bands;
+    sessions that agree on every value of any one band share a band key
+    and are candidates for each other. With 32 bands of 4 rows, sessions
+    with a Jaccard similarity of 0.5 become candidates 87% of the time,
+    and those at 0.2 only 5% of the time.
+    """
+
+    def __init__(self, bands=32, rows=4, shingle=3, seed=1):
+        """init."""
+        self.bands = bands
+        self.rows = rows
+        self.shingle = shingle
+        generator = random.Random(seed)
+        self.permutations = [(generator.randint(1, PRIME - 1),
+                              generator.randint(0, PRIME - 1))
+                             for _ in range(bands * rows)]
+
+    @staticmethod
+    def normalise(command):
+        """
+        Return the form of a command that is compared.
+
+        Numbers are masked, so that runs of a campaign that differ only
+        in an IP address, port or file size still match.
+        """
+        return NUMBERS.sub("0", SPACES.sub(" ", command.strip().lower()))
+
+    def shingles(self, commands):
+        """Return the shingles of a command sequence."""
+        steps = [self.normalise(command) for command in commands if command]
+        if len(steps) < self.shingle:
+            return set(["\n".join(steps)]) if steps else set()
+        return set("\n".join(steps[i:i + self.shingle])
+                   for i in range(len(steps) - self.shingle + 1))
+
+    def signature(self, shingles):
+        """Return the MinHash signature of a set of shingles."""
+        values = [int(hashlib.md5(shingle.encode("utf-8")).hexdigest()[:15],
+                      16) for shingle in shingles]
+        return [min((a * value + b) % PRIME for value in values)
+                for a, b in self.permutations]
+
+    def band_keys(self, signature):
+        """Return the LSH key of every band of a signature."""
+        keys = []
+        for band in range(self.bands):
+            rows = signature[band * self.rows:(band + 1) * self.rows]
+            digest = hashlib.md5(",".join(str(row) for row in rows)
+                                 .encode("ascii")).hexdigest()[:16]
+            keys.append("{0}:{1}".format(band, digest))
+        return keys
+
+    @staticmethod
+    def similarity(first, second):
+        """Estimate the Jaccard similarity of two signatures."""
+        same = sum(1 for a, b in zip(first, second) if a == b)
+        return float(same) / len(first)
+
+
+HASHER = MinHasher()
+
+
+def candidates(signature, exclude=None, max_candidates=1000):
+    """Return the signatures sharing at least one band with signature."""
+    query = SessionSignature.objects(bands__in=signature.bands)
+    if exclude is not None:
+        query = query.filter(id__ne=exclude)
+    return list(query.exclude("bands").limit(max_candidates))
+
+
+def similar(signature, threshold=0.5, limit=20, max_candidates=1000):
+    """
+    Return [(similarity, SessionSignature)] of the sessions most like one.
+
+    Only sessions sharing a band are compared, so the cost depends on
+    the number of near neighbours rather than on the number of sessions.
+    """
+    scored = []
+    for other in candidates(signature, signature.id, max_candidates):
+        score = MinHasher.similarity(signature.minhash, other.minhash)
+        if score >= threshold:
+            scored.append((score, other))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return scored[:limit]
+
+
+def record_session(session_id, threshold=0.5, max_candidates=1000):
+    """
+    Compute and store the signature of a closed session.
+
+    The session joins the cluster of its most similar earlier session
+    when that is at least threshold alike, and otherwise starts its own,
+    so campaign clusters are maintained as sessions close. Returns the
+    signature, or None for a session without commands.
+    """
+    session = Session.objects(id=session_id).only(
+        "session", "sensor_name", "start_time").first()
+    if session is None:
+        return None
+    commands = [command.command for command in Command.objects(
+        session=session_id).only("command").order_by("timestamp")]
+    shingles = HASHER.shingles(commands)
+    if not shingles:
+        return None
+    minhash = HASHER.signature(shingles)
+    signature = SessionSignature(
+        id=session_id,
+        session=session.session,
+        sensor_name=session.sensor_name,
+        start_time=session.start_time,
+        commands=len(commands),
+        minhash=minhash,
+        bands=HASHER.band_keys(minhash)
+    )
+    nearest = similar(signature, threshold, 1, max_candidates)
+    signature.cluster = nearest[0][1].cluster if nearest else session_id
+    signature.save()
+    return signature
+
+
+def clusters(since=None, min_size=2, limit=50):
+    """Return the largest campaign clusters, optionally since a time."""
+    pipeline = []
+    if since is not None:
+        pipeline.append({"$match": {"start_time": {"$gte": since}}})
+    pipeline.extend([
+        {"$group": {
+            "_id": "$cluster",
+            "sessions": {"$sum": 1},
+            "sensors": {"$addToSet": "$sensor_name"},
+            "first_seen": {"$min": "$start_time"},
+            "last_seen": {"$max": "$start_time"},
+            "example": {"$first": "$session"}
+        }},
+        {"$match": {"sessions": {"$gte": min_size}}},
+        {"$sort": {"sessions": -1}},
+        {"$limit": limit}
+    ])
+    return list(SessionSignature._get_collection().aggregate(
+        pipeline, allowDiskUse=True))
@@ -0,0 +1,223 @@
+"""Search Blueprint for finding commands and sessions."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bson import objectid
+from flask import request, jsonify, Blueprint, current_app
+
+from donthackme_api import auth
+from donthackme_api import partitions
+from donthackme_api.cache import cached_view
+from donthackme_api.models import (AttackerProfile, ClientFingerprint,
+                                   Command, Session, SessionSignature)
+from donthackme_api.search import index
+from donthackme_api.search import minhash
+from donthackme_api.sessions.views import (BadRequest, limit, scan,
+                                           time_range)
+
+search = Blueprint('search', __name__, url_prefix="/search")
+
+
+@search.errorhandler(BadRequest)
+def bad_request(error):
+    """Report an unusable query string."""
+    return jsonify(error=str(error)), 400
+
+
+@search.errorhandler(index.QueryTooBroad)
+def too_broad(error):
+    """Report a query that would match too much to answer quickly."""
+    return jsonify(error=str(error)), 422
+
+
+@search.route("/commands", methods=["GET"])
+@auth.requires_token
+@cached_view("command")
+def search_commands():
+    """
+    Find commands containing a substring.
+
+    Query string: q (case-insensitive) and limit. Returns the matching
+    distinct commands, most recently seen first, and the latest command
+    events that ran them, with their session ids.
+    """
+    query = request.args.get("q", "").strip()
+    if not query:
+        raise BadRequest("q is required.")
+    count = limit()
+    texts = index.search(
+        query, count,
+        current_app.config.get("SEARCH_MAX_CANDIDATES", 100000))
+    commands = []
+    if texts:
+        commands = scan(Command, partitions.ROUTER.partitions(Command),
+                        "timestamp",
+                        {"command__in": [text.text for text in texts]},
+                        count)
+    return jsonify(matches=[text.to_dict() for text in texts],
+                   commands=commands)
+
+
+def threshold():
+    """Return the similarity threshold of the query string."""
+    try:
+        value = float(request.args.get(
+            "threshold",
+            current_app.config.get("SIMILARITY_THRESHOLD", 0.5)))
+    except ValueError:
+        raise BadRequest("threshold must be a number.")
+    if not 0 < value <= 1:
+        raise BadRequest("threshold must be in (0, 1].")
+    return value
+
+
+@search.route("/sessions/<session>/similar", methods=["GET"])
+@auth.requires_token
+@cached_view("session")
+def similar_sessions(session):
+    """
+    Find the closed sessions whose commands are most like a session's.
+
+    Query string: sensor_name, threshold (estimated Jaccard similarity
+    of command shingles, default SIMILARITY_THRESHOLD) and limit.
+    """
+    filters = {"session": session}
+    if "sensor_name" in request.args:
+        filters["sensor_name"] = request.args["sensor_name"]
+    signature = SessionSignature.objects(**filters).order_by(
+        "-start_time").first()
+    if signature is None:
+        msg = ("Session {0} has no signature; it is still open or ran no "
+               "commands.").format(session)
+        return jsonify(error=msg), 404
+    found = minhash.similar(
+        signature, threshold(), limit(),
+        current_app.config.get("SIMILARITY_MAX_CANDIDATES", 1000))
+    results = []
+    for score, other in found:
+        result = other.to_dict()
+        result["similarity"] = score
+        results.append(result)
+    return jsonify(session=signature.to_dict(), similar=results)
+
+
+@search.route("/clusters", methods=["GET"])
+@auth.requires_token
+@cached_view("session")
+def list_clusters():
+    """
+    List the largest campaign clusters of similar sessions.
+
+    Query string: start (ISO 8601, on start_time), min_size and limit.
+    """
+    start, _ = time_range()
+    try:
+        min_size = int(request.args.get("min_size", 2))
+    except ValueError:
+        raise BadRequest("min_size must be an integer.")
+    results = []
+    for cluster in minhash.clusters(start, min_size, limit()):
+        results.append({
+            "cluster": str(cluster["_id"]),
+            "sessions": cluster["sessions"],
+            "sensors": sorted(name for name in cluster["sensors"] if name),
+            "first_seen": cluster["first_seen"].isoformat()
+            if cluster["first_seen"] else None,
+            "last_seen": cluster["last_seen"].isoformat()
+            if cluster["last_seen"] else None,
+            "example": cluster["example"]
+        })
+    return jsonify(clusters=results)
+
+
+@search.route("/clusters/<cluster>", methods=["GET"])
+@auth.requires_token
+@cached_view("session")
+def get_cluster(cluster):
+    """List the sessions of a campaign cluster, newest first."""
+    if not objectid.ObjectId.is_valid(cluster):
+        raise BadRequest("{0} is not a cluster id.".format(cluster))
+    members = SessionSignature.objects(
+        cluster=objectid.ObjectId(cluster)
+    ).exclude("minhash", "bands").order_by("-start_time").limit(limit())
+    return jsonify(cluster=cluster,
+                   sessions=[member.to_dict() for member in members])
+
+
+@search.route("/clients", methods=["GET"])
+@auth.requires_token
+@cached_view("session")
+def list_clients():
+    """
+    List the SSH clients seen, by HASSH fingerprint.
+
+    Query string: start (ISO 8601, on last_seen), such as the start of
+    today for the tools that hit us today, and limit. The busiest
+    clients come first.
+    """
+    start, _ = time_range()
+    clients = ClientFingerprint.objects
+    if start is not None:
+        clients = clients.filter(last_seen__gte=start)
+    clients = clients.order_by("-sessions").limit(limit())
+    return jsonify(clients=[client.to_dict() for client in clients])
+
+
+@search.route("/clients/<fingerprint>", methods=["GET"])
+@auth.requires_token
+@cached_view("session")
+def get_client(fingerprint):
+    """Describe an SSH client and list its latest sessions."""
+    client = ClientFingerprint.objects(id=fingerprint.lower()).first()
+    if client is None:
+        msg = "Client {0} has not been seen.".format(fingerprint)
+        return jsonify(error=msg), 404
+    count = limit()
+    sessions = []
+    for suffix in partitions.ROUTER.partitions(Session):
+        with partitions.use(suffix):
+            for session in Session.objects(ssh_hassh=client.id).only(
+                    "session", "sensor_name", "source_ip", "start_time",
+                    "ssh_version").order_by("-start_time").limit(
+                    count - len(sessions)):
+                sessions.append({
+                    "session": session.session,
+                    "sensor_name": session.sensor_name,
+                    "source_ip": session.source_ip,
+                    "start_time": session.start_time.isoformat()
+                    if session.start_time else None,
+                    "ssh_version": session.ssh_version
+                })
+        if len(sessions) >= count:
+            break
+    return jsonify(client=client.to_dict(), sessions=sessions)
+
+
+@search.route("/attackers/<ip>", methods=["GET"])
+@auth.requires_token
+@cached_view("session", "credentials", "command", "download")
+def get_attacker(ip):
+    """
+    Profile a source IP from one read.
+
+    Returns its session, login and command counts, first and last
+    sightings, and the sensors, credentials, download hashes and client
+    fingerprints seen from it.
+    """
+    attacker = AttackerProfile.objects(id=ip).first()
+    if attacker is None:
+        msg = "No sessions from {0} have been seen.".format(ip)
+        return jsonify(error=msg), 404
+    return jsonify(attacker=attacker.to_dict())
@@ -0,0 +1,300 @@
+"""Sessions Blueprint for reading collected data."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from flask import request, jsonify, Blueprint, Response
+
+from donthackme_api import auth
+from donthackme_api import blobstore
+from donthackme_api import partitions
+from donthackme_api import retention
+from donthackme_api import ttylog
+from donthackme_api.cache import cached_view
+from donthackme_api.models import Command, Session
+
+import base64
+import io
+import json
+
+sessions = Blueprint('sessions', __name__, url_prefix="/sessions")
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+class BadRequest(ValueError):
+    """A query string argument could not be used."""
+
+
+def time_range():
+    """Return the (start, end) datetimes of the query string."""
+    bounds = []
+    for name in ("start", "end"):
+        value = request.args.get(name)
+        if value is None:
+            bounds.append(None)
+            continue
+        try:
+            bounds.append(partitions.to_datetime(value))
+        except (ValueError, OverflowError):
+            raise BadRequest("{0} is not a valid timestamp.".format(name))
+    return tuple(bounds)
+
+
+def limit():
+    """Return the number of results requested, within MAX_LIMIT."""
+    try:
+        value = int(request.args.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise BadRequest("limit must be an integer.")
+    return max(1, min(value, MAX_LIMIT))
+
+
+def scan(document, suffixes, field, filters, count):
+    """
+    Query partitions newest first until count results are found.
+
+    Each result is converted with to_dict while its partition is active,
+    so that references into the same partition are dereferenced there.
+    """
+    results = []
+    for suffix in suffixes:
+        with partitions.use(suffix):
+            queryset = document.objects(**filters).order_by(
+                "-" + field).limit(count - len(results))
+            for item in queryset:
+                response = item.to_dict()
+                response["id"] = str(item.id)
+                results.append(response)
+        if len(results) >= count:
+            break
+    return results
+
+
+@sessions.errorhandler(BadRequest)
+def bad_request(error):
+    """Report an unusable query string."""
+    return jsonify(error=str(error)), 400
+
+
+@sessions.route("/", methods=["GET"])
+@auth.requires_token
+@cached_view("session", "command", "credentials", "download",
+             "fingerprint", "tcp_connection")
+def list_sessions():
+    """
+    List sessions, newest first.
+
+    Query string: start, end (ISO 8601, on start_time), source_ip,
+    sensor_name and limit.
+    """
+    start, end = time_range()
+    filters = dict((key, request.args[key])
+                   for key in ("source_ip", "sensor_name")
+                   if key in request.args)
+    if start is not None:
+        filters["start_time__gte"] = start
+    if end is not None:
+        filters["start_time__lt"] = end
+    suffixes = partitions.ROUTER.partitions(Session, start, end)
+    return jsonify(sessions=scan(Session, suffixes, "start_time",
+                                 filters, limit()))
+
+
+@sessions.route("/commands", methods=["GET"])
+@auth.requires_token
+@cached_view("command")
+def list_commands():
+    """
+    List commands, newest first.
+
+    Query string: start, end (ISO 8601, on timestamp), command,
+    sensor_name and limit.
+    """
+    start, end = time_range()
+    filters = dict((key, request.args[key])
+                   for key in ("command", "sensor_name")
+                   if key in request.args)
+    if start is not None:
+        filters["timestamp__gte"] = start
+    if end is not None:
+        filters["timestamp__lt"] = end
+    # Commands live in their session's partition, which may begin up to
+    # PARTITION_SESSION_MAX_AGE before the command itself.
+    partition_start = None
+    if start is not None:
+        partition_start = start - partitions.ROUTER.session_max_age
+    suffixes = partitions.ROUTER.partitions(Command, partition_start, end)
+    return jsonify(commands=scan(Command, suffixes, "timestamp",
+                                 filters, limit()))
+
+
+@sessions.route("/<session>", methods=["GET"])
+@auth.requires_token
+@cached_view("session", "command", "credentials", "download",
+             "fingerprint", "tcp_connection")
+def get_session(session):
+    """
+    Return one session and its children.
+
+    Sessions that have expired are read from the archive.
+
+    Query string: sensor_name, when several sensors reuse a session id.
+    """
+    sensor_name = request.args.get("sensor_name")
+    filters = {"session": session}
+    if sensor_name is not None:
+        filters["sensor_name"] = sensor_name
+    found = scan(Session, partitions.ROUTER.partitions(Session),
+                 "start_time", filters, 1)
+    if found:
+        return jsonify(session=found[0])
+    archived = retention.archive().lookup(session, sensor_name)
+    if archived:
+        response = retention.jsonable(archived[0])
+        response["id"] = response.pop("_id")
+        return jsonify(session=response, archived=True)
+    msg = "Session {0} Not Found.".format(session)
+    return jsonify(error=msg), 404
+
+
+def offset_argument(name):
+    """Return a query string offset in seconds, or None."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise BadRequest("{0} must be a number of seconds.".format(name))
+
+
+def open_ttylog(session, sensor_name=None):
+    """
+    Return the TTY log of a session as a file-like object, or None.
+
+    Only the log is fetched, not the session's children, and logs in
+    the blob store are read from GridFS a chunk at a time. Logs that
+    have expired or been removed from the database are read from the
+    archive.
+    """
+    filters = {"session": session}
+    if sensor_name is not None:
+        filters["sensor_name"] = sensor_name
+    for suffix in partitions.ROUTER.partitions(Session):
+        with partitions.use(suffix):
+            found = Session.objects(**filters).only(
+                "ttylog.sha256", "ttylog.log_binary").order_by(
+                "-start_time").first()
+        if found is None or found.ttylog is None:
+            continue
+        if found.ttylog.sha256:
+            stream = blobstore.open_blob(found.ttylog.sha256)
+            if stream is not None:
+                return stream
+        elif found.ttylog.log_binary:
+            return io.BytesIO(found.ttylog.log_binary)
+    for document in retention.archive().lookup(session, sensor_name):
+        binary = (document.get("ttylog") or {}).get("log_binary")
+        if binary:
+            return io.BytesIO(bytes(binary))
+    return None
+
+
+def frame_lines(frames):
+    """Yield frames as newline-delimited JSON."""
+    for frame in frames:
+        yield json.dumps({
+            "offset": round(frame.offset, 6),
+            "time": frame.time,
+            "op": frame.op,
+            "direction": ttylog.DIRECTIONS.get(frame.direction),
+            "data": base64.b64encode(frame.data).decode("ascii")
+        }) + "\n"
+
+
+@sessions.route("/<session>/ttylog", methods=["GET"])
+@auth.requires_token
+def get_ttylog(session):
+    """
+    Stream the TTY log of a session.
+
+    Query string:
+        sensor_name: when several sensors reuse a session id.
+        format: raw (default) for the cowrie binary log, frames for one
+            JSON object per line per record, or index for a map of
+            seconds to byte positions in the raw log.
+        start, end: offsets in seconds from the first record; end is
+            exclusive. A raw log is cut at the records they fall on.
+        direction: input or output, to only stream frames of one side.
+        interval: seconds between index points (default 1).
+
+    Raw logs honour a single-range Range header, relative to the cut
+    when start or end are given, so players can seek without fetching
+    the whole log.
+    """
+    stream = open_ttylog(session, request.args.get("sensor_name"))
+    if stream is None:
+        msg = "Session {0} has no TTY log.".format(session)
+        return jsonify(error=msg), 404
+    start = offset_argument("start")
+    end = offset_argument("end")
+    output = request.args.get("format", "raw")
+
+    if output == "index":
+        interval = offset_argument("interval") or 1.0
+        return jsonify(index=ttylog.seek_index(stream, interval))
+
+    if output == "frames":
+        directions = None
+        if "direction" in request.args:
+            names = dict((name, value) for value, name
+                         in ttylog.DIRECTIONS.items())
+            if request.args["direction"] not in names:
+                raise BadRequest("direction must be input or output.")
+            directions = (names[request.args["direction"]],)
+        stream.seek(0)
+        return Response(frame_lines(ttylog.frames(stream, start, end,
+                                                  directions)),
+                        mimetype="application/x-ndjson")
+
+    if output != "raw":
+        raise BadRequest("format must be raw, frames or index.")
+
+    stream.seek(0, io.SEEK_END)
+    first, last = 0, stream.tell()
+    if start is not None:
+        position = ttylog.position_at(stream, start)
+        first = last if position is None else position
+    if end is not None:
+        position = ttylog.position_at(stream, end)
+        last = last if position is None else max(first, position)
+    length = last - first
+
+    status = 200
+    headers = {"Accept-Ranges": "bytes"}
+    byte_range = request.range
+    if byte_range is not None and len(byte_range.ranges) == 1:
+        bounds = byte_range.range_for_length(length)
+        if bounds is None:
+            headers["Content-Range"] = "bytes */{0}".format(length)
+            return Response(status=416, headers=headers)
+        status = 206
+        headers["Content-Range"] = "bytes {0}-{1}/{2}".format(
+            bounds[0], bounds[1] - 1, length)
+        first, last = first + bounds[0], first + bounds[1]
+    headers["Content-Length"] = str(last - first)
+    return Response(ttylog.chunks(stream, first, last), status=status,
+                    headers=headers, mimetype="application/octet-stream")
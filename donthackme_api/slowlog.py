@@ -0,0 +1,356 @@
+"""Log of slow MongoDB commands with their route, shape and plan."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from Queue import Full, Queue
+
+from bson.son import SON
+
+from flask import has_request_context, request
+
+from pymongo import monitoring
+
+from donthackme_api import metrics
+from donthackme_api.tracing import ProcessFileHandler
+
+# Parts of each command that describe the query, by command name.
+SHAPE_FIELDS = {
+    "find": ("filter", "sort", "projection", "hint"),
+    "aggregate": ("pipeline",),
+    "count": ("query",),
+    "distinct": ("key", "query"),
+    "findAndModify": ("query", "sort", "update", "remove", "upsert"),
+    "findandmodify": ("query", "sort", "update", "remove", "upsert"),
+    "update": ("updates",),
+    "delete": ("deletes",),
+    "getMore": (),
+    "insert": (),
+}
+
+# Commands the server can explain.
+EXPLAINABLE = set(["find", "aggregate", "count", "distinct",
+                   "findAndModify", "findandmodify", "update", "delete"])
+
+# Fields added by the driver, which explain does not accept.
+DRIVER_FIELDS = set(["lsid", "$db", "$clusterTime", "$readPreference",
+                     "txnNumber", "writeConcern", "readConcern",
+                     "cursor", "batchSize", "maxTimeMS"])
+
+metrics.REGISTRY.describe("donthackme_mongo_slow_commands_total",
+                          "MongoDB commands over SLOWLOG_THRESHOLD_MS.")
+
+writer = logging.getLogger("donthackme_api.slowlog")
+writer.propagate = False
+
+_explaining = threading.local()
+
+
+def redact(value):
+    """
+    Return the shape of a query: its keys and operators, without values.
+
+    Scalars become "?"; a list becomes the shape of its first item, so
+    that an $in over three ids and one over three hundred match.
+    """
+    if isinstance(value, dict):
+        return dict((key, redact(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [redact(value[0])] + (["..."] if len(value) > 1 else []) \
+            if value else []
+    return "?"
+
+
+def shape(command_name, command):
+    """Return the redacted shape of a command."""
+    result = {}
+    for field in SHAPE_FIELDS.get(command_name, ()):
+        if field in command:
+            if field in ("updates", "deletes"):
+                # Bulk writes show their first statement and a count.
+                statements = command[field]
+                first = statements[0] if statements else {}
+                result[field] = redact(dict(
+                    (key, first[key]) for key in ("q", "u") if key in first))
+                result["statements"] = len(statements)
+            elif field in ("key", "sort"):
+                # Field names and directions, not values.
+                result[field] = command[field]
+            else:
+                result[field] = redact(command[field])
+    if command_name == "insert":
+        result["documents"] = len(command.get("documents", ()))
+    return result
+
+
+def plan_summary(plan):
+    """Summarise a winning plan as its stages, outermost first."""
+    stages = []
+    while isinstance(plan, dict):
+        stage = plan.get("stage", "?")
+        if "indexName" in plan:
+            stage += " " + plan["indexName"]
+        stages.append(stage)
+        plan = plan.get("inputStage") or \
+            (plan.get("inputStages") or [None])[0]
+    return " <- ".join(stages) if stages else None
+
+
+class SlowLog(object):
+    """
+    Record MongoDB commands slower than a threshold.
+
+    The request path only times commands and, for slow ones, queues a
+    record; a background thread writes the records to this worker's
+    JSON-lines file in `directory`, after running explain on a sample
+    of them. A shape is explained at most once per `explain_interval`.
+    """
+
+    def __init__(self):
+        """init."""
+        self.enabled = False
+        self.threshold = 0.1
+        self.explain_rate = 0.1
+        self.explain_interval = 300
+        self.directory = None
+        self._queue = Queue(1000)
+        self._explained = {}
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, record, command=None):
+        """Queue a record, with the command when it is to be explained."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive a fork: start this worker's own.
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        try:
+            self._queue.put_nowait((record, command))
+        except Full:
+            pass
+
+    def wants_explain(self, key):
+        """Return True when a command of this shape should be explained."""
+        if random.random() >= self.explain_rate:
+            return False
+        now = time.time()
+        with self._lock:
+            if now - self._explained.get(key, 0) < self.explain_interval:
+                return False
+            self._explained[key] = now
+        return True
+
+    def _run(self):
+        _explaining.active = True
+        while True:
+            record, command = self._queue.get()
+            if command is not None:
+                self._explain(record, command)
+            try:
+                writer.info(json.dumps(record, default=str))
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    "Slow command not logged.")
+
+    @staticmethod
+    def _explain(record, command):
+        from mongoengine.connection import get_connection
+
+        name = record["command"]
+        # The server takes the first key as the command name, so the
+        # order of the driver's SON has to be kept, with the name first.
+        explained = SON([(name, command[name])])
+        for key, value in command.items():
+            if key != name and key not in DRIVER_FIELDS:
+                explained[key] = value
+        if name == "aggregate":
+            explained["cursor"] = {}
+        try:
+            result = get_connection()[record["database"]].command(
+                "explain", explained, verbosity="queryPlanner")
+        except Exception as e:
+            record["explain_error"] = str(e)
+            return
+        planner = result.get("queryPlanner") or {}
+        if not planner and result.get("stages"):
+            # Aggregations explain their $cursor stage instead.
+            planner = result["stages"][0].get("$cursor", {}).get(
+                "queryPlanner", {})
+        # Only the stages and index names are kept: the plan itself
+        # carries the query's values in its filters and index bounds.
+        record["plan_summary"] = plan_summary(planner.get("winningPlan"))
+
+    def listener(self):
+        """Return the pymongo listener feeding this log."""
+        return CommandListener(self)
+
+    def summary(self, since=None, limit=50):
+        """
+        Group the records of every worker's files by route and shape.
+
+        Returns the groups with the most total time first, each with its
+        count, total and maximum duration, last sighting and latest plan
+        summary.
+        """
+        groups = {}
+        pattern = os.path.join(self.directory, "slowlog.*.jsonl*")
+        for path in glob.glob(pattern):
+            try:
+                with open(path) as log:
+                    lines = log.readlines()
+            except IOError:
+                continue
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if since is not None and record["time"] < since:
+                    continue
+                key = (record.get("route"), record["shape_id"])
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = {
+                        "route": record.get("route"),
+                        "command": record["command"],
+                        "collection": record.get("collection"),
+                        "shape": record["shape"],
+                        "count": 0,
+                        "total_ms": 0.0,
+                        "max_ms": 0.0,
+                        "last_seen": 0
+                    }
+                group["count"] += 1
+                group["total_ms"] += record["duration_ms"]
+                group["max_ms"] = max(group["max_ms"],
+                                      record["duration_ms"])
+                if record["time"] >= group["last_seen"]:
+                    group["last_seen"] = record["time"]
+                if record.get("plan_summary"):
+                    group["plan_summary"] = record["plan_summary"]
+        ordered = sorted(groups.values(), key=lambda item: item["total_ms"],
+                         reverse=True)
+        return ordered[:limit]
+
+
+class CommandListener(monitoring.CommandListener):
+    """Time commands and hand those over the threshold to a SlowLog."""
+
+    def __init__(self, log):
+        """init."""
+        self.log = log
+        self._inflight = {}
+
+    def started(self, event):
+        """Remember a command and the request that issued it."""
+        if not self.log.enabled or \
+                getattr(_explaining, "active", False):
+            return
+        route = None
+        if has_request_context() and request.url_rule is not None:
+            route = "{0} {1}".format(request.method, request.url_rule.rule)
+        self._inflight[(event.connection_id, event.request_id)] = (
+            event.command, route)
+
+    def succeeded(self, event):
+        """Record the command if it was slow."""
+        self._finish(event, None)
+
+    def failed(self, event):
+        """Record the command if it was slow, with its error."""
+        self._finish(event, event.failure.get("errmsg"))
+
+    def _finish(self, event, error):
+        started = self._inflight.pop(
+            (event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        duration = event.duration_micros / 1e6
+        if duration < self.log.threshold:
+            return
+        command, route = started
+        name = event.command_name
+        collection = command.get(name)
+        if not isinstance(collection, basestring):
+            collection = None
+        query = shape(name, command)
+        shape_id = hashlib.sha1(json.dumps(
+            [name, collection, query], sort_keys=True)
+        ).hexdigest()[:16]
+        metrics.inc("donthackme_mongo_slow_commands_total",
+                    {"collection": collection or "", "command": name})
+        record = {
+            "time": time.time(),
+            "pid": os.getpid(),
+            "route": route,
+            "database": event.database_name,
+            "collection": collection,
+            "command": name,
+            "duration_ms": round(duration * 1000.0, 3),
+            "shape": query,
+            "shape_id": shape_id
+        }
+        if error is not None:
+            record["error"] = error
+        explain = name in EXPLAINABLE and \
+            self.log.wants_explain((route, shape_id))
+        self.log.submit(record, SON(command) if explain else None)
+
+
+SLOWLOG = SlowLog()
+
+_listener_registered = False
+
+
+def init_app(app):
+    """Log slow commands to SLOWLOG_DIR, before the client is made."""
+    global _listener_registered
+    SLOWLOG.enabled = bool(app.config.get("SLOWLOG_ENABLED", True))
+    SLOWLOG.threshold = app.config.get("SLOWLOG_THRESHOLD_MS", 100) / 1000.0
+    SLOWLOG.explain_rate = app.config.get("SLOWLOG_EXPLAIN_RATE", 0.1)
+    SLOWLOG.explain_interval = app.config.get("SLOWLOG_EXPLAIN_INTERVAL",
+                                              300)
+    SLOWLOG.directory = app.config.get("SLOWLOG_DIR",
+                                       "/tmp/donthackme_slowlog")
+    if not SLOWLOG.enabled:
+        return
+    try:
+        os.makedirs(SLOWLOG.directory)
+    except OSError:
+        if not os.path.isdir(SLOWLOG.directory):
+            raise
+    handler = ProcessFileHandler(
+        SLOWLOG.directory, "slowlog",
+        app.config.get("SLOWLOG_MAX_BYTES", 10 * 1024 * 1024),
+        app.config.get("SLOWLOG_BACKUPS", 3)
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    writer.handlers = [handler]
+    writer.setLevel(logging.INFO)
+    if not _listener_registered:
+        monitoring.register(SLOWLOG.listener())
+        _listener_registered = True
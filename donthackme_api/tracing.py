@@ -0,0 +1,384 @@
+"""Per-request tracing with timed spans, exported as OTLP JSON lines."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+from logging.handlers import RotatingFileHandler
+
+from flask import request
+
+from pymongo import monitoring
+
+# OTLP span kinds.
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+# OTLP status codes.
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# W3C trace context: version-traceid-parentid-flags.
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_local = threading.local()
+
+exporter = logging.getLogger("donthackme_api.traces")
+exporter.propagate = False
+
+settings = {
+    "enabled": False,
+    "sample_rate": 0.01,
+    "slow_seconds": 0.5,
+    "keep_errors": True,
+    "max_spans": 1000,
+    "service": "donthackme_api"
+}
+
+
+def _id(size):
+    return binascii.hexlify(os.urandom(size)).decode("ascii")
+
+
+def _now():
+    return int(time.time() * 1e9)
+
+
+class Span(object):
+    """A timed operation within a trace."""
+
+    __slots__ = ("span_id", "parent_id", "name", "kind", "start", "end",
+                 "attributes", "error")
+
+    def __init__(self, parent_id, name, kind, attributes):
+        """init."""
+        self.span_id = _id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = _now()
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    def finish(self, error=None):
+        """End the span, optionally as failed."""
+        self.end = _now()
+        if error is not None:
+            self.error = error
+
+
+class Trace(object):
+    """
+    The spans of one request.
+
+    Spans are always recorded, as that costs little; whether the trace
+    is written out is decided when the request ends (see keep).
+    """
+
+    def __init__(self, trace_id=None, parent_id=None, sampled=False):
+        """init."""
+        self.trace_id = trace_id or _id(16)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.spans = []
+        self.stack = []
+        self.dropped = 0
+
+    def start(self, name, kind=KIND_INTERNAL, attributes=None, push=True):
+        """Open a span under the innermost open one, or return None."""
+        if len(self.spans) >= settings["max_spans"]:
+            self.dropped += 1
+            return None
+        parent = self.stack[-1].span_id if self.stack else self.parent_id
+        span = Span(parent, name, kind, attributes or {})
+        self.spans.append(span)
+        if push:
+            self.stack.append(span)
+        return span
+
+    def finish(self, span, error=None):
+        """Close a span opened by start."""
+        span.finish(error)
+        if self.stack and self.stack[-1] is span:
+            self.stack.pop()
+
+    def keep(self):
+        """
+        Decide whether to export the trace, once its root has ended.
+
+        Head sampling keeps sample_rate of all requests (or whatever an
+        incoming traceparent decided); tail sampling also keeps every
+        request slower than slow_seconds or that failed.
+        """
+        if self.sampled:
+            return True
+        root = self.spans[0] if self.spans else None
+        if root is None or root.end is None:
+            return False
+        if (root.end - root.start) / 1e9 >= settings["slow_seconds"]:
+            return True
+        return settings["keep_errors"] and root.error is not None
+
+
+def current():
+    """Return the trace of the request being handled, if any."""
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time the block as a span of the current trace, if there is one."""
+    trace = current()
+    opened = trace.start(name, attributes=attributes) \
+        if trace is not None else None
+    if opened is None:
+        yield None
+        return
+    try:
+        yield opened
+    except Exception as e:
+        trace.finish(opened, "{0}: {1}".format(type(e).__name__, e))
+        raise
+    trace.finish(opened)
+
+
+def traced(name=None):
+    """Decorate a function to run in a span named after it."""
+    def decorator(f):
+        label = name or f.__name__
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(label):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, (int, long)):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": u"{0}".format(value)}
+
+
+def _attributes(values):
+    return [{"key": key, "value": _value(value)}
+            for key, value in sorted(values.items()) if value is not None]
+
+
+def to_otlp(trace):
+    """Return a trace as an OTLP/JSON ExportTraceServiceRequest."""
+    spans = []
+    for item in trace.spans:
+        if item.end is None:
+            item.finish("span not finished")
+        record = {
+            "traceId": trace.trace_id,
+            "spanId": item.span_id,
+            "name": item.name,
+            "kind": item.kind,
+            "startTimeUnixNano": str(item.start),
+            "endTimeUnixNano": str(item.end),
+            "attributes": _attributes(item.attributes),
+            "status": {"code": STATUS_ERROR, "message": item.error}
+            if item.error else {"code": STATUS_OK}
+        }
+        if item.parent_id:
+            record["parentSpanId"] = item.parent_id
+        spans.append(record)
+    resource = {"service.name": settings["service"],
+                "process.pid": os.getpid()}
+    if trace.dropped:
+        resource["donthackme.dropped_spans"] = trace.dropped
+    return {"resourceSpans": [{
+        "resource": {"attributes": _attributes(resource)},
+        "scopeSpans": [{
+            "scope": {"name": __name__},
+            "spans": spans
+        }]
+    }]}
+
+
+def _begin():
+    if not settings["enabled"]:
+        return
+    parent_id = None
+    sampled = random.random() < settings["sample_rate"]
+    match = TRACEPARENT.match(request.headers.get("traceparent", ""))
+    if match is not None:
+        trace_id, parent_id, flags = match.groups()
+        sampled = sampled or bool(int(flags, 16) & 1)
+    else:
+        trace_id = None
+    trace = _local.trace = Trace(trace_id, parent_id, sampled)
+    rule = request.url_rule.rule if request.url_rule else request.path
+    trace.start("{0} {1}".format(request.method, rule), KIND_SERVER, {
+        "http.method": request.method,
+        "http.route": rule,
+        "http.target": request.full_path
+    })
+
+
+def _annotate(response):
+    trace = current()
+    if trace is not None and trace.spans:
+        root = trace.spans[0]
+        root.attributes["http.status_code"] = response.status_code
+        if response.status_code >= 500:
+            root.error = "HTTP {0}".format(response.status_code)
+        response.headers["X-Trace-Id"] = trace.trace_id
+    return response
+
+
+def _end(exc=None):
+    trace = current()
+    _local.trace = None
+    if trace is None or not trace.spans:
+        return
+    root = trace.spans[0]
+    if exc is not None:
+        root.error = "{0}: {1}".format(type(exc).__name__, exc)
+    root.finish(root.error)
+    if trace.keep():
+        try:
+            exporter.info(json.dumps(to_otlp(trace)))
+        except Exception:
+            logging.getLogger(__name__).exception("Trace not exported.")
+
+
+class ProcessFileHandler(RotatingFileHandler):
+    """
+    Rotating file named after the writing process.
+
+    Several processes cannot share a rotation, so each uWSGI worker
+    writes its own file; the name is chosen again after a fork.
+    """
+
+    def __init__(self, directory, prefix, max_bytes, backups):
+        """init."""
+        self.directory = directory
+        self.prefix = prefix
+        self._pid = os.getpid()
+        RotatingFileHandler.__init__(self, self._filename(),
+                                     maxBytes=max_bytes,
+                                     backupCount=backups, delay=True)
+
+    def _filename(self):
+        return os.path.abspath(os.path.join(
+            self.directory, "{0}.{1}.jsonl".format(self.prefix,
+                                                   os.getpid())))
+
+    def emit(self, record):
+        """Write a record, to this process's own file."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.stream = None
+            self.baseFilename = self._filename()
+        RotatingFileHandler.emit(self, record)
+
+
+class CommandListener(monitoring.CommandListener):
+    """Add a span for every MongoDB command run during a traced request."""
+
+    def __init__(self):
+        """init."""
+        self._inflight = {}
+
+    def started(self, event):
+        """Open a client span under the innermost open span."""
+        trace = current()
+        if trace is None:
+            return
+        collection = event.command.get(event.command_name)
+        opened = trace.start(
+            "mongodb {0}".format(event.command_name), KIND_CLIENT, {
+                "db.system": "mongodb",
+                "db.name": event.database_name,
+                "db.operation": event.command_name,
+                "db.mongodb.collection": collection
+                if isinstance(collection, basestring) else None
+            }, push=False)
+        if opened is not None:
+            self._inflight[(event.connection_id, event.request_id)] = opened
+
+    def succeeded(self, event):
+        """Close the span of a command."""
+        opened = self._inflight.pop(
+            (event.connection_id, event.request_id), None)
+        if opened is not None:
+            opened.finish()
+
+    def failed(self, event):
+        """Close the span of a command as failed."""
+        opened = self._inflight.pop(
+            (event.connection_id, event.request_id), None)
+        if opened is not None:
+            opened.finish(u"{0}".format(event.failure.get("errmsg")))
+
+
+_listener_registered = False
+
+
+def register_listener():
+    """Register the MongoDB span listener, before the client is made."""
+    global _listener_registered
+    if not _listener_registered:
+        monitoring.register(CommandListener())
+        _listener_registered = True
+
+
+def init_app(app):
+    """Trace requests when TRACE_ENABLED, into rotating files."""
+    settings["enabled"] = bool(app.config.get("TRACE_ENABLED", False))
+    settings["sample_rate"] = app.config.get("TRACE_SAMPLE_RATE", 0.01)
+    settings["slow_seconds"] = app.config.get("TRACE_SLOW_MS", 500) / 1000.0
+    settings["keep_errors"] = app.config.get("TRACE_KEEP_ERRORS", True)
+    settings["max_spans"] = app.config.get("TRACE_MAX_SPANS", 1000)
+    settings["service"] = app.name
+    if not settings["enabled"]:
+        return
+    directory = app.config.get("TRACE_DIR", "/tmp/donthackme_traces")
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    handler = ProcessFileHandler(
+        directory, "traces",
+        app.config.get("TRACE_MAX_BYTES", 50 * 1024 * 1024),
+        app.config.get("TRACE_BACKUPS", 5)
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    exporter.handlers = [handler]
+    exporter.setLevel(logging.INFO)
+    register_listener()
+    app.before_request(_begin)
+    app.after_request(_annotate)
+    app.teardown_request(_end)
@@ -0,0 +1,131 @@
+"""Lazy reader for cowrie's binary TTY log format."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import struct
+
+from collections import namedtuple
+
+# op, tty, length, direction, seconds, microseconds
+RECORD = struct.Struct("<iLiiLL")
+
+OP_OPEN = 1
+OP_CLOSE = 2
+OP_WRITE = 3
+OP_EXEC = 4
+
+TYPE_INPUT = 1
+TYPE_OUTPUT = 2
+TYPE_INTERACT = 3
+
+DIRECTIONS = {
+    TYPE_INPUT: "input",
+    TYPE_OUTPUT: "output",
+    TYPE_INTERACT: "interact",
+}
+
+CHUNK_SIZE = 64 * 1024
+
+# Longest record data accepted; cowrie writes a record per terminal
+# read or write, far shorter than this. A longer or negative length
+# means the log is corrupt.
+MAX_RECORD = 16 * 1024 * 1024
+
+
+class Frame(namedtuple("Frame", ["position", "size", "op", "direction",
+                                 "time", "offset", "data"])):
+    """
+    One record of a TTY log.
+
+    position and size locate the whole record, header included, in the
+    log. time is in seconds since the epoch, offset in seconds since the
+    first record. data is None when the reader was asked to skip it.
+    """
+
+
+def frames(stream, start=None, end=None, directions=None, data=True):
+    """
+    Yield the frames of a TTY log read from a file-like stream.
+
+    start and end are offsets in seconds from the first frame; a frame
+    at end is not included. Only one frame is held at a time, and the
+    data of frames that are filtered out (or all data, without data) is
+    skipped rather than read. A truncated last record, or one whose
+    length is negative or over MAX_RECORD, ends the log.
+    """
+    first = None
+    position = stream.tell()
+    while True:
+        header = stream.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        op, _, length, direction, sec, usec = RECORD.unpack(header)
+        if not 0 <= length <= MAX_RECORD:
+            return
+        when = sec + usec / 1000000.0
+        if first is None:
+            first = when
+        offset = when - first
+        if end is not None and offset >= end:
+            return
+        wanted = (start is None or offset >= start) and \
+            (directions is None or direction in directions)
+        if wanted and data:
+            payload = stream.read(length)
+            if len(payload) < length:
+                return
+        else:
+            payload = None
+            stream.seek(length, os.SEEK_CUR)
+        if wanted:
+            yield Frame(position, RECORD.size + length, op, direction,
+                        when, offset, payload)
+        position += RECORD.size + length
+
+
+def seek_index(stream, interval=1.0):
+    """
+    Return [(seconds, byte position)] at most every interval seconds.
+
+    A player can map a time to the byte position of the first record at
+    or after it, then request the log from there with a Range header.
+    """
+    points = []
+    stream.seek(0)
+    for frame in frames(stream, data=False):
+        if not points or frame.offset - points[-1][0] >= interval:
+            points.append((round(frame.offset, 6), frame.position))
+    return points
+
+
+def position_at(stream, seconds):
+    """Return the byte position of the first record at or after seconds."""
+    stream.seek(0)
+    for frame in frames(stream, start=seconds, data=False):
+        return frame.position
+    return None
+
+
+def chunks(stream, start, stop, size=CHUNK_SIZE):
+    """Yield the bytes of stream from start up to stop, a chunk at a time."""
+    stream.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = stream.read(min(size, remaining))
+        if not chunk:
+            return
+        remaining -= len(chunk)
+        yield chunk
@@ -0,0 +1,175 @@
+"""Configurable write concern tiers for ingest writes."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from flask import current_app, g, has_request_context, request
+
+from mongoengine.queryset import transform
+
+from pymongo.write_concern import WriteConcern
+
+from donthackme_api import metrics
+from donthackme_api import partitions
+from donthackme_api import tracing
+from donthackme_api.concurrency import COALESCER, EXECUTOR
+
+
+metrics.REGISTRY.describe("donthackme_write_duration_seconds",
+                          "Write latency by write concern tier and "
+                          "collection.")
+
+
+def current_event():
+    """Return the cowrie event being handled, if any."""
+    if not has_request_context():
+        return None
+    override = getattr(g, "write_concern_event", None)
+    if override is not None:
+        return override
+    if request.url_rule is None:
+        return None
+    return metrics.event_type(request.url_rule.rule)
+
+
+def tier_for(collection, event=None):
+    """
+    Pick the tier for a write.
+
+    WRITE_CONCERN_COLLECTIONS wins over WRITE_CONCERN_EVENTS, which wins
+    over WRITE_CONCERN_DEFAULT_TIER. Collections are named without their
+    partition suffix.
+    """
+    config = current_app.config
+    tier = config.get("WRITE_CONCERN_COLLECTIONS", {}).get(collection)
+    if tier is None and event is not None:
+        tier = config.get("WRITE_CONCERN_EVENTS", {}).get(event)
+    if tier is None:
+        tier = config.get("WRITE_CONCERN_DEFAULT_TIER", "standard")
+    return tier
+
+
+def options(tier):
+    """Return the write concern options of a tier."""
+    return dict(current_app.config.get("WRITE_CONCERN_TIERS", {})
+                .get(tier, {}))
+
+
+def _observe(tier, collection, start):
+    metrics.observe("donthackme_write_duration_seconds",
+                    time.time() - start,
+                    {"tier": tier, "collection": collection})
+
+
+def save(document, event=None, acknowledged=False):
+    """
+    Save a document with the write concern of its tier.
+
+    Pass acknowledged=True when the caller relies on the server's reply,
+    such as a NotUniqueError, so that a w=0 tier is raised to w=1.
+    """
+    collection = partitions.base_collection_name(type(document))
+    tier = tier_for(collection, event or current_event())
+    write_concern = options(tier)
+    if acknowledged and write_concern.get("w") == 0:
+        write_concern["w"] = 1
+    start = time.time()
+    try:
+        with tracing.span("save " + collection, tier=tier), \
+                EXECUTOR.slot():
+            return document.save(write_concern=write_concern)
+    finally:
+        _observe(tier, collection, start)
+
+
+def update_one(queryset, event=None, **kwargs):
+    """Run queryset.update_one with the write concern of its tier."""
+    collection = partitions.base_collection_name(queryset._document)
+    tier = tier_for(collection, event or current_event())
+    start = time.time()
+    try:
+        with tracing.span("update " + collection, tier=tier), \
+                EXECUTOR.slot():
+            return queryset.update_one(write_concern=options(tier),
+                                       **kwargs)
+    finally:
+        _observe(tier, collection, start)
+
+
+def find_one_and_update(queryset, projection=None, event=None, **kwargs):
+    """
+    Update one document in its tier and return it as it was before.
+
+    The raw document is returned, or None when nothing matched. The
+    caller relies on the reply, so a w=0 tier is raised to w=1.
+    """
+    document = queryset._document
+    collection = partitions.base_collection_name(document)
+    tier = tier_for(collection, event or current_event())
+    write_concern = options(tier)
+    if write_concern.get("w") == 0:
+        write_concern["w"] = 1
+    target = document._get_collection().with_options(
+        write_concern=WriteConcern(**write_concern))
+    start = time.time()
+    try:
+        with tracing.span("update " + collection, tier=tier), \
+                EXECUTOR.slot():
+            return target.find_one_and_update(
+                queryset._query, transform.update(document, **kwargs),
+                projection=projection)
+    finally:
+        _observe(tier, collection, start)
+
+
+def push(document, doc_id, field, value, event=None):
+    """
+    Append value to a list field of one document, in its tier.
+
+    Concurrent pushes to the same document and tier are merged into one
+    update by the coalescer.
+    """
+    collection = partitions.base_collection_name(document)
+    tier = tier_for(collection, event or current_event())
+    target = document._get_collection().with_options(
+        write_concern=WriteConcern(**options(tier)))
+
+    def write(pushes):
+        start = time.time()
+        try:
+            with EXECUTOR.slot():
+                target.update_one({"_id": doc_id}, {"$push": dict(
+                    (name, {"$each": values})
+                    for name, values in pushes.items())})
+        finally:
+            _observe(tier, collection, start)
+
+    with tracing.span("push {0}.{1}".format(collection, field), tier=tier):
+        COALESCER.push(document, doc_id, field, value, write, group=tier)
+
+
+def init_app(app):
+    """Check that every tier the configuration names is defined."""
+    tiers = app.config.get("WRITE_CONCERN_TIERS", {})
+    named = [("WRITE_CONCERN_DEFAULT_TIER",
+              app.config.get("WRITE_CONCERN_DEFAULT_TIER", "standard"))]
+    for setting in ("WRITE_CONCERN_EVENTS", "WRITE_CONCERN_COLLECTIONS"):
+        for key, tier in sorted(app.config.get(setting, {}).items()):
+            named.append(("{0}[{1!r}]".format(setting, key), tier))
+    for setting, tier in named:
+        if tier not in tiers:
+            raise ValueError("{0} names tier {1!r}, which is not in "
+                             "WRITE_CONCERN_TIERS.".format(setting, tier))
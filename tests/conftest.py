@@ -0,0 +1,111 @@
+"""Fixtures: the app against mongomock, with a clean database per test."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sys
+
+import mongomock.gridfs
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+DB_NAME = "donthackme_test"
+
+CONFIG_TEMPLATE = """
+MONGODB_SETTINGS = {{"host": "mongomock://localhost", "db": {db!r}}}
+MONGODB_WARM_UP = False
+SECRET_KEY = "test"
+LOG_FILE = {log_file!r}
+METRICS_DIR = None
+PROFILE_DIR = None
+TRACE_ENABLED = False
+SLOWLOG_ENABLED = False
+HEARTBEAT_ENABLED = False
+RATELIMIT_ENABLED = False
+RESPONSE_CACHE_CHECK_INTERVAL = 0
+"""
+
+mongomock.gridfs.enable_gridfs_integration()
+
+
+@pytest.fixture(scope="session")
+def app(tmpdir_factory):
+    """Create the app once, against an in-memory mongomock database."""
+    workdir = tmpdir_factory.mktemp("donthackme")
+    config = workdir.join("test_config.py")
+    config.write(CONFIG_TEMPLATE.format(
+        db=DB_NAME, log_file=str(workdir.join("test.log"))))
+    os.environ["DONTHACKME_API_SETTINGS"] = str(config)
+
+    from donthackme_api.app import create_app
+    return create_app(app_name="donthackme_test")
+
+
+@pytest.fixture
+def db(app):
+    """Empty the database and the per-worker caches around a test."""
+    from mongoengine.connection import get_db
+
+    from donthackme_api import cache, hassh, mongo, partitions, profiles
+    from donthackme_api.events import views as event_views
+    from donthackme_api.models import TransactionLog
+
+    get_db().client.drop_database(get_db().name)
+    for document in mongo.documents():
+        document._collection = None
+    partitions.reset()
+    # mongomock cannot create capped collections; a plain one keeps the
+    # entries in the same order.
+    TransactionLog._collection = get_db()[
+        TransactionLog._get_collection_name()]
+    cache.RESPONSE_CACHE.__init__()
+    cache.RESPONSE_CACHE.configure(interval=0)
+    event_views.session_cache.clear()
+    event_views.failed_login_cache.clear()
+    profiles.SEEN.clear()
+    profiles.session_ips.clear()
+    hassh.known_versions.clear()
+    with app.app_context():
+        yield get_db()
+    partitions.ROUTER.scheme = None
+
+
+@pytest.fixture
+def api(app, db):
+    """
+    Return send(method, path, body=None) for a registered user.
+
+    send returns the status code and the decoded JSON body, or None.
+    """
+    from donthackme_api.models import User
+
+    user = User(username="test", email="test@example.com",
+                password="test", version=1).save()
+    test_client = app.test_client()
+    headers = {"X-Auth-Token": str(user.api_key)}
+
+    def send(method, path, body=None):
+        response = test_client.open(
+            path, method=method, headers=headers,
+            data=json.dumps(body) if body is not None else None,
+            content_type="application/json")
+        try:
+            return response.status_code, json.loads(response.data)
+        except ValueError:
+            return response.status_code, None
+    return send
@@ -0,0 +1,68 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from donthackme_api import metrics
+from donthackme_api.models import Sensor
+
+
+def test_liveness_does_not_touch_mongo(app, monkeypatch):
+    def refuse(*args, **kwargs):
+        raise AssertionError("MongoDB was queried.")
+    monkeypatch.setattr(Sensor, "_get_db", refuse)
+    response = app.test_client().get("/admin/live")
+    assert response.status_code == 200
+
+
+def test_readiness_pings_within_the_budget(app, db):
+    response = app.test_client().get("/admin/ready")
+    assert response.status_code == 200
+    body = json.loads(response.data)
+    assert body["status"] == "ready"
+    assert 0 <= body["ping_ms"] <= body["budget_ms"]
+    assert "in_use" in body["pool"]
+
+
+def test_readiness_fails_when_mongo_is_slow(app, db, monkeypatch):
+    monkeypatch.setitem(app.config, "READINESS_LATENCY_BUDGET_MS", -1)
+    response = app.test_client().get("/admin/ready")
+    assert response.status_code == 503
+    assert json.loads(response.data)["status"] == "degraded"
+
+
+def test_readiness_fails_when_mongo_is_down(app, db, monkeypatch):
+    class Down(object):
+        def command(self, name):
+            raise IOError("connection refused")
+    monkeypatch.setattr(Sensor, "_get_db", classmethod(lambda cls: Down()))
+    response = app.test_client().get("/admin/health")
+    assert response.status_code == 503
+    body = json.loads(response.data)
+    assert body["status"] == "unavailable"
+    assert body["error"] == "connection refused"
+
+
+def test_pool_stats_track_checkouts():
+    stats = metrics.PoolStats(window=2)
+    for wait in (0.5, 0.1, 0.2):
+        stats.checked_out(wait)
+    stats.checked_in()
+    summary = stats.to_dict()
+    assert summary["in_use"] == 2
+    # Only the last window of checkouts is summarised.
+    assert summary["recent_checkouts"] == 2
+    assert summary["wait_ms"]["max"] == 200.0
@@ -0,0 +1,123 @@
+"""Tests of blob reference counting, uploads and collection."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import io
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from donthackme_api import blobstore, pending
+from donthackme_api.models import Blob, PendingEvent, Session
+
+CONTENT = b"\x00ttylog" * 100
+
+
+def refs(sha256):
+    return Blob.objects.get(id=sha256).refs
+
+
+def test_put_stores_content_once(db):
+    sha256 = blobstore.put(CONTENT)
+    assert blobstore.put(CONTENT) == sha256
+    assert refs(sha256) == 2
+    assert blobstore.read(sha256) == CONTENT
+    assert db["blobs.files"].count_documents({}) == 1
+
+
+def test_reference_needs_stored_content(db):
+    assert not blobstore.reference(blobstore.digest(CONTENT))
+    sha256 = blobstore.put(CONTENT)
+    assert blobstore.reference(sha256)
+    assert refs(sha256) == 2
+
+
+def test_collect_removes_unreferenced_blobs_after_the_grace(db):
+    sha256 = blobstore.put(CONTENT)
+    blobstore.release(sha256)
+    assert blobstore.collect() == (0, 0)
+    Blob.objects(id=sha256).update(
+        last_referenced=datetime.utcnow() - timedelta(hours=2))
+    assert blobstore.collect() == (1, len(CONTENT))
+    assert not blobstore.exists(sha256)
+    assert blobstore.read(sha256) is None
+
+
+def test_recount_follows_the_referencing_documents(db):
+    sha256 = blobstore.put(CONTENT)
+    blobstore.put(CONTENT)
+    Session(session="a1", sensor_name="s", sensor_ip="10.0.0.1",
+            ttylog={"sha256": sha256}).save()
+    assert blobstore.recount() == 1
+    assert refs(sha256) == 1
+
+
+def test_ttylog_of_an_unknown_session_is_held(api):
+    status, _ = api("PUT", "/events/log/closed", {
+        "session": "a1", "sensor_name": "s", "sensor_ip": "10.0.0.1",
+        "ttylog": {"log_base64": base64.b64encode(CONTENT)}})
+    assert status == 202
+    assert refs(blobstore.digest(CONTENT)) == 1
+    assert PendingEvent.objects.count() == 1
+
+
+def test_expired_ttylog_releases_its_reference(app, api):
+    api("PUT", "/events/log/closed", {
+        "session": "a1", "sensor_name": "s", "sensor_ip": "10.0.0.1",
+        "ttylog": {"log_base64": base64.b64encode(CONTENT)}})
+    PendingEvent.objects.update(
+        received=datetime.utcnow() - timedelta(days=1))
+    with app.test_request_context("/"):
+        assert pending.sweep(force=True) == 1
+    assert PendingEvent.objects.count() == 0
+    assert refs(blobstore.digest(CONTENT)) == 0
+
+
+def test_retried_ttylog_keeps_one_reference(api):
+    session = {"session": "a1", "sensor_name": "s", "sensor_ip": "10.0.0.1"}
+    api("POST", "/events/session/connect", dict(
+        session, source_ip="203.0.113.5",
+        start_time="2016-07-01T00:00:00.000000Z"))
+    closed = dict(session, ttylog={"log_base64": base64.b64encode(CONTENT)})
+    assert api("PUT", "/events/log/closed", closed)[0] == 202
+    assert api("PUT", "/events/log/closed", closed)[0] == 202
+    assert refs(blobstore.digest(CONTENT)) == 1
+
+    other = b"\x01ttylog" * 100
+    api("PUT", "/events/log/closed", dict(
+        session, ttylog={"log_base64": base64.b64encode(other)}))
+    assert refs(blobstore.digest(CONTENT)) == 0
+    assert refs(blobstore.digest(other)) == 1
+
+
+def test_claim_keeps_an_upload_that_follows(db):
+    sha256 = blobstore.digest(CONTENT)
+    blobstore.claim(sha256)
+    assert not blobstore.exists(sha256)
+    assert blobstore.upload(sha256, io.BytesIO(CONTENT))
+    assert blobstore.exists(sha256)
+    assert refs(sha256) == 1
+    assert not blobstore.upload(sha256, io.BytesIO(CONTENT))
+
+
+def test_upload_rejects_content_with_another_digest(db):
+    sha256 = blobstore.digest(b"something else")
+    with pytest.raises(blobstore.DigestMismatch):
+        blobstore.upload(sha256, io.BytesIO(CONTENT))
+    assert not blobstore.exists(sha256)
+    with pytest.raises(blobstore.TooLarge):
+        blobstore.upload(sha256, io.BytesIO(CONTENT), max_bytes=10)
@@ -0,0 +1,75 @@
+"""Tests of the lookup caches and of response cache invalidation."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from donthackme_api import cache
+from donthackme_api.cache import TTLCache
+
+SESSION = {
+    "session": "a1b2c3d4",
+    "sensor_name": "sensor-1",
+    "sensor_ip": "10.0.0.1"
+}
+CONNECT = dict(SESSION, source_ip="203.0.113.5",
+               start_time="2016-07-01T00:00:00.000000Z")
+
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    entries = TTLCache(maxsize=10, ttl=60)
+    entries.set("key", "value")
+    assert entries.get("key") == "value"
+    now[0] += 61
+    assert entries.get("key") is None
+
+
+def test_ttl_cache_evicts_oldest():
+    entries = TTLCache(maxsize=2, ttl=60)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    entries.set("c", 3)
+    assert entries.get("a") is None
+    assert entries.get("b") == 2
+    assert entries.get("c") == 3
+
+
+def test_session_list_follows_child_writes(api):
+    assert api("POST", "/events/session/connect", CONNECT)[0] == 201
+    status, before = api("GET", "/sessions/")
+    assert status == 200
+    assert before["sessions"][0]["commands"] == []
+
+    status, _ = api("PUT", "/events/command/success", dict(
+        SESSION, command="uname -a", success=True,
+        timestamp="2016-07-01T00:00:05.000000Z"))
+    assert status == 202
+    status, after = api("GET", "/sessions/")
+    assert status == 200
+    assert len(after["sessions"][0]["commands"]) == 1
+
+
+def test_cached_response_is_served_until_a_write(api, db):
+    api("POST", "/events/session/connect", CONNECT)
+    first = api("GET", "/sessions/")[1]
+    # A change the TransactionLog does not hear of is not seen...
+    db.session.update_many({}, {"$set": {"source_ip": "198.51.100.1"}})
+    assert api("GET", "/sessions/")[1] == first
+    # ...until a logged write to a collection the view reads.
+    api("PUT", "/events/session/closed", dict(
+        SESSION, end_time="2016-07-01T00:01:00.000000Z"))
+    sessions = api("GET", "/sessions/")[1]["sessions"]
+    assert sessions[0]["source_ip"] == "198.51.100.1"
+
@@ -0,0 +1,98 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+import pytest
+
+from donthackme_api import concurrency
+from donthackme_api.models import Session
+
+
+def run_all(targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_executor_bounds_operations_in_flight():
+    executor = concurrency.Executor()
+    executor.configure(2)
+    state = {"running": 0, "most": 0}
+    lock = threading.Lock()
+
+    def operation():
+        with lock:
+            state["running"] += 1
+            state["most"] = max(state["most"], state["running"])
+        time.sleep(0.02)
+        with lock:
+            state["running"] -= 1
+
+    run_all([lambda: executor.run(operation)] * 6)
+    assert state["most"] == 2
+
+
+def test_unbounded_executor_just_calls():
+    executor = concurrency.Executor()
+    assert executor.run(max, 1, 2) == 2
+
+
+def test_coalescer_merges_pushes_waiting_on_a_write():
+    coalescer = concurrency.Coalescer()
+    first_write = threading.Event()
+    release = threading.Event()
+    writes = []
+
+    def write(pushes):
+        writes.append(dict(pushes))
+        if len(writes) == 1:
+            first_write.set()
+            release.wait()
+
+    def push(value):
+        return lambda: coalescer.push(Session, "id", "commands", value,
+                                      write)
+
+    first = threading.Thread(target=push(0))
+    first.start()
+    first_write.wait()
+    # These arrive while the first update is in flight, and are written
+    # together once it returns.
+    others = [threading.Thread(target=push(value)) for value in (1, 2, 3)]
+    for thread in others:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [first] + others:
+        thread.join()
+    assert writes[0] == {"commands": [0]}
+    assert len(writes) == 2
+    assert sorted(writes[1]["commands"]) == [1, 2, 3]
+
+
+def test_coalesced_push_failures_reach_every_caller():
+    coalescer = concurrency.Coalescer()
+
+    def write(pushes):
+        raise IOError("write failed")
+
+    with pytest.raises(IOError):
+        coalescer.push(Session, "id", "commands", 1, write)
+    assert coalescer._queues == {}
@@ -0,0 +1,103 @@
+"""Tests for HASSH fingerprints and the client catalog."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from datetime import datetime
+
+from donthackme_api import hassh
+from donthackme_api.models import ClientFingerprint
+
+# OpenSSH 7.6's client offer, and its HASSH as published by Salesforce.
+KEX = ["curve25519-sha256", "curve25519-sha256@libssh.org",
+       "ecdh-sha2-nistp256", "ecdh-sha2-nistp384", "ecdh-sha2-nistp521",
+       "diffie-hellman-group-exchange-sha256",
+       "diffie-hellman-group16-sha512", "diffie-hellman-group18-sha512",
+       "diffie-hellman-group-exchange-sha1",
+       "diffie-hellman-group14-sha256", "diffie-hellman-group14-sha1",
+       "ext-info-c"]
+ENC = ["chacha20-poly1305@openssh.com", "aes128-ctr", "aes192-ctr",
+       "aes256-ctr", "aes128-gcm@openssh.com", "aes256-gcm@openssh.com"]
+MAC = ["umac-64-etm@openssh.com", "umac-128-etm@openssh.com",
+       "hmac-sha2-256-etm@openssh.com", "hmac-sha2-512-etm@openssh.com",
+       "hmac-sha1-etm@openssh.com", "umac-64@openssh.com",
+       "umac-128@openssh.com", "hmac-sha2-256", "hmac-sha2-512",
+       "hmac-sha1"]
+COMP = ["none", "zlib@openssh.com", "zlib"]
+HASSH = "06046964c022c6407d15a27b12a6a4fb"
+
+VERSION = dict(session="a1b2c3d4", sensor_name="sensor-1",
+               sensor_ip="10.0.0.1", ssh_version="SSH-2.0-OpenSSH_7.6",
+               ssh_kexAlgs=KEX, ssh_encCS=ENC, ssh_macCS=MAC,
+               ssh_compCS=COMP)
+
+
+def test_published_hassh():
+    fingerprint, algorithms = hassh.from_session(VERSION)
+    assert fingerprint == HASSH
+    assert algorithms.split(";") == [
+        ",".join(names) for names in (KEX, ENC, MAC, COMP)]
+
+
+def test_sessions_without_algorithms_have_no_hassh():
+    assert hassh.from_session({"ssh_version": "SSH-2.0-Go"}) is None
+
+
+def test_older_sensors_leave_missing_lists_empty():
+    fingerprint, algorithms = hassh.from_session({"ssh_kexAlgs": KEX})
+    assert algorithms == ",".join(KEX) + ";;;"
+    assert fingerprint == hassh.hassh(algorithms)
+
+
+def test_record_counts_sessions_and_versions(db, monkeypatch):
+    monkeypatch.setattr(hassh, "MAX_VERSIONS", 2)
+    first, last = datetime(2016, 7, 1), datetime(2016, 7, 3)
+    hassh.record(HASSH, "kex;;;", "SSH-2.0-a", seen=last)
+    hassh.record(HASSH, "kex;;;", "SSH-2.0-a", seen=first)
+    hassh.record(HASSH, "kex;;;", "SSH-2.0-b", seen=last)
+    hassh.record(HASSH, "kex;;;", "SSH-2.0-c", seen=last)
+    client = ClientFingerprint.objects.get(id=HASSH)
+    assert client.sessions == 4
+    assert (client.first_seen, client.last_seen) == (first, last)
+    assert client.versions == ["SSH-2.0-a", "SSH-2.0-b"]
+
+
+def test_backfill_can_run_again(db):
+    hassh.record(HASSH, "kex;;;", "SSH-2.0-a", seen=datetime(2016, 7, 2))
+    group = {"_id": HASSH, "algorithms": "kex;;;", "sessions": 3,
+             "first_seen": datetime(2016, 7, 1),
+             "last_seen": datetime(2016, 7, 2),
+             "versions": [None, "SSH-2.0-a", "SSH-2.0-b"]}
+    hassh.backfill(group)
+    hassh.backfill(group)
+    client = ClientFingerprint.objects.get(id=HASSH)
+    assert client.sessions == 3
+    assert client.first_seen == datetime(2016, 7, 1)
+    assert client.versions == ["SSH-2.0-a", "SSH-2.0-b"]
+
+
+def test_client_version_fingerprints_the_session(api):
+    api("POST", "/events/session/connect", dict(
+        session="a1b2c3d4", sensor_name="sensor-1", sensor_ip="10.0.0.1",
+        source_ip="203.0.113.5", start_time="2016-07-01T00:00:00.000000Z"))
+    assert api("PUT", "/events/client/version", VERSION)[0] == 202
+
+    status, body = api("GET", "/search/clients/" + HASSH.upper())
+    assert status == 200
+    assert body["client"]["sessions"] == 1
+    assert [session["session"] for session in body["sessions"]] == \
+        ["a1b2c3d4"]
+    assert api("GET", "/search/clients")[1]["clients"][0]["hassh"] == HASSH
+    assert api("GET", "/search/clients/" + "0" * 32)[0] == 404
@@ -0,0 +1,112 @@
+"""Tests for sensor heartbeats and activity."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+
+from datetime import datetime, timedelta
+
+from donthackme_api import heartbeat
+from donthackme_api.heartbeat import Heartbeats, minute
+from donthackme_api.models import Sensor, SensorActivity, User
+
+
+def register(name, ip, last_seen=None):
+    return Sensor(timestamp=datetime(2016, 7, 1), name=name, ip=ip,
+                  last_seen=last_seen).save()
+
+
+def test_flush_writes_counts_and_last_seen(db):
+    register("sensor-1", "10.0.0.1")
+    start = minute(datetime.utcnow()) - timedelta(minutes=5)
+    heartbeats = Heartbeats()
+    heartbeats.record("sensor-1", "cowrie.command.input",
+                      start + timedelta(seconds=30))
+    heartbeats.record("sensor-1", "cowrie.command.input",
+                      start + timedelta(seconds=10))
+    heartbeats.record("sensor-1", "cowrie.login.failed",
+                      start + timedelta(minutes=1))
+    assert heartbeats.flush() == 1
+
+    sensor = Sensor.objects.get(name="sensor-1")
+    assert sensor.last_seen == start + timedelta(minutes=1)
+    assert sensor.event_counts == {"cowrie_command_input": 2,
+                                   "cowrie_login_failed": 1}
+    activity = SensorActivity._get_collection().find_one(
+        {"_id": "sensor-1:{0:%Y%m%d%H%M}".format(start)})
+    assert activity["events"] == 2
+    assert activity["counts"] == {"cowrie_command_input": 2}
+    assert SensorActivity.objects.count() == 2
+
+
+def test_flushes_add_up_and_empty_ones_write_nothing(db):
+    register("sensor-1", "10.0.0.1")
+    when = datetime(2016, 7, 1, 12, 0, 30)
+    heartbeats = Heartbeats()
+    for _ in range(2):
+        heartbeats.record("sensor-1", "cowrie.session.connect", when)
+        heartbeats.flush()
+    assert heartbeats.flush() == 0
+    sensor = Sensor.objects.get(name="sensor-1")
+    assert sensor.event_counts == {"cowrie_session_connect": 2}
+    assert SensorActivity._get_collection().find_one()["events"] == 2
+
+
+def test_flush_is_due_after_the_interval(monkeypatch):
+    heartbeats = Heartbeats(interval=10)
+    assert not heartbeats.due()
+    monkeypatch.setattr(heartbeat.time, "time",
+                        lambda: heartbeats._last_flush + 10)
+    assert heartbeats.due()
+
+
+def test_requests_record_their_sensor(app, db, monkeypatch):
+    heartbeats = Heartbeats(interval=3600)
+    monkeypatch.setattr(heartbeat, "HEARTBEATS", heartbeats)
+    body = json.dumps({"session": "a1", "sensor_name": "sensor-1"})
+    for status in (202, 400):
+        with app.test_request_context("/events/login/failed",
+                                      method="PUT", data=body,
+                                      content_type="application/json"):
+            heartbeat._record(app.response_class(status=status))
+    assert heartbeats._seen["sensor-1"][1] == {"cowrie_login_failed": 1}
+
+
+def test_sensors_report_liveness_and_rate(app, db, api):
+    now = datetime.utcnow()
+    register("sensor-1", "10.0.0.1", last_seen=now)
+    register("sensor-2", "10.0.0.2", last_seen=now - timedelta(hours=1))
+    register("sensor-3", "10.0.0.3")
+    heartbeats = Heartbeats()
+    for _ in range(30):
+        heartbeats.record("sensor-1", "cowrie.command.input",
+                          minute(now) - timedelta(minutes=1))
+    # The current minute is not yet complete, so it is not counted.
+    heartbeats.record("sensor-1", "cowrie.command.input", now)
+    heartbeats.flush()
+
+    assert api("GET", "/admin/sensors")[0] == 403
+    User.objects(username="test").update(set__roles=["admin"])
+    status, body = api("GET", "/admin/sensors")
+    assert status == 200
+    assert body["alive"] == 1
+    window = app.config["HEARTBEAT_RATE_MINUTES"]
+    assert [(sensor["name"], sensor["alive"], sensor["events_per_minute"])
+            for sensor in body["sensors"]] == [
+        ("sensor-1", True, 30.0 / window),
+        ("sensor-2", False, 0.0),
+        ("sensor-3", False, 0.0)]
+    assert body["sensors"][2]["seconds_since_seen"] is None
@@ -0,0 +1,199 @@
+"""Tests of the bulk importer: reading, checkpoints and shard writes."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import json
+import threading
+import time
+
+from datetime import datetime
+from Queue import Queue
+
+import pytest
+
+from donthackme_api import importer
+from donthackme_api.models import (AttackerProfile, Command, Credentials,
+                                   Sensor, SensorActivity, Session)
+
+
+def cowrie_events(session, commands):
+    """Return the cowrie.json events of a session running commands."""
+    common = {"session": session, "sensor": "sensor-1"}
+    events = [dict(common, eventid="cowrie.session.connect",
+                   src_ip="203.0.113.5", dst_ip="10.0.0.1",
+                   timestamp="2016-07-01T00:00:00.000000Z"),
+              dict(common, eventid="cowrie.login.success",
+                   username="root", password="admin",
+                   timestamp="2016-07-01T00:00:01.000000Z")]
+    for command in commands:
+        events.append(dict(common, eventid="cowrie.command.input",
+                           input=command,
+                           timestamp="2016-07-01T00:00:02.000000Z"))
+    return events
+
+
+def write_log(path, events, opener=open):
+    with opener(str(path), "wb") as log:
+        for event in events:
+            log.write(json.dumps(event) + "\n")
+
+
+class Worker(threading.Thread):
+    """Stand-in for an import process, failing the events it is told to."""
+
+    def __init__(self, inbox, outbox, fail=()):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.inbox = inbox
+        self.outbox = outbox
+        self.fail = set(fail)
+        self.written = []
+
+    def run(self):
+        failed = 0
+        while True:
+            message = self.inbox.get()
+            if message is None:
+                break
+            if message == "sync":
+                self.outbox.put(({"events": len(self.written)}, failed))
+                self.written = []
+                failed = 0
+            elif any(payload.get("command") in self.fail
+                     for _, payload in message):
+                failed += len(message)
+            else:
+                self.written.extend(message)
+
+
+def run_import(path, checkpoint, fail=()):
+    """Import path through one Worker; return the Importer."""
+    inbox, outbox = Queue(), Queue()
+    worker = Worker(inbox, outbox, fail)
+    worker.start()
+    job = importer.Importer(None, workers=1, batch_size=2,
+                            checkpoint_every=2, checkpoint=checkpoint)
+    job.started = time.time()
+    try:
+        job.import_file(path, [inbox], outbox, [worker])
+    finally:
+        inbox.put(None)
+        worker.join()
+    return job
+
+
+def test_read_events_resumes_from_any_offset(tmpdir):
+    path = tmpdir.join("cowrie.json.gz")
+    events = cowrie_events("a1", ["w", "id"])
+    with gzip.open(str(path), "wb") as log:
+        log.write(json.dumps(events[0]) + "\n\nnot json\n")
+        for event in events[1:]:
+            log.write(json.dumps(event) + "\n")
+    read = list(importer.read_events(str(path)))
+    assert [event for event, _ in read] == events
+    rest = importer.read_events(str(path), read[1][1])
+    assert [event for event, _ in rest] == events[2:]
+
+
+def test_checkpoint_is_saved_and_reloaded(tmpdir):
+    path = str(tmpdir.join("import.ckpt"))
+    checkpoint = importer.Checkpoint(path)
+    assert checkpoint.position("a.json") == 0
+    checkpoint.save("a.json", 120, 3)
+    checkpoint.save("b.json", 300, 9, done=True)
+    reloaded = importer.Checkpoint(path)
+    assert reloaded.position("a.json") == 120
+    assert reloaded.position("b.json") is None
+    assert reloaded.events == 9
+
+
+def test_finished_files_are_skipped_on_resume(tmpdir):
+    path = tmpdir.join("cowrie.json")
+    write_log(path, cowrie_events("a1", ["w", "id", "uname"]))
+    checkpoint = str(tmpdir.join("import.ckpt"))
+    first = run_import(str(path), checkpoint)
+    assert first.imported == 5
+    second = run_import(str(path), checkpoint)
+    assert second.imported == 0
+    assert second.total() == 5
+
+
+def test_failed_batch_stops_before_the_checkpoint(tmpdir):
+    path = tmpdir.join("cowrie.json")
+    write_log(path, cowrie_events("a1", ["w", "id", "uname", "free"]))
+    checkpoint = str(tmpdir.join("import.ckpt"))
+    with pytest.raises(RuntimeError):
+        run_import(str(path), checkpoint, fail=["uname"])
+    offsets = [offset for _, offset in importer.read_events(str(path))]
+    # Checkpoints come every two events: the third sync failed.
+    assert importer.Checkpoint(checkpoint).position(str(path)) == \
+        offsets[3]
+
+    resumed = run_import(str(path), checkpoint)
+    assert resumed.imported == 2
+    assert importer.Checkpoint(checkpoint).position(str(path)) is None
+
+
+def test_shard_writes_sessions_with_their_children(db):
+    translator = importer.Translator()
+    batch = [translator.translate(event)
+             for event in cowrie_events("a1", ["w", "id"])]
+    shard = importer.Shard()
+    counts = shard.apply([(eventid, payload)
+                          for eventid, _, _, payload in batch[:3]])
+    assert counts == {"cowrie.session.connect": 1,
+                      "cowrie.login.success": 1,
+                      "cowrie.command.success": 1}
+    # A later batch finds the session again, here from a new worker.
+    importer.Shard().apply([(batch[3][0], batch[3][3])])
+
+    session = Session.objects.get(session="a1")
+    assert session.source_ip == "203.0.113.5"
+    assert [cmd.command for cmd in session.commands] == ["w", "id"]
+    assert Command.objects(session=session.id).count() == 2
+    assert Credentials.objects.get().session.id == session.id
+
+
+def test_shard_updates_profiles_and_sensor_activity(db):
+    translator = importer.Translator()
+    batch = [translator.translate(event)
+             for event in cowrie_events("a1", ["w", "id"])]
+    shard = importer.Shard()
+    shard.apply([(eventid, payload)
+                 for eventid, _, _, payload in batch[:2]])
+    # The source IP of a session connected in an earlier batch is known.
+    shard.apply([(eventid, payload) for eventid, _, _, payload in batch[2:]])
+
+    profile = AttackerProfile.objects.get(id="203.0.113.5")
+    assert (profile.sessions, profile.login_attempts, profile.logins,
+            profile.commands) == (1, 1, 1, 2)
+    assert profile.sensors == ["sensor-1"]
+    assert profile.credentials == [["root", "admin"]]
+    assert profile.first_seen == datetime(2016, 7, 1)
+
+    sensor = Sensor.objects.get(name="sensor-1")
+    assert sensor.last_seen == datetime(2016, 7, 1, 0, 0, 2)
+    assert sensor.event_counts["cowrie_command_success"] == 2
+    assert SensorActivity.objects.get().events == 4
+
+
+def test_deliver_gives_up_on_an_exited_worker(monkeypatch):
+    monkeypatch.setattr(importer, "WORKER_POLL", 0.01)
+    inbox = Queue(maxsize=1)
+    inbox.put("waiting")
+    worker = Worker(inbox, Queue())
+    with pytest.raises(RuntimeError):
+        importer.deliver(inbox, worker, "more")
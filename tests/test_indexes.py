@@ -0,0 +1,47 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from donthackme_api import indexes, retention
+from donthackme_api.models import Command
+
+
+@pytest.fixture
+def policy():
+    saved = dict(retention.POLICY.days)
+    yield retention.POLICY
+    retention.POLICY.days = saved
+
+
+def ttl(document, name):
+    info = document._get_collection().index_information()[name]
+    return info.get("expireAfterSeconds")
+
+
+def test_create_builds_declared_indexes(db):
+    assert indexes.create([Command]) == 4
+    assert indexes.verify([Command]) == 0
+    assert indexes.create([Command]) == 0
+
+
+def test_retention_turned_off_removes_the_ttl(db, policy):
+    policy.days = {"command": 30}
+    indexes.create([Command])
+    policy.days = {}
+    indexes.create([Command])
+    assert ttl(Command, "timestamp_1") is None
+    assert indexes.verify([Command]) == 0
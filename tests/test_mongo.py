@@ -0,0 +1,82 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import types
+
+from datetime import datetime
+
+from flask import Flask
+
+from mongoengine import connection
+
+from donthackme_api import mongo
+from donthackme_api.models import Sensor
+
+
+def test_pool_settings_fill_in_mongodb_settings():
+    app = Flask(__name__)
+    app.config.update(MONGODB_SETTINGS={"host": "db", "maxPoolSize": 5},
+                      MONGODB_MAX_POOL_SIZE=50,
+                      MONGODB_MAX_IDLE_TIME_MS=60000)
+    settings = mongo.connection_settings(app)
+    assert settings["maxPoolSize"] == 5
+    assert settings["maxIdleTimeMS"] == 60000
+    assert settings["connect"] is False
+
+
+def test_reset_drops_inherited_clients(db):
+    Sensor(name="sensor-1", ip="10.0.0.1",
+           timestamp=datetime(2016, 7, 1)).save()
+    client = Sensor._get_collection().database.client
+    mongo.reset_connections()
+    assert Sensor._collection is None
+    assert connection._connections == {}
+    # The next query connects again, with a client of its own.
+    assert Sensor._get_collection().database.client is not client
+
+
+def uwsgi_postfork(monkeypatch):
+    """Pretend to run under uWSGI; return the postfork hooks."""
+    hooks = []
+    decorators = types.ModuleType("uwsgidecorators")
+    decorators.postfork = hooks.append
+    monkeypatch.setitem(sys.modules, "uwsgi", types.ModuleType("uwsgi"))
+    monkeypatch.setitem(sys.modules, "uwsgidecorators", decorators)
+    return hooks
+
+
+def test_workers_warm_up_after_the_fork(app, monkeypatch):
+    warmed = []
+    monkeypatch.setattr(mongo, "warm_up", warmed.append)
+    hooks = uwsgi_postfork(monkeypatch)
+    monkeypatch.setitem(app.config, "MONGODB_WARM_UP", True)
+    mongo.register_postfork(app)
+    assert warmed == []
+    hooks[0]()
+    assert warmed == [app]
+
+
+def test_warm_up_can_be_turned_off_in_workers(app, monkeypatch):
+    warmed = []
+    monkeypatch.setattr(mongo, "warm_up", warmed.append)
+    hooks = uwsgi_postfork(monkeypatch)
+    mongo.register_postfork(app)
+    Sensor._get_collection()
+    hooks[0]()
+    assert warmed == []
+    # The clients are still replaced in the worker.
+    assert Sensor._collection is None
@@ -0,0 +1,128 @@
+"""Tests of the partition router and of partitioned collections."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from donthackme_api import partitions
+from donthackme_api.models import Command, Session
+
+
+@pytest.fixture
+def router():
+    router = partitions.Router()
+    router.scheme = "monthly"
+    return router
+
+
+def test_disabled_router_uses_base_collections():
+    router = partitions.Router()
+    assert router.suffix_for("2016-07-14T12:00:00Z") is None
+    assert router.session_partitions() == [None]
+
+
+def test_monthly_suffix_and_bounds(router):
+    assert router.suffix_for("2016-07-14T12:00:00Z") == "2016_07"
+    assert router.bounds("2016_12") == (datetime(2016, 12, 1),
+                                        datetime(2017, 1, 1))
+
+
+def test_weekly_suffix_and_bounds(router):
+    router.scheme = "weekly"
+    # 2016-01-01 is a Friday, in the last ISO week of 2015.
+    assert router.suffix_for(datetime(2016, 1, 1)) == "2015_w53"
+    start, end = router.bounds("2016_w27")
+    assert start == datetime(2016, 7, 4)
+    assert end - start == timedelta(days=7)
+
+
+def test_timezones_are_converted_to_utc(router):
+    assert router.suffix_for("2016-07-01T01:00:00+02:00") == "2016_06"
+
+
+def test_epoch_hints(router):
+    assert partitions.to_datetime(1467331200) == datetime(2016, 7, 1)
+    assert router.suffix_for(1467331200.5) == "2016_07"
+    with pytest.raises(ValueError):
+        partitions.to_datetime(True)
+    with pytest.raises(ValueError):
+        partitions.to_datetime({"$gt": 0})
+
+
+def test_suffixes_between(router):
+    assert router.suffixes_between("2016-11-20", "2017-02-01") == [
+        "2016_11", "2016_12", "2017_01", "2017_02"]
+
+
+def test_session_partitions_reach_back_to_the_previous_period(router):
+    assert router.session_partitions("2016-07-01T06:00:00Z") == [
+        "2016_07", "2016_06", None]
+    router.include_legacy = False
+    assert router.session_partitions("2016-07-15T06:00:00Z") == [
+        "2016_07"]
+
+
+def test_strip_suffix():
+    assert partitions.strip_suffix("session_2016_07") == "session"
+    assert partitions.strip_suffix("session_2016_w27") == "session"
+    assert partitions.strip_suffix("transaction_log") == "transaction_log"
+
+
+def test_documents_are_routed_to_the_active_partition(db):
+    partitions.ROUTER.scheme = "monthly"
+    with partitions.use("2016_07"):
+        Session(session="a1", sensor_name="s", sensor_ip="10.0.0.1",
+                start_time=datetime(2016, 7, 2)).save()
+        assert Command._get_collection_name() == "command_2016_07"
+    assert partitions.current_suffix() is None
+    assert db["session_2016_07"].count_documents({}) == 1
+    assert db["session"].count_documents({}) == 0
+    assert partitions.ROUTER.existing("session") == ["2016_07"]
+
+
+def test_partitions_are_created_with_their_indexes(db):
+    partitions.ROUTER.scheme = "monthly"
+    with partitions.use("2016_08"):
+        Command._get_collection()
+    assert "timestamp_1" in db["command_2016_08"].index_information()
+
+
+def test_requests_only_build_unique_partition_indexes(app, db):
+    partitions.ROUTER.scheme = "monthly"
+    with app.test_request_context("/"):
+        with partitions.use("2016_09"):
+            Command._get_collection().insert_one({"command": "w"})
+            Session._get_collection().insert_one({"session": "a1"})
+    assert "timestamp_1" not in db["command_2016_09"].index_information()
+    indexes = db["session_2016_09"].index_information()
+    assert indexes["session_1_sensor_ip_1"]["unique"]
+    assert "source_ip_1" not in indexes
+
+
+def test_untimed_events_find_old_sessions(api):
+    partitions.ROUTER.scheme = "monthly"
+    session = dict(session="a1", sensor_name="sensor-1",
+                   sensor_ip="10.0.0.1")
+    api("POST", "/events/session/connect", dict(
+        session, source_ip="203.0.113.5",
+        start_time="2016-07-01T00:00:00.000000Z"))
+    # client.size has no timestamp to narrow the search by.
+    assert api("PUT", "/events/client/size", dict(
+        session, ttysize={"width": 80, "height": 24}))[0] == 202
+    assert partitions.ROUTER.partitions(Session) == ["2016_07"]
+    with partitions.use("2016_07"):
+        assert Session.objects.get().ttysize.width == 80
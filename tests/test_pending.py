@@ -0,0 +1,72 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime, timedelta
+
+from donthackme_api import pending
+from donthackme_api.models import Command, PendingEvent, Session
+
+SESSION = {
+    "session": "a1b2c3d4",
+    "sensor_name": "sensor-1",
+    "sensor_ip": "10.0.0.1"
+}
+CONNECT = dict(SESSION, source_ip="203.0.113.5",
+               start_time="2016-07-01T00:00:00.000000Z")
+
+
+def command(text, second):
+    return dict(SESSION, command=text, success=True,
+                timestamp="2016-07-01T00:00:{0:02d}.000000Z".format(second))
+
+
+def test_early_events_are_applied_in_order_on_connect(api):
+    assert api("PUT", "/events/command/success", command("id", 9))[0] == 202
+    assert api("PUT", "/events/command/success", command("w", 5))[0] == 202
+    assert PendingEvent.objects.count() == 2
+    assert Session.objects.count() == 0
+
+    assert api("POST", "/events/session/connect", CONNECT)[0] == 201
+    assert PendingEvent.objects.count() == 0
+    session = Session.objects.get()
+    assert [cmd.command for cmd in session.commands] == ["w", "id"]
+
+
+def test_held_events_per_session_are_capped(app, api, monkeypatch):
+    monkeypatch.setitem(app.config, "PENDING_MAX_PER_SESSION", 1)
+    assert api("PUT", "/events/command/success", command("w", 5))[0] == 202
+    assert api("PUT", "/events/command/success", command("id", 9))[0] == 404
+    assert PendingEvent.objects.count() == 1
+
+
+def test_sweep_drops_expired_events(app, api):
+    api("PUT", "/events/command/success", command("w", 5))
+    with app.test_request_context("/"):
+        assert pending.sweep(force=True) == 0
+        PendingEvent.objects.update(
+            received=datetime.utcnow() - timedelta(days=1))
+        assert pending.sweep(force=True) == 1
+    assert PendingEvent.objects.count() == 0
+    assert Command.objects.count() == 0
+
+
+def test_only_event_requests_sweep(app, api, monkeypatch):
+    swept = []
+    monkeypatch.setattr(pending, "sweep", lambda: swept.append(True))
+    app.test_client().get("/admin/live")
+    assert swept == []
+    api("PUT", "/events/command/success", command("w", 5))
+    assert swept == [True]
@@ -0,0 +1,77 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import time
+
+from donthackme_api import profiler
+from donthackme_api.models import User
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def idle(stop):
+    stop.wait()
+
+
+def test_collapse_renders_the_stack_root_first():
+    stack = profiler.collapse(sys._getframe())
+    assert stack.endswith(
+        "test_profiler.py:test_collapse_renders_the_stack_root_first")
+
+
+def test_run_samples_matching_requests_only(tmpdir):
+    sampler = profiler.SamplingProfiler()
+    sampler.directory = str(tmpdir)
+    stop = threading.Event()
+    threads = [threading.Thread(target=target, args=(stop,))
+               for target in (spin, idle)]
+    for thread in threads:
+        thread.start()
+    sampler._requests[threads[0].ident] = ("/events/command/success",
+                                           "/events/command/success")
+    sampler._requests[threads[1].ident] = ("/sessions/", "/sessions/")
+    try:
+        assert sampler.start(0.2, "/events/command/*", 0.005)
+        assert not sampler.start(0.2)
+        while sampler.status()["active"]:
+            time.sleep(0.01)
+    finally:
+        stop.set()
+    run = sampler.status()["run"]
+    assert run["samples"] > 0
+    with open(run["output"]) as collapsed:
+        lines = collapsed.read().splitlines()
+    assert all("test_profiler.py:spin" in line for line in lines)
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == \
+        run["samples"]
+
+
+def test_short_intervals_are_raised_to_a_millisecond(app, api):
+    User.objects(username="test").update(set__roles=["admin"])
+    status, body = api("POST", "/admin/profile",
+                       {"seconds": 0.05, "interval_ms": 0.01})
+    assert status == 202
+    assert body["run"]["interval"] == 0.001
+    assert api("POST", "/admin/profile", {"seconds": 1})[0] == 409
+    while profiler.PROFILER.status()["active"]:
+        time.sleep(0.01)
+    assert api("POST", "/admin/profile", {"interval_ms": -1})[0] == 400
+    assert api("POST", "/admin/profile", {"seconds": "soon"})[0] == 400
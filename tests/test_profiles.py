@@ -0,0 +1,79 @@
+"""Tests of the lookup caches and of response cache invalidation."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from donthackme_api import profiles
+from donthackme_api.models import AttackerProfile
+
+SESSION = {
+    "session": "a1b2c3d4",
+    "sensor_name": "sensor-1",
+    "sensor_ip": "10.0.0.1"
+}
+CONNECT = dict(SESSION, source_ip="203.0.113.5",
+               start_time="2016-07-01T00:00:00.000000Z")
+
+
+def test_attacker_profile_follows_login_attempts(api):
+    api("POST", "/events/session/connect", CONNECT)
+    status, before = api("GET", "/search/attackers/203.0.113.5")
+    assert status == 200
+    assert before["attacker"]["login_attempts"] == 0
+
+    api("PUT", "/events/login/failed", dict(
+        SESSION, username="root", password="admin", success=False,
+        timestamp="2016-07-01T00:00:03.000000Z"))
+    after = api("GET", "/search/attackers/203.0.113.5")[1]
+    assert after["attacker"]["login_attempts"] == 1
+    assert after["attacker"]["credentials"] == [
+        {"username": "root", "password": "admin"}]
+
+
+def test_known_ip_keeps_the_earliest_first_seen(db):
+    profiles.session_started("a1", "203.0.113.5", "sensor-1",
+                             "2016-07-02T00:00:00.000000Z")
+    # Another worker, or a filter cleared by a restart, still moves
+    # first_seen back for an earlier event.
+    profiles.session_started("a2", "203.0.113.5", "sensor-1",
+                             "2016-07-01T00:00:00.000000Z")
+    profile = AttackerProfile.objects.get(id="203.0.113.5")
+    assert profile.first_seen.day == 1
+    assert profile.last_seen.day == 2
+    assert profile.sessions == 2
+
+
+def test_profile_written_elsewhere_is_upserted(db):
+    profiles.SEEN.add("ip:203.0.113.5")
+    profiles.session_started("a1", "203.0.113.5", "sensor-1",
+                             "2016-07-01T00:00:00.000000Z")
+    assert AttackerProfile.objects.get(id="203.0.113.5").sessions == 1
+
+
+def test_values_are_added_after_a_lost_write(db):
+    profiles.session_started("a1", "203.0.113.5", "sensor-1", None)
+    AttackerProfile.objects(id="203.0.113.5").update(set__sensors=[])
+    profiles.session_started("a2", "203.0.113.5", "sensor-1", None)
+    profiles.session_started("a3", "203.0.113.5", "sensor-2", None)
+    assert AttackerProfile.objects.get(id="203.0.113.5").sensors == \
+        ["sensor-1", "sensor-2"]
+
+
+def test_value_lists_are_capped(db, monkeypatch):
+    monkeypatch.setitem(profiles.settings, "max_values", 2)
+    for number in range(3):
+        profiles.session_started("a{0}".format(number), "203.0.113.5",
+                                 "sensor-{0}".format(number), None)
+    assert AttackerProfile.objects.get(id="203.0.113.5").sensors == \
+        ["sensor-0", "sensor-1"]
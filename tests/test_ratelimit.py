@@ -0,0 +1,73 @@
+"""Tests of the per-user token buckets."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from donthackme_api.ratelimit import Limiter
+
+
+class User(object):
+    def __init__(self, username, api_key="key"):
+        self.id = username
+        self.username = username
+        self.api_key = api_key
+
+
+@pytest.fixture
+def limiter(tmpdir):
+    limiter = Limiter()
+    limiter.directory = str(tmpdir)
+    limiter.enabled = True
+    return limiter
+
+
+def test_burst_then_refusal(limiter):
+    for _ in range(3):
+        assert limiter.take("alice", 1.0, 3.0, now=100.0) == 0
+    assert limiter.take("alice", 1.0, 3.0, now=100.0) == pytest.approx(1.0)
+
+
+def test_tokens_refill_at_the_rate(limiter):
+    for _ in range(2):
+        limiter.take("alice", 2.0, 2.0, now=100.0)
+    assert limiter.take("alice", 2.0, 2.0, now=100.0) == pytest.approx(0.5)
+    assert limiter.take("alice", 2.0, 2.0, now=100.5) == 0
+    # Refills never go past the burst.
+    for _ in range(2):
+        assert limiter.take("alice", 2.0, 2.0, now=1000.0) == 0
+    assert limiter.take("alice", 2.0, 2.0, now=1000.0) > 0
+
+
+def test_buckets_are_per_user(limiter):
+    assert limiter.take("alice", 1.0, 1.0, now=100.0) == 0
+    assert limiter.take("alice", 1.0, 1.0, now=100.0) > 0
+    assert limiter.take("bob", 1.0, 1.0, now=100.0) == 0
+
+
+def test_buckets_are_shared_through_their_files(limiter, tmpdir):
+    limiter.take("alice", 1.0, 1.0, now=100.0)
+    other = Limiter()
+    other.directory = str(tmpdir)
+    assert other.take("alice", 1.0, 1.0, now=100.0) > 0
+
+
+def test_overrides_by_api_key_or_username(limiter):
+    limiter.overrides = {"sensor-key": {"rate": 500}, "bulk": {"rate": 0}}
+    assert limiter.limits(User("alice", "sensor-key")) == (500.0, 200.0)
+    assert limiter.limits(User("alice")) == (50.0, 200.0)
+    user = User("bulk")
+    for _ in range(1000):
+        assert limiter.check(user) == 0
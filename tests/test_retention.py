@@ -0,0 +1,83 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime, timedelta
+
+from donthackme_api import retention
+from donthackme_api.models import Command, Session
+
+
+def test_apply_sets_ttl_on_the_time_field_index():
+    policy = retention.Policy()
+    policy.days = {"command": 2}
+    specs = [([("session", 1)], {}), ([("timestamp", 1)], {})]
+    assert policy.apply("command", specs)[1] == \
+        ([("timestamp", 1)], {"expireAfterSeconds": 2 * retention.DAY})
+
+
+def test_apply_adds_a_time_field_index_when_none_is_declared():
+    policy = retention.Policy()
+    policy.days = {"session": 1}
+    specs = policy.apply("session", [([("session", 1)], {})])
+    assert specs[-1] == ([("start_time", 1)],
+                         {"expireAfterSeconds": retention.DAY})
+
+
+def test_apply_leaves_collections_without_retention():
+    specs = [([("timestamp", 1)], {})]
+    assert retention.Policy().apply("command", specs) == \
+        [([("timestamp", 1)], {})]
+
+
+def test_archive_cutoff_uses_the_shortest_child_ttl():
+    policy = retention.Policy()
+    assert policy.archive_cutoff() is None
+    policy.days = {"session": 90, "command": 30, "ttylog": 1}
+    now = datetime(2016, 7, 31)
+    assert policy.archive_cutoff(now) == \
+        now - timedelta(days=30) + policy.lead
+
+
+def test_archive_appends_and_looks_up_sessions(tmpdir):
+    store = retention.Archive(str(tmpdir))
+    assert store.lookup("a1b2c3d4") == []
+    documents = [
+        {"_id": 1, "session": "a1b2c3d4", "sensor_name": "sensor-1",
+         "start_time": datetime(2016, 7, 1)},
+        {"_id": 2, "session": "a1b2c3d4", "sensor_name": "sensor-2",
+         "start_time": datetime(2016, 7, 2)},
+    ]
+    assert store.append(documents) == 2
+    assert [document["_id"] for document in store.lookup("a1b2c3d4")] == \
+        [2, 1]
+    assert [document["_id"] for document in
+            store.lookup("a1b2c3d4", "sensor-1")] == [1]
+
+
+def test_archive_sessions_inlines_children(db, tmpdir, monkeypatch):
+    monkeypatch.setattr(retention.POLICY, "archive_dir", str(tmpdir))
+    session = Session(session="a1b2c3d4", sensor_name="sensor-1",
+                      sensor_ip="10.0.0.1", source_ip="203.0.113.5",
+                      start_time=datetime(2016, 7, 1)).save()
+    Command(session=session.id, sensor_name="sensor-1",
+            timestamp=datetime(2016, 7, 1), command="uname -a",
+            success=True).save()
+    assert retention.archive_sessions(datetime(2016, 8, 1)) == 1
+    assert Session.objects.get(id=session.id).archived is not None
+    archived, = retention.archive().lookup("a1b2c3d4")
+    assert [command["command"] for command in archived["commands"]] == \
+        ["uname -a"]
+    assert retention.archive_sessions(datetime(2016, 8, 1)) == 0
